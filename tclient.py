@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010, 2018, Oracle and/or its affiliates. All rights reserved.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 only, as
+# published by the Free Software Foundation.
+#
+# This code is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# version 2 for more details (a copy is included in the LICENSE file that
+# accompanied this code).
+#
+# You should have received a copy of the GNU General Public License version
+# 2 along with this work; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Please contact Oracle, 500 Oracle Parkway, Redwood Shores, CA 94065 USA
+# or visit www.oracle.com if you need additional information or have any
+# questions.
+#
+
+"""run an hg command through a trees command server (see hg help tserve)
+
+usage: tclient.py [--socket PATH] COMMAND [ARG]...
+
+The command and its arguments are sent, with the current directory and the
+environment, to the server listening on PATH, on $TREES_SOCKET or on the first
+.hg/trees.sock found in the current directory or its parents.  The output of
+the command is shown and its exit status returned; standard input is sent to
+the server as the command reads it.  If there is no server, hg is run instead
+($HG, if set).
+
+This deliberately does not import mercurial, so that it starts quickly.
+"""
+
+import os
+import socket
+import struct
+import sys
+
+def findsocket(path):
+    while True:
+        sock = os.path.join(path, '.hg', 'trees.sock')
+        if os.path.exists(sock):
+            return sock
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def recvall(conn, n):
+    l = []
+    while n:
+        s = conn.recv(n)
+        if not s:
+            break
+        l.append(s)
+        n -= len(s)
+    return ''.join(l)
+
+def frame(data, ch=''):
+    return ch + struct.pack('>I', len(data)) + data
+
+def connect(path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except socket.error:
+        conn.close()
+        return None
+    return conn
+
+def main(args):
+    path = None
+    if args[:1] == ['--socket']:
+        path = args[1]
+        args = args[2:]
+    cwd = os.getcwd()
+    path = path or os.environ.get('TREES_SOCKET') or findsocket(cwd)
+    conn = path and connect(path)
+    if not conn:
+        hg = os.environ.get('HG', 'hg')
+        os.execvp(hg, [hg] + args)
+    env = ['%s=%s' % (k, v) for k, v in os.environ.items() if '\0' not in v]
+    conn.sendall(frame('\0'.join([cwd] + args)) + frame('\0'.join(env)))
+    while True:
+        header = recvall(conn, 5)
+        if len(header) < 5:
+            sys.stderr.write('tclient: lost connection to %s\n' % path)
+            return 255
+        ch, n = header[0], struct.unpack('>I', header[1:])[0]
+        data = recvall(conn, n)
+        if ch == 'o':
+            sys.stdout.write(data)
+            sys.stdout.flush()
+        elif ch == 'e':
+            sys.stderr.write(data)
+            sys.stderr.flush()
+        elif ch in 'IL':
+            # The command reads its input:  up to n bytes, or a line.
+            n = struct.unpack('>I', data)[0]
+            try:
+                if ch == 'I':
+                    data = sys.stdin.read(n)
+                else:
+                    data = sys.stdin.readline(n)
+            except (IOError, OSError):
+                data = ''
+            conn.sendall(frame(data, 'i'))
+        elif ch == 'r':
+            return struct.unpack('>i', data)[0]
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
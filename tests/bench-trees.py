@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010, 2018, Oracle and/or its affiliates. All rights reserved.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 only, as
+# published by the Free Software Foundation.
+#
+# This code is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# version 2 for more details (a copy is included in the LICENSE file that
+# accompanied this code).
+#
+# You should have received a copy of the GNU General Public License version
+# 2 along with this work; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Please contact Oracle, 500 Oracle Parkway, Redwood Shores, CA 94065 USA
+# or visit www.oracle.com if you need additional information or have any
+# questions.
+#
+
+"""benchmark the trees extension on a generated forest
+
+A 'remote' forest is generated with the requested shape (subtrees per repo,
+levels of nesting, changesets per repo, files in each working dir).  It is
+cloned with tclone (using a file:// url, so it stands in for a server), new
+changesets are added to the remote, and then each t* command is timed against
+the clone.  tclone is timed on fresh destinations and tpull is run last, once,
+since it changes the clone.  The startup cost of the extension is shown by
+timing hg id (which trees does not change) with and without the extension.
+
+For each command the wall clock time (the best of --repeat runs), the user and
+system cpu time and the peak RSS (of hg and any processes it waited for) are
+recorded.  Commands that show a [repo]: header for each repo also get a
+per-repo breakdown:  the time between the output of successive repos, which
+(since trees flushes the output of each repo when the repo is done) is close
+to the time spent on each repo.
+
+The results are written as JSON (--output), and can be compared with the
+results of an earlier run (--compare).  Typical use:
+
+    $ make bench BENCH_ARGS='--output before.json'
+    ... change trees.py ...
+    $ make bench BENCH_ARGS='--compare before.json'
+"""
+
+import json
+import optparse
+import os
+import re
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Commands run against the clone, in order, with their arguments.  'J' marks
+# commands that accept --jobs.
+COMMANDS = [
+    ('tlist', [], ''),
+    ('tstatus', [], 'J'),
+    ('tsummary', [], 'J'),
+    ('theads', [], 'J'),
+    ('ttip', [], 'J'),
+    ('tparents', [], 'J'),
+    ('tlog', ['-l', '5'], 'J'),
+    ('tdiff', [], 'J'),
+    ('tincoming', [], 'J'),
+    ('toutgoing', [], 'J'),
+]
+
+_header = re.compile(r'^\[(.*)\]:$')
+
+class bench(object):
+    def __init__(self, opts):
+        self.opts = opts
+        self.dir = opts.dir or tempfile.mkdtemp(prefix='bench-trees-')
+        self.remote = os.path.join(self.dir, 'remote')
+        self.local = os.path.join(self.dir, 'local')
+        self.env = dict(os.environ)
+        self.env['HGPLAIN'] = '1'
+        self.env['HGRCPATH'] = os.path.join(self.dir, 'hgrc')
+        f = open(self.env['HGRCPATH'], 'w')
+        f.write('[extensions]\ntrees = %s\n[ui]\nusername = bench\n' %
+                opts.extension)
+        f.close()
+
+    def hg(self, *args):
+        """Run hg quietly; raise an exception if it fails."""
+        p = subprocess.Popen([self.opts.hg] + list(args), env=self.env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        if p.returncode:
+            raise Exception('hg %s failed:\n%s' % (' '.join(args), out))
+        return out
+
+    def subtrees(self, prefix, level):
+        if level >= self.opts.depth:
+            return []
+        return ['%s%d' % (prefix, i) for i in range(self.opts.width)]
+
+    def generate(self, root, prefix='s', level=0):
+        """Create the repo at root and its subtrees, recursively."""
+        os.makedirs(root)
+        self.hg('init', root)
+        if self.opts.commits > 1:
+            self.hg('-R', root, 'debugbuilddag', '--mergeable-file',
+                    '+%d' % (self.opts.commits - 1))
+            self.hg('-R', root, 'update', '-q', 'tip')
+        data = 'x' * (self.opts.file_size - 1) + '\n'
+        for i in range(self.opts.files):
+            d = os.path.join(root, 'd%d' % (i % 10))
+            if not os.path.isdir(d):
+                os.mkdir(d)
+            f = open(os.path.join(d, 'f%d' % i), 'w')
+            f.write(data)
+            f.close()
+        subtrees = self.subtrees(prefix, level)
+        if subtrees:
+            f = open(os.path.join(root, '.hg', 'trees'), 'w')
+            f.write('\n'.join(subtrees) + '\n')
+            f.close()
+            f = open(os.path.join(root, '.hgignore'), 'w')
+            f.write('\n'.join(['^%s$' % s for s in subtrees]) + '\n')
+            f.close()
+        self.hg('-R', root, 'commit', '-q', '-A', '-m', 'files')
+        n = 1
+        for s in subtrees:
+            n += self.generate(os.path.join(root, s), s + '.', level + 1)
+        return n
+
+    def addchanges(self, root, prefix='s', level=0):
+        """Add a changeset to each repo in the forest at root."""
+        f = open(os.path.join(root, 'new'), 'a')
+        f.write('new\n')
+        f.close()
+        self.hg('-R', root, 'commit', '-q', '-A', '-m', 'new')
+        for s in self.subtrees(prefix, level):
+            self.addchanges(os.path.join(root, s), s + '.', level + 1)
+
+    def run(self, args):
+        """Run hg with args; return a dict describing the run."""
+        start = time.time()
+        p = subprocess.Popen([self.opts.hg] + args, env=self.env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             cwd=self.dir)
+        repos = []
+        buf = ''
+        fd = p.stdout.fileno()
+        while True:
+            select.select([fd], [], [])
+            s = os.read(fd, 65536)
+            if not s:
+                break
+            now = time.time()
+            buf += s
+            lines = buf.split('\n')
+            buf = lines.pop()
+            for line in lines:
+                m = _header.match(line)
+                if m:
+                    repos.append((m.group(1), now))
+        pid, status, ru = os.wait4(p.pid, 0)
+        p.returncode = status
+        end = time.time()
+        d = {'wall': end - start, 'user': ru.ru_utime, 'sys': ru.ru_stime,
+             'maxrss_kb': ru.ru_maxrss, 'rc': os.WEXITSTATUS(status)}
+        if repos:
+            d['repos'] = {}
+            prev = start
+            for root, t in repos:
+                path = root[len(self.local) + 1:] or '.'
+                d['repos'][path] = t - prev
+                prev = t
+        return d
+
+    def time(self, name, args, repeat):
+        runs = [self.run(args) for i in range(repeat)]
+        best = min(runs, key=lambda r: r['wall'])
+        best['runs'] = [r['wall'] for r in runs]
+        self.results[name] = best
+        self.report(name, best)
+
+    def report(self, name, r):
+        sys.stdout.write('%-12s %8.3fs  user %7.3fs  sys %7.3fs  %8d KB  rc %d\n'
+                         % (name, r['wall'], r['user'], r['sys'],
+                            r['maxrss_kb'], r['rc']))
+        if self.opts.verbose and r.get('repos'):
+            for path in sorted(r['repos']):
+                sys.stdout.write('    %-30s %8.3fs\n' % (path,
+                                                        r['repos'][path]))
+        sys.stdout.flush()
+
+    def main(self):
+        opts = self.opts
+        self.results = {}
+        t = time.time()
+        n = self.generate(self.remote)
+        sys.stdout.write('generated %d repos in %.1fs in %s\n' %
+                         (n, time.time() - t, self.dir))
+        jobs = []
+        if opts.jobs:
+            jobs = ['--jobs', str(opts.jobs)]
+        url = 'file://' + self.remote
+        clones = []
+        for i in range(opts.repeat):
+            clones.append(os.path.join(self.dir, 'clone%d' % i))
+        runs = []
+        for dest in clones:
+            runs.append(self.run(['tclone', '-q'] + jobs + [url, dest]))
+        best = min(runs, key=lambda r: r['wall'])
+        best['runs'] = [r['wall'] for r in runs]
+        self.results['tclone'] = best
+        self.report('tclone', best)
+        os.rename(clones[0], self.local)
+        for dest in clones[1:]:
+            shutil.rmtree(dest)
+        # What having trees enabled costs a command that does not use it.
+        startup = max(opts.repeat, 10)
+        self.time('id', ['id', '-R', self.local], startup)
+        self.time('id-notrees', ['--config', 'extensions.trees=!', 'id', '-R',
+                                 self.local], startup)
+        self.addchanges(self.remote)
+        for cmd, args, flags in COMMANDS:
+            a = [cmd, '-R', self.local] + args
+            if 'J' in flags:
+                a += jobs
+            self.time(cmd, a, opts.repeat)
+        self.time('tpull', ['tpull', '-R', self.local] + jobs, 1)
+        doc = {'params': {'width': opts.width, 'depth': opts.depth,
+                          'commits': opts.commits, 'files': opts.files,
+                          'file_size': opts.file_size, 'jobs': opts.jobs,
+                          'repeat': opts.repeat, 'repos': n},
+               'hg': self.hg('version', '-q').strip(),
+               'extension': opts.extension,
+               'time': time.time(),
+               'results': self.results}
+        if opts.output:
+            f = open(opts.output, 'w')
+            json.dump(doc, f, indent=1, sort_keys=True)
+            f.write('\n')
+            f.close()
+        if opts.compare:
+            compare(json.load(open(opts.compare)), doc)
+        if not opts.keep and not opts.dir:
+            shutil.rmtree(self.dir)
+
+def compare(old, new):
+    """Show the wall clock time of each command in old and new."""
+    if old.get('params') != new.get('params'):
+        sys.stdout.write('warning: the runs used different parameters\n')
+    sys.stdout.write('\n%-12s %10s %10s %8s\n' % ('command', 'old', 'new',
+                                                'change'))
+    for name in sorted(new['results']):
+        n = new['results'][name]['wall']
+        o = old['results'].get(name, {}).get('wall')
+        if o:
+            sys.stdout.write('%-12s %9.3fs %9.3fs %+7.1f%%\n' %
+                             (name, o, n, (n - o) * 100 / o))
+        else:
+            sys.stdout.write('%-12s %10s %9.3fs\n' % (name, '-', n))
+
+def main(argv):
+    here = os.path.dirname(os.path.abspath(__file__))
+    p = optparse.OptionParser(usage='%prog [options]')
+    p.add_option('--hg', default=os.environ.get('HG', 'hg'),
+                 help='hg executable (default: $HG or hg)')
+    p.add_option('--extension',
+                 default=os.path.join(os.path.dirname(here), 'trees.py'),
+                 help='path to trees.py (default: the one next to tests)')
+    p.add_option('--width', type='int', default=3,
+                 help='subtrees in each repo (default: %default)')
+    p.add_option('--depth', type='int', default=2,
+                 help='levels of subtrees (default: %default)')
+    p.add_option('--commits', type='int', default=50,
+                 help='changesets in each repo (default: %default)')
+    p.add_option('--files', type='int', default=100,
+                 help='files in each working dir (default: %default)')
+    p.add_option('--file-size', type='int', default=1024,
+                 help='bytes in each file (default: %default)')
+    p.add_option('--jobs', type='int', default=0,
+                 help='pass --jobs N to the commands that accept it')
+    p.add_option('--repeat', type='int', default=3,
+                 help='runs of each command; the best is kept '
+                 '(default: %default)')
+    p.add_option('--dir', help='directory for the forests (default: a '
+                 'temporary directory, removed afterwards)')
+    p.add_option('--keep', action='store_true',
+                 help='keep the temporary directory')
+    p.add_option('-o', '--output', help='write the results as JSON to FILE')
+    p.add_option('--compare', metavar='FILE',
+                 help='compare with the JSON results in FILE')
+    p.add_option('-v', '--verbose', action='store_true',
+                 help='show the per-repo breakdown')
+    opts, args = p.parse_args(argv)
+    if args:
+        p.error('unexpected arguments')
+    opts.extension = os.path.abspath(opts.extension)
+    if opts.dir:
+        opts.dir = os.path.abspath(opts.dir)
+    bench(opts).main()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -33,6 +33,10 @@ This requires mercurial w/pushkey support (1.6 and later).
   0: s1 has a space
   1: s2
   2: s3 has a space
+  $ hg tdebugkeys --recursive http://localhost:$HGPORT/
+  0: s1 has a space
+  1: s2
+  2: s3 has a space
 
 Test splitting of --subtrees args and quoting.
 
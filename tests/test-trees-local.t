@@ -1356,3 +1356,1370 @@ tconfig --set --depth with no args should be repeatable
   $ hg -R n3/a/b/c/f tlist --short
   .
   g/h
+
+Test concurrent execution with --jobs; output and exit status should match
+serial execution.
+
+  $ echo change >> r1/s1/x
+  $ echo change >> 'r1/s1/s1.3 with spaces/x'
+  $ hg tstatus -R r1 --jobs 4
+  [$TESTTMP/r1]:
+  
+  [$TESTTMP/r1/s1]:
+  M x
+  
+  [$TESTTMP/r1/s1/s1.1 with spaces]:
+  
+  [$TESTTMP/r1/s1/s1.2]:
+  
+  [$TESTTMP/r1/s1/s1.3 with spaces]:
+  M x
+  
+  [$TESTTMP/r1/s2]:
+  
+  [$TESTTMP/r1/s2/s2.1]:
+  
+  [$TESTTMP/r1/s2/s2.2]:
+  
+  [$TESTTMP/r1/s2/s2.2/s2.2.1]:
+  $ for cmd in tstatus 'tlog -l 1' tparents 'theads --template {node}'
+  > do
+  >     hg $cmd -R r1 > serial.out 2>&1; echo $? >> serial.out
+  >     hg $cmd -R r1 --jobs 3 > jobs.out 2>&1; echo $? >> jobs.out
+  >     hg $cmd -R r1 --config trees.jobs=5 > config.out 2>&1
+  >     echo $? >> config.out
+  >     cmp serial.out jobs.out && cmp serial.out config.out
+  > done
+  $ hg tstatus -R r1 --jobs 2 --subtrees s1 -q
+  M x
+  M x
+  $ hg tstatus -R r1 --jobs 2 --subtrees 's2 no-such-repo'
+  [$TESTTMP/r1]:
+  
+  [$TESTTMP/r1/s2]:
+  
+  [$TESTTMP/r1/s2/s2.1]:
+  
+  [$TESTTMP/r1/s2/s2.2]:
+  
+  [$TESTTMP/r1/s2/s2.2/s2.2.1]:
+  
+  abort: repository $TESTTMP/r1/no-such-repo not found!
+  [255]
+  $ hg --cwd r1/s1 revert --no-backup x
+  $ hg --cwd 'r1/s1/s1.3 with spaces' revert --no-backup x
+
+Network commands accept --jobs too, optionally limited per remote host.
+
+  $ for cmd in 'tincoming r1' 'toutgoing r1' "tincoming file:$TESTTMP/r1"
+  > do
+  >     hg $cmd -R r2 > serial.out 2>&1; echo $? >> serial.out
+  >     hg $cmd -R r2 --jobs 3 > jobs.out 2>&1; echo $? >> jobs.out
+  >     hg $cmd -R r2 --jobs 3 --config trees.hostjobs=1 > host.out 2>&1
+  >     echo $? >> host.out
+  >     cmp serial.out jobs.out && cmp serial.out host.out
+  > done
+  $ hg tpull -R r2 --jobs 2 -q r1
+
+Clone concurrently with --jobs.  Siblings finish in any order, so only the
+resulting trees are compared.
+
+  $ hg tclone -q --jobs 3 r1 rjobs
+  $ hg tlist -R rjobs --short
+  .
+  s1
+  s1/s1.1 with spaces
+  s1/s1.2
+  s1/s1.3 with spaces
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+  $ hg tconfig -R rjobs/s1
+  s1.1 with spaces
+  s1.2
+  s1.3 with spaces
+  $ hg tclone -q --jobs 2 r1 rjobs2 s1 no-such-repo s2
+  failed to clone $TESTTMP/r1/no-such-repo: repository $TESTTMP/r1/no-such-repo not found
+  abort: 1 subtrees could not be cloned
+  [255]
+  $ hg tconfig -R rjobs2
+  s1
+  s2
+  $ hg tlist -R rjobs2 --short
+  .
+  s1
+  s1/s1.1 with spaces
+  s1/s1.2
+  s1/s1.3 with spaces
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+
+The recursively expanded list of repos is cached in the top-level repo.  The
+cache is only written once the files it depends on are at least a second old,
+and is not used after any of them change.
+
+  $ sleep 1
+  $ hg tlist -R r1 > /dev/null
+  $ hg tlist -R r1 --short --debug
+  using cached tree topology
+  .
+  s1
+  s1/s1.1 with spaces
+  s1/s1.2
+  s1/s1.3 with spaces
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+  $ hg tconfig -R r1/s2 --del s2.1
+  $ hg tlist -R r1 --short --debug | grep -v '^listing keys'
+  .
+  s1
+  s1/s1.1 with spaces
+  s1/s1.2
+  s1/s1.3 with spaces
+  s2
+  s2/s2.2
+  s2/s2.2/s2.2.1
+  $ hg tconfig -R r1/s2 --set --walk
+  $ hg tlist -R r1 --short --subtrees s2 --debug | grep -v '^listing keys'
+  .
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+
+Walking the file system with limits.
+
+  $ hg init w
+  $ mkdir -p w/a/b w/build/x w/out
+  $ hg init w/a/b/r3
+  $ hg init w/build/x/r4
+  $ hg init w/out/r5
+  $ hg init w/r1
+  $ hg init w/r1/r2
+  $ ln -s ../r1 w/a/link
+  $ echo 'out' > w/.hgignore
+  $ hg tlist -R w --walk --short
+  .
+  a/b/r3
+  build/x/r4
+  out/r5
+  r1
+  r1/r2
+  $ hg tlist -R w --walk --short --config trees.walkthreads=3
+  .
+  a/b/r3
+  build/x/r4
+  out/r5
+  r1
+  r1/r2
+  $ hg tlist -R w --walk --short --maxdepth 1
+  .
+  r1
+  $ hg tlist -R w --walk --short --maxdepth 2
+  .
+  out/r5
+  r1
+  r1/r2
+  $ hg tlist -R w --walk --short --config trees.walkskip='build r1/*'
+  .
+  a/b/r3
+  out/r5
+  r1
+  $ hg tlist -R w --walk --short --config trees.walkignored=False
+  .
+  a/b/r3
+  build/x/r4
+  r1
+  r1/r2
+  $ hg tconfig -R w --set --walk --maxdepth 2
+  $ hg tlist -R w --short
+  .
+  out/r5
+  r1
+  r1/r2
+
+tcommand --jobs shows the output of each repo in tree order.
+
+  $ hg tcommand -R r1 -- sh -c 'pwd; echo err >&2' > serial.out 2>&1
+  $ hg tcommand -R r1 --jobs 3 -- sh -c 'pwd; echo err >&2' > jobs.out 2>&1
+  $ cmp serial.out jobs.out
+  $ hg tcommand -R r1 --stop --jobs 3 -- sh -c 'pwd; test "`basename "$PWD"`" != s1.2'
+  [$TESTTMP/r1]:
+  $TESTTMP/r1
+  
+  [$TESTTMP/r1/s1]:
+  $TESTTMP/r1/s1
+  
+  [$TESTTMP/r1/s1/s1.1 with spaces]:
+  $TESTTMP/r1/s1/s1.1 with spaces
+  
+  [$TESTTMP/r1/s1/s1.2]:
+  $TESTTMP/r1/s1/s1.2
+  [1]
+
+With --interleave, each line of output is prefixed with the path of its repo
+and shown as soon as the repo is done.
+
+  $ hg tcommand -R r1 --interleave -- sh -c 'pwd; printf "no newline"'
+  .: $TESTTMP/r1
+  .: no newline
+  s1: $TESTTMP/r1/s1
+  s1: no newline
+  s1/s1.1 with spaces: $TESTTMP/r1/s1/s1.1 with spaces
+  s1/s1.1 with spaces: no newline
+  s1/s1.2: $TESTTMP/r1/s1/s1.2
+  s1/s1.2: no newline
+  s1/s1.3 with spaces: $TESTTMP/r1/s1/s1.3 with spaces
+  s1/s1.3 with spaces: no newline
+  s2: $TESTTMP/r1/s2
+  s2: no newline
+  s2/s2.1: $TESTTMP/r1/s2/s2.1
+  s2/s2.1: no newline
+  s2/s2.2: $TESTTMP/r1/s2/s2.2
+  s2/s2.2: no newline
+  s2/s2.2/s2.2.1: $TESTTMP/r1/s2/s2.2/s2.2.1
+  s2/s2.2/s2.2.1: no newline
+  $ hg tstatus -R r1 -A --jobs 3 --config trees.interleave=True | sort > interleave.out
+  $ hg tstatus -R r1 -A | grep -v '^\[' | grep . | sort > serial.out
+  $ sed 's/^[^:]*: //' interleave.out | sort | cmp - serial.out
+  $ hg tincoming -R r1 --jobs 3 --interleave "file:$TESTTMP/r1" | sort
+  .: comparing with file://$TESTTMP/r1
+  .: no changes found
+  .: searching for changes
+  s1/s1.1 with spaces: comparing with file://$TESTTMP/r1/s1/s1.1%20with%20spaces
+  s1/s1.1 with spaces: no changes found
+  s1/s1.1 with spaces: searching for changes
+  s1/s1.2: comparing with file://$TESTTMP/r1/s1/s1.2
+  s1/s1.2: no changes found
+  s1/s1.2: searching for changes
+  s1/s1.3 with spaces: comparing with file://$TESTTMP/r1/s1/s1.3%20with%20spaces
+  s1/s1.3 with spaces: no changes found
+  s1/s1.3 with spaces: searching for changes
+  s1: comparing with file://$TESTTMP/r1/s1
+  s1: no changes found
+  s1: searching for changes
+  s2/s2.1: comparing with file://$TESTTMP/r1/s2/s2.1
+  s2/s2.1: no changes found
+  s2/s2.1: searching for changes
+  s2/s2.2/s2.2.1: comparing with file://$TESTTMP/r1/s2/s2.2/s2.2.1
+  s2/s2.2/s2.2.1: no changes found
+  s2/s2.2/s2.2.1: searching for changes
+  s2/s2.2: comparing with file://$TESTTMP/r1/s2/s2.2
+  s2/s2.2: no changes found
+  s2/s2.2: searching for changes
+  s2: comparing with file://$TESTTMP/r1/s2
+  s2: no changes found
+  s2: searching for changes
+
+-Tjson writes one JSON object for the whole tree.
+
+  $ echo new > r1/s1/new.txt
+  $ hg tstatus -R r1 -Tjson > serial.json
+  $ hg tstatus -R r1 -Tjson --jobs 3 > jobs.json
+  $ cmp serial.json jobs.json
+  $ cat > showjson.py <<EOF2
+  > import json, sys
+  > d = json.load(open(sys.argv[1]))
+  > for k in sorted(d):
+  >     r = d[k]
+  >     print '%s: %s unknown=%d modified=%d parents=%d heads=%d %s' % (
+  >         k, r['branch'], r['unknown'], r['modified'], len(r['parents']),
+  >         len(r['heads']), r['tip'] == r['parents'][0])
+  > EOF2
+  $ $PYTHON showjson.py serial.json
+  .: default unknown=0 modified=0 parents=1 heads=1 True
+  s1: default unknown=1 modified=0 parents=1 heads=1 True
+  s1/s1.1 with spaces: default unknown=0 modified=0 parents=1 heads=1 True
+  s1/s1.2: default unknown=0 modified=0 parents=1 heads=1 True
+  s1/s1.3 with spaces: default unknown=0 modified=0 parents=1 heads=1 True
+  s2: default unknown=0 modified=0 parents=1 heads=1 False
+  s2/s2.1: default unknown=0 modified=0 parents=1 heads=1 True
+  s2/s2.2: default unknown=0 modified=0 parents=1 heads=1 False
+  s2/s2.2/s2.2.1: default unknown=0 modified=0 parents=1 heads=1 False
+  $ hg tsummary -R r1 -Tjson | cmp - serial.json
+  $ hg theads -R r1 -Tjson --subtrees s1 | $PYTHON -c 'import json, sys; print sorted(json.load(sys.stdin))'
+  [u'.', u's1', u's1/s1.1 with spaces', u's1/s1.2', u's1/s1.3 with spaces']
+  $ hg theads -R r1 -Tjson default
+  abort: cannot use -Tjson with BRANCHREVS
+  [255]
+  $ hg init noheads
+  $ hg theads -R noheads -Tjson
+  {
+   ".": {"added": 0, "branch": "default", *} (glob)
+  }
+  [1]
+  $ rm -r noheads
+
+File arguments only count in the repos that own them.
+
+  $ cd r1
+  $ hg tstatus -Tjson s1/new.txt s2 > ../files.json
+  $ hg tstatus -Tjson s1/new.txt s2 --jobs 3 | cmp - ../files.json
+  $ cd ..
+  $ $PYTHON showjson.py files.json | grep -v 's1/\|s2/'
+  .: default unknown=0 modified=0 parents=1 heads=1 True
+  s1: default unknown=1 modified=0 parents=1 heads=1 True
+  s2: default unknown=0 modified=0 parents=1 heads=1 False
+  $ rm r1/s1/new.txt files.json
+
+tdirty reports through its exit status whether any repo has changes.
+
+  $ hg tdirty -R r1
+  [1]
+  $ hg tdirty -R r1 --jobs 3
+  [1]
+  $ echo unknown > r1/s2/unknown.txt
+  $ hg tdirty -R r1
+  [1]
+  $ echo change >> r1/s2/s2.1/x
+  $ hg tdirty -R r1 -v
+  $TESTTMP/r1/s2/s2.1 has uncommitted changes
+  $ hg tdirty -R r1 --jobs 3 -v
+  $TESTTMP/r1/s2/s2.1 has uncommitted changes
+  $ hg tdirty -R r1 --subtrees s1
+  [1]
+  $ hg --cwd r1/s2/s2.1 revert --no-backup x
+  $ hg --cwd r1/s1 rm x
+  $ hg tdirty -R r1 --jobs 2
+  $ hg --cwd r1/s1 revert x
+  $ rm r1/s2/unknown.txt
+  $ hg tdirty -R r1 --jobs 2
+  [1]
+
+Commands can be run through a tserve server with tclient.py.
+
+  $ hg tserve -R r1 --socket "$TESTTMP/t.sock" --daemon --pid-file tserve.pid
+  listening on $TESTTMP/t.sock
+  $ cat tserve.pid >> $DAEMON_PIDS
+  $ tclient() {
+  >     $PYTHON "$TESTDIR/../tclient.py" --socket "$TESTTMP/t.sock" "$@"
+  > }
+  $ tclient tstatus -R r1 -A > client.out
+  $ hg tstatus -R r1 -A | cmp - client.out
+  $ tclient tdirty -R r1
+  [1]
+  $ echo change >> r1/s2/s2.1/x
+  $ cd r1/s2
+  $ tclient tstatus
+  [$TESTTMP/r1/s2]:
+  
+  [$TESTTMP/r1/s2/s2.1]:
+  M x
+  
+  [$TESTTMP/r1/s2/s2.2]:
+  
+  [$TESTTMP/r1/s2/s2.2/s2.2.1]:
+  $ tclient tdirty -v
+  $TESTTMP/r1/s2/s2.1 has uncommitted changes
+  $ tclient tcommand --subtrees s2.1 -- sh -c 'pwd; echo err >&2' 2>tclient.err
+  [$TESTTMP/r1/s2]:
+  $TESTTMP/r1/s2
+  
+  [$TESTTMP/r1/s2/s2.1]:
+  $TESTTMP/r1/s2/s2.1
+  $ cat tclient.err
+  err
+  err
+  $ rm tclient.err
+  $ tclient --config ui.quiet=True tstatus --subtrees s2.1
+  M x
+  $ tclient tstatus --subtrees no-such-repo
+  [$TESTTMP/r1/s2]:
+  
+  abort: repository $TESTTMP/r1/s2/no-such-repo not found!
+  [255]
+  $ hg --cwd s2.1 revert --no-backup x
+  $ tclient tdirty
+  [1]
+
+A repo kept open by the server is reused only if the command has the same
+settings; e.g., the ignore file given with --config applies to the dirstate.
+
+  $ echo junk > s2.1/junk
+  $ tclient tstatus -q --subtrees s2.1 -u
+  ? junk
+  $ echo junk > "$TESTTMP/ignore"
+  $ tclient --config ui.ignore="$TESTTMP/ignore" tstatus -q --subtrees s2.1 -u
+  $ tclient tstatus -q --subtrees s2.1 -u
+  ? junk
+  $ rm s2.1/junk "$TESTTMP/ignore"
+
+The command gets the environment of the client, and reads its standard input.
+
+  $ FOO=bar tclient tcommand --subtrees s2.1 -- sh -c 'echo $FOO'
+  [$TESTTMP/r1/s2]:
+  bar
+  
+  [$TESTTMP/r1/s2/s2.1]:
+  bar
+  $ echo more >> s2.1/x
+  $ printf 'message\nfrom stdin\n' | HGUSER=someone tclient commit -R s2.1 -l -
+  $ hg -R s2.1 log -r tip -T '{author}: {desc}\n'
+  someone: message
+  from stdin
+  $ hg -R s2.1 strip -q --config extensions.strip= --keep tip
+  $ hg --cwd s2.1 revert --no-backup x
+  $ cd ../..
+
+Only the user running the server can connect.
+
+  $ $PYTHON -c 'import os, stat; print oct(stat.S_IMODE(os.stat("t.sock").st_mode))'
+  0600
+
+Without a server, tclient.py runs hg.
+
+  $ $PYTHON "$TESTDIR/../tclient.py" --socket "$TESTTMP/no.sock" tlist -R r1 --short --subtrees s1
+  .
+  s1
+  s1/s1.1 with spaces
+  s1/s1.2
+  s1/s1.3 with spaces
+  $ kill `cat tserve.pid`
+  $ sleep 1
+  $ test -e "$TESTTMP/t.sock"
+  [1]
+
+--trees-profile shows the time spent on each repo, slowest first, on stderr.
+
+  $ hg -R r1 tstatus --subtrees s1 --trees-profile 2>profile >/dev/null
+  $ head -1 profile
+  repo +open +config +command +total +cpu (re)
+  $ sed 1d profile | sort
+  . +[0-9. ]+ (re)
+  s1 +[0-9. ]+ (re)
+  s1/s1.1 with spaces +[0-9. ]+ (re)
+  s1/s1.2 +[0-9. ]+ (re)
+  s1/s1.3 with spaces +[0-9. ]+ (re)
+  total +[0-9. ]+ (re)
+  $ hg -R r1 tstatus --subtrees s1 --trees-profile --jobs 3 2>profile >/dev/null
+  $ sed 1d profile | sort
+  . +[0-9. ]+ (re)
+  s1 +[0-9. ]+ (re)
+  s1/s1.1 with spaces +[0-9. ]+ (re)
+  s1/s1.2 +[0-9. ]+ (re)
+  s1/s1.3 with spaces +[0-9. ]+ (re)
+  total +[0-9. ]+ (re)
+  $ hg -R r1 tcommand --subtrees s1 --trees-profile --trees-profile-dir prof \
+  >   -- true >/dev/null 2>&1
+  $ ls prof
+  root.command.prof
+  s1.command.prof
+  s1_s1.1 with spaces.command.prof
+  s1_s1.2.command.prof
+  s1_s1.3 with spaces.command.prof
+  $ $PYTHON -c 'import pstats, sys; pstats.Stats(sys.argv[1])' prof/s1.command.prof
+  $ rm -r prof profile
+
+The profiling options are not passed on to the commands run in each repo.
+
+  $ $PYTHON -c 'import sys; sys.path.insert(0, sys.argv[1]); import trees
+  > print(sorted(trees._cmdopts({"trees_profile": True, "jobs": 2,
+  >     "trees_profile_dir": "d", "subtrees": [], "tns": "", "rev": []})))
+  > ' "$TESTDIR/.."
+  ['rev']
+
+Commands called with the wrong arguments are still reported as such.
+
+  $ hg -R r1 tpaths a b --trees-profile 2>&1 | head -1
+  hg tpaths: invalid arguments
+
+With [trees] telemetry set, a JSON record for each repo is appended to a log.
+
+  $ cat > showlog.py <<'PYEOF'
+  > import json, sys
+  > for line in open(sys.argv[1]):
+  >     d = json.loads(line)
+  >     print('%s %s rc=%s %s' % (d['command'], d['path'], d['rc'],
+  >                               ' '.join(sorted(d['phases']))))
+  > PYEOF
+  $ hg -R r1 tstatus --subtrees s1 --config trees.telemetry=log.jsonl -q
+  $ hg -R r1 tcommand --subtrees s1 --config trees.telemetry=log.jsonl \
+  >   -- sh -c 'test -d s1.2' >/dev/null
+  [4]
+  $ $PYTHON showlog.py log.jsonl
+  tstatus . rc=0 command config
+  tstatus s1 rc=0 command config open
+  tstatus s1/s1.1 with spaces rc=0 command config open
+  tstatus s1/s1.2 rc=0 command config open
+  tstatus s1/s1.3 with spaces rc=0 command config open
+  tcommand . rc=1 command config
+  tcommand s1 rc=0 command config open
+  tcommand s1/s1.1 with spaces rc=1 command config open
+  tcommand s1/s1.2 rc=1 command config open
+  tcommand s1/s1.3 with spaces rc=1 command config open
+  $ hg -R r1 tstatus --subtrees s1 --config trees.telemetry=no-such-dir/log -q
+  cannot write telemetry to no-such-dir/log: No such file or directory
+  $ rm log.jsonl showlog.py
+
+The repos on an ssh:// host share one ssh connection, through a master started
+before the first repo and closed at the end.  This ssh logs how it is called
+and runs the remote command locally.
+
+  $ mkdir bin
+  $ cat > bin/ssh <<'PYEOF'
+  > #!/usr/bin/env python
+  > import os, sys
+  > args = sys.argv[1:]
+  > opts, rest = [], []
+  > while args:
+  >     a = args.pop(0)
+  >     if a in ('-o', '-p', '-O'):
+  >         opts.append((a, args.pop(0)))
+  >     elif a.startswith('-'):
+  >         opts.append((a, None))
+  >     else:
+  >         rest.append(a)
+  > names = ' '.join([v.split('=')[0] for o, v in opts if o == '-o'])
+  > log = open(os.path.join(os.environ['TESTTMP'], 'ssh.log'), 'a')
+  > if ('-O', 'exit') in opts:
+  >     log.write('exit %s\n' % rest[0])
+  > elif ('-N', None) in opts:
+  >     log.write('master %s %s\n' % (rest[0], names))
+  > else:
+  >     log.write('%s %s %s\n' % (rest[0], names, rest[1]))
+  >     log.close()
+  >     os.chdir(os.environ['TESTTMP'])
+  >     sys.exit(os.system(rest[1]) and 1)
+  > PYEOF
+  $ chmod +x bin/ssh
+  $ OLDPATH="$PATH"
+  $ PATH="$TESTTMP/bin:$PATH"
+  $ hg tclone -q ssh://user@dummy/r1 sshc s2
+  $ cat ssh.log
+  master user@dummy ControlPath ControlMaster ControlPersist
+  user@dummy ControlPath hg -R r1 serve --stdio
+  user@dummy ControlPath hg -R r1/s2 serve --stdio
+  user@dummy ControlPath hg -R r1/s2/s2.1 serve --stdio
+  user@dummy ControlPath hg -R r1/s2/s2.2 serve --stdio
+  user@dummy ControlPath hg -R r1/s2/s2.2/s2.2.1 serve --stdio
+  exit user@dummy
+  $ rm ssh.log
+  $ hg -R sshc tincoming -q --jobs 2
+  [1]
+  $ sort ssh.log
+  exit user@dummy
+  master user@dummy ControlPath ControlMaster ControlPersist
+  user@dummy ControlPath hg -R r1 serve --stdio
+  user@dummy ControlPath hg -R r1/s2 serve --stdio
+  user@dummy ControlPath hg -R r1/s2/s2.1 serve --stdio
+  user@dummy ControlPath hg -R r1/s2/s2.2 serve --stdio
+  user@dummy ControlPath hg -R r1/s2/s2.2/s2.2.1 serve --stdio
+  $ rm ssh.log
+
+A user or host that is not a plain name is refused before ssh is run.
+
+  $ hg tclone -q 'ssh://x;touch${IFS}PWNED;/r1' bad
+  abort: potentially unsafe url: 'ssh://x;touch${IFS}PWNED;/r1'
+  [255]
+  $ hg tclone -q ssh://-oProxyCommand=touch%20PWNED/r1 bad
+  abort: potentially unsafe url: 'ssh://-oProxyCommand=touch%20PWNED/r1'
+  [255]
+  $ ls PWNED bad ssh.log
+  ls: *PWNED*: No such file or directory (glob)
+  ls: *bad*: No such file or directory (glob)
+  ls: *ssh.log*: No such file or directory (glob)
+  [2]
+
+Connections are not shared if disabled, or if --ssh is given.
+
+  $ hg -R sshc toutgoing -q --config trees.sshmux=False --subtrees s2
+  [1]
+  $ hg -R sshc toutgoing -q -e 'ssh -C' --subtrees s2
+  [1]
+  $ cat ssh.log
+  user@dummy  hg -R r1 serve --stdio
+  user@dummy  hg -R r1/s2 serve --stdio
+  user@dummy  hg -R r1/s2/s2.1 serve --stdio
+  user@dummy  hg -R r1/s2/s2.2 serve --stdio
+  user@dummy  hg -R r1/s2/s2.2/s2.2.1 serve --stdio
+  user@dummy  hg -R r1 serve --stdio
+  user@dummy  hg -R r1/s2 serve --stdio
+  user@dummy  hg -R r1/s2/s2.1 serve --stdio
+  user@dummy  hg -R r1/s2/s2.2 serve --stdio
+  user@dummy  hg -R r1/s2/s2.2/s2.2.1 serve --stdio
+  $ rm ssh.log
+
+With [trees] pullcache, a pull that is not skipped reuses the connection that
+checked the remote state, which asks for the heads, bookmarks and phases in a
+single batch.
+
+  $ echo more >> r1/s2/s2.1/x
+  $ hg -R r1/s2/s2.1 ci -qm more
+  $ hg -R sshc/s2/s2.1 tpull -q --config trees.pullcache=True \
+  >   --config trees.sshmux=False --debug | grep '^sending'
+  sending hello command
+  sending between command
+  sending protocaps command (?)
+  sending batch command
+  sending batch command
+  sending getbundle command
+  $ cat ssh.log
+  user@dummy  hg -R r1/s2/s2.1 serve --stdio
+  $ hg -R sshc/s2/s2.1 log -r tip -T '{rev}\n'
+  1
+  $ hg -R r1/s2/s2.1 strip -q --config extensions.strip= tip
+  $ rm ssh.log
+
+tclone and tdebugkeys --recursive learn the whole tree with a single listkeys
+request, if the server supports it.
+
+  $ hg tdebugkeys -r ssh://user@dummy/r1
+  0: s1
+  1: s1/s1.1 with spaces
+  2: s1/s1.2
+  3: s1/s1.3 with spaces
+  4: s2
+  5: s2/s2.1
+  6: s2/s2.2
+  7: s2/s2.2/s2.2.1
+  $ hg tclone --debug ssh://user@dummy/r1 sshd s2 | grep '^received listkey'
+  received listkey for "trees-recursive": * bytes (glob)
+  $ hg tlist -R sshd --short
+  .
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+  $ rm -r sshd
+
+Otherwise, the configuration of each repo is read in turn.  This server acts as
+an older version of the extension.
+
+  $ cat > norecursive.py <<'PYEOF'
+  > from mercurial import pushkey
+  > def reposetup(ui, repo):
+  >     for ns in list(pushkey._namespaces):
+  >         if ns.endswith('-recursive'):
+  >             del pushkey._namespaces[ns]
+  > PYEOF
+  $ { cat $HGRCPATH; echo '[extensions]'
+  >   echo "norecursive = $TESTTMP/norecursive.py"; } > old.hgrc
+  $ printf '#!/bin/sh\nHGRCPATH="%s" exec hg "$@"\n' "$TESTTMP/old.hgrc" > bin/hg-old
+  $ chmod +x bin/hg-old
+  $ hg tdebugkeys -r ssh://user@dummy/r1 --config ui.remotecmd=hg-old
+  0: s1
+  1: s1/s1.1 with spaces
+  2: s1/s1.2
+  3: s1/s1.3 with spaces
+  4: s2
+  5: s2/s2.1
+  6: s2/s2.2
+  7: s2/s2.2/s2.2.1
+  $ hg tclone --debug --remotecmd hg-old --jobs 2 ssh://user@dummy/r1 sshd s2 |
+  > grep '^received listkey' | sort
+  received listkey for "trees": 0 bytes
+  received listkey for "trees": 0 bytes
+  received listkey for "trees": 0 bytes
+  received listkey for "trees": 0 bytes
+  received listkey for "trees": 0 bytes
+  received listkey for "trees": 0 bytes
+  received listkey for "trees": 27 bytes
+  received listkey for "trees-recursive": 0 bytes
+  $ hg tlist -R sshd --short
+  .
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+  $ PATH="$OLDPATH"
+  $ rm -r bin ssh.log sshc sshd norecursive.py old.hgrc
+
+The server does not list subtrees outside the repo that configures them, and
+the client does not apply the configuration of one source to a subtree cloned
+from another.
+
+  $ hg init ev
+  $ echo ../r1 > ev/.hg/trees
+  $ hg debugpushkey ev trees-recursive
+  $ hg debugpushkey ev trees
+  0	../r1
+  $ rm -r ev
+  $ hg init o
+  $ hg init o/s1
+  $ hg init o/s1/z
+  $ hg -R o/s1 tconfig -q --set z
+  $ hg tclone -q r1 mx s2 "file://$TESTTMP/o" s1
+  $ hg tlist -R mx --short
+  .
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+  s1
+  s1/z
+  $ rm -r o mx
+
+tclone --share-pool creates each repo as a share of a store kept in the pool;
+later clones only fetch what the pooled store is missing.
+
+  $ hg tclone -q --share-pool pool r1 shared s2
+  $ ls pool | wc -l | tr -d ' '
+  5
+  $ sed "s|$TESTTMP/||" shared/s2/s2.1/.hg/sharedpath; echo
+  pool/*/.hg (glob)
+  $ hg -R shared/s2/s2.1 paths default
+  $TESTTMP/r1/s2/s2.1
+  $ hg tclone --share-pool pool r1 shared2 s2 | grep sharing
+  (sharing from existing pooled repository *) (glob)
+  (sharing from existing pooled repository *) (glob)
+  (sharing from existing pooled repository *) (glob)
+  (sharing from existing pooled repository *) (glob)
+  (sharing from existing pooled repository *) (glob)
+  $ hg tclone --share-pool pool --reference shared r1 x
+  abort: cannot use --share-pool with --reference
+  [255]
+  $ rm -r pool shared shared2
+
+tclone --reference copies each repo from the same path in a local tree, then
+pulls the missing changesets from the source.  Repos missing from the reference
+tree are cloned from the source.
+
+  $ hg tclone -q r1 src s2
+  $ hg tclone -q src ref
+  $ rm -r ref/s2/s2.2
+  $ echo more >> src/s2/s2.1/x
+  $ hg -R src/s2/s2.1 ci -qm more
+  $ hg tclone --reference ref src dst | grep -v '^updating\|files updated'
+  cloning src
+  copying from reference $TESTTMP/ref
+  pulling from src
+  searching for changes
+  no changes found
+  created $TESTTMP/dst
+  
+  cloning $TESTTMP/src/s2
+  copying from reference $TESTTMP/ref/s2
+  pulling from $TESTTMP/src/s2
+  searching for changes
+  no changes found
+  created $TESTTMP/dst/s2
+  
+  cloning $TESTTMP/src/s2/s2.1
+  copying from reference $TESTTMP/ref/s2/s2.1
+  pulling from $TESTTMP/src/s2/s2.1
+  searching for changes
+  adding changesets
+  adding manifests
+  adding file changes
+  added 1 changesets with 1 changes to 1 files
+  new changesets * (glob) (?)
+  created $TESTTMP/dst/s2/s2.1
+  
+  cloning $TESTTMP/src/s2/s2.2
+  created $TESTTMP/dst/s2/s2.2
+  
+  cloning $TESTTMP/src/s2/s2.2/s2.2.1
+  created $TESTTMP/dst/s2/s2.2/s2.2.1
+  $ hg -R dst/s2/s2.1 paths default
+  $TESTTMP/src/s2/s2.1
+  $ hg -R dst/s2/s2.1 id -n
+  1
+  $ $PYTHON -c 'import os; print(os.stat("dst/s2/.hg/store/00changelog.i").st_nlink > 1)'
+  True
+  $ rm -r dst
+
+Changesets of the reference that the source does not have are not kept.
+
+  $ echo local >> ref/s2/x
+  $ hg -R ref/s2 ci -qm local
+  $ hg tclone --reference ref src dst s2 | grep 'removing\|^created'
+  created $TESTTMP/dst
+  removing 1 changesets not in the source
+  created $TESTTMP/dst/s2
+  created $TESTTMP/dst/s2/s2.1
+  created $TESTTMP/dst/s2/s2.2
+  created $TESTTMP/dst/s2/s2.2/s2.2.1
+  $ hg -R dst/s2 log -r 'desc(local)'
+  $ hg -R dst/s2 id -n
+  3
+  $ rm -r dst
+  $ hg tclone --reference ref -u nosuchrev src dst
+  cloning src
+  copying from reference $TESTTMP/ref
+  pulling from src
+  searching for changes
+  no changes found
+  abort: unknown revision 'nosuchrev'
+  [255]
+  $ rm -r src ref dst
+
+With [trees] pullcache, tpull and tincoming skip the repos whose remote heads,
+bookmarks and phases did not change since the last time.
+
+  $ hg tclone -q r1 pc s2
+  $ cat >> pc/.hg/hgrc <<EOF2
+  > [trees]
+  > pullcache = True
+  > EOF2
+  $ hg -R pc tpull > /dev/null
+  $ hg -R pc tincoming
+  [$TESTTMP/pc]:
+  comparing with $TESTTMP/r1
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2]:
+  comparing with $TESTTMP/r1/s2
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2/s2.1]:
+  comparing with $TESTTMP/r1/s2/s2.1
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2/s2.2]:
+  comparing with $TESTTMP/r1/s2/s2.2
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2/s2.2/s2.2.1]:
+  comparing with $TESTTMP/r1/s2/s2.2/s2.2.1
+  no changes found (remote heads unchanged)
+  [1]
+  $ echo more >> r1/s2/s2.1/x
+  $ hg -R r1/s2/s2.1 ci -qm more
+  $ hg -R r1/s2/s2.2 bookmark -q mark
+  $ hg -R pc tpull
+  [$TESTTMP/pc]:
+  pulling from $TESTTMP/r1
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2]:
+  pulling from $TESTTMP/r1/s2
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2/s2.1]:
+  pulling from $TESTTMP/r1/s2/s2.1
+  searching for changes
+  adding changesets
+  adding manifests
+  adding file changes
+  added 1 changesets with 1 changes to 1 files
+  new changesets * (glob) (?)
+  (run 'hg update' to get a working copy)
+  
+  [$TESTTMP/pc/s2/s2.2]:
+  pulling from $TESTTMP/r1/s2/s2.2
+  searching for changes
+  no changes found
+  adding remote bookmark mark
+  
+  [$TESTTMP/pc/s2/s2.2/s2.2.1]:
+  pulling from $TESTTMP/r1/s2/s2.2/s2.2.1
+  no changes found (remote heads unchanged)
+  $ hg -R pc tpull --jobs 2
+  [$TESTTMP/pc]:
+  pulling from $TESTTMP/r1
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2]:
+  pulling from $TESTTMP/r1/s2
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2/s2.1]:
+  pulling from $TESTTMP/r1/s2/s2.1
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2/s2.2]:
+  pulling from $TESTTMP/r1/s2/s2.2
+  no changes found (remote heads unchanged)
+  
+  [$TESTTMP/pc/s2/s2.2/s2.2.1]:
+  pulling from $TESTTMP/r1/s2/s2.2/s2.2.1
+  no changes found (remote heads unchanged)
+  $ hg -R pc/s2/s2.1 log -r tip -T '{rev}\n'
+  1
+  $ hg -R pc/s2/s2.2 bookmarks
+     mark                      *:* (glob)
+  $ hg -R r1/s2/s2.1 strip -q --config extensions.strip= tip
+  $ hg -R r1/s2/s2.2 bookmark -q -d mark
+  $ rm -r pc
+
+tclone keeps a journal until the whole tree is cloned; an interrupted clone
+can be finished with --resume.
+
+  $ printf '[hooks]\npreoutgoing.fail = false\n' >> r1/s2/s2.2/.hg/hgrc
+  $ hg tclone -q --pull r1 rc s2
+  abort: preoutgoing.fail hook exited with status 1
+  [255]
+  $ cat rc/.hg/trees.clonejournal
+  done .
+  plan s2
+  start s2
+  done s2
+  plan s2/s2.1
+  plan s2/s2.2
+  plan s2/s2.2/s2.2.1
+  start s2/s2.1
+  done s2/s2.1
+  start s2/s2.2
+  $ test -f rc/s2/.hg/trees
+  [1]
+  $ mkdir -p rc/s2/s2.2/.hg
+  $ hg tclone r1 rc s2
+  abort: rc has an interrupted clone (use --resume to finish it)
+  [255]
+  $ rm r1/s2/s2.2/.hg/hgrc
+  $ hg tclone --resume r1 rc s2
+  resuming clone of r1 (3 of 5 repos cloned)
+  skipping r1 (destination exists)
+  
+  skipping $TESTTMP/r1/s2 (destination exists)
+  
+  skipping $TESTTMP/r1/s2/s2.1 (destination exists)
+  
+  removing partial clone $TESTTMP/rc/s2/s2.2
+  cloning $TESTTMP/r1/s2/s2.2
+  updating to branch default
+  3 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  created $TESTTMP/rc/s2/s2.2
+  
+  cloning $TESTTMP/r1/s2/s2.2/s2.2.1
+  updating to branch default
+  3 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  created $TESTTMP/rc/s2/s2.2/s2.2.1
+  $ test -f rc/.hg/trees.clonejournal
+  [1]
+  $ hg -R rc tlist --short
+  .
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+  $ cat rc/s2/.hg/trees
+  s2.1
+  s2.2
+  s2.2/s2.2.1
+
+The same with --jobs.
+
+  $ rm -r rc
+  $ printf '[hooks]\npreoutgoing.fail = false\n' >> r1/s2/s2.2/.hg/hgrc
+  $ hg tclone -q --jobs 2 --pull r1 rc s2
+  failed to clone $TESTTMP/r1/s2/s2.2: preoutgoing.fail hook exited with status 1
+  skipped $TESTTMP/r1/s2/s2.2/s2.2.1 ($TESTTMP/r1/s2/s2.2 could not be cloned)
+  abort: 1 subtrees could not be cloned
+  [255]
+  $ cat rc/s2/.hg/trees
+  s2.1
+  $ mkdir -p rc/s2/s2.2/.hg
+  $ rm r1/s2/s2.2/.hg/hgrc
+  $ hg tclone -q --jobs 2 --resume r1 rc s2
+  $ test -f rc/.hg/trees.clonejournal
+  [1]
+  $ hg -R rc tlist --short
+  .
+  s2
+  s2/s2.1
+  s2/s2.2
+  s2/s2.2/s2.2.1
+
+Repos that already exist are journaled as done, never as started, so resuming
+does not remove them.
+
+  $ echo keep > rc/s2/s2.1/keep
+  $ rm -r rc/s2/s2.2
+  $ printf '[hooks]\npreoutgoing.fail = false\n' >> r1/s2/s2.2/.hg/hgrc
+  $ hg tclone -q --jobs 2 --pull r1 rc s2
+  failed to clone $TESTTMP/r1/s2/s2.2: preoutgoing.fail hook exited with status 1
+  skipped $TESTTMP/r1/s2/s2.2/s2.2.1 ($TESTTMP/r1/s2/s2.2 could not be cloned)
+  abort: 1 subtrees could not be cloned
+  [255]
+  $ grep start rc/.hg/trees.clonejournal
+  start s2/s2.2
+  $ rm r1/s2/s2.2/.hg/hgrc
+  $ hg tclone -q --resume r1 rc s2
+  $ cat rc/s2/s2.1/keep
+  keep
+  $ rm -r rc
+
+tpull -u with --jobs updates each repo as soon as it has been pulled, and lists
+the repos with unresolved files at the end.
+
+  $ hg tclone -q r1 pu s1
+  $ for r in s1 s1/s1.2; do
+  >     echo new >> r1/$r/x
+  >     hg -R r1/$r ci -qm new
+  > done
+  $ echo local >> pu/s1/x
+  $ hg -R pu tpull -u --jobs 3
+  [$TESTTMP/pu]:
+  pulling from $TESTTMP/r1
+  searching for changes
+  no changes found
+  
+  [$TESTTMP/pu/s1]:
+  pulling from $TESTTMP/r1/s1
+  searching for changes
+  adding changesets
+  adding manifests
+  adding file changes
+  added 1 changesets with 1 changes to 1 files
+  new changesets * (glob) (?)
+  merging x
+  0 files updated, 0 files merged, 0 files removed, 1 files unresolved
+  use 'hg resolve' to retry unresolved file merges
+  warning: conflicts while merging x! (edit, then use 'hg resolve --mark')
+  
+  [$TESTTMP/pu/s1/s1.1 with spaces]:
+  pulling from $TESTTMP/r1/s1/s1.1 with spaces
+  searching for changes
+  no changes found
+  
+  [$TESTTMP/pu/s1/s1.2]:
+  pulling from $TESTTMP/r1/s1/s1.2
+  searching for changes
+  adding changesets
+  adding manifests
+  adding file changes
+  added 1 changesets with 1 changes to 1 files
+  new changesets * (glob) (?)
+  1 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  
+  [$TESTTMP/pu/s1/s1.3 with spaces]:
+  pulling from $TESTTMP/r1/s1/s1.3 with spaces
+  searching for changes
+  no changes found
+  
+  repos with unresolved files:
+    s1
+  $ hg -R pu/s1/s1.2 parents -T '{rev}\n'
+  1
+  $ echo newer >> r1/s1/s1.2/x
+  $ hg -R r1/s1/s1.2 ci -qm newer
+  $ hg -R pu tpull -u --jobs 3 --interleave | grep '^s1/s1.2:'
+  s1/s1.2: pulling from $TESTTMP/r1/s1/s1.2
+  s1/s1.2: searching for changes
+  s1/s1.2: adding changesets
+  s1/s1.2: adding manifests
+  s1/s1.2: adding file changes
+  s1/s1.2: added 1 changesets with 1 changes to 1 files
+  s1/s1.2: new changesets * (glob) (?)
+  s1/s1.2: 1 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  $ hg -R r1/s1 strip -q --config extensions.strip= tip
+  $ hg -R r1/s1/s1.2 strip -q --config extensions.strip= 'tip^'
+  $ rm -r pu
+
+The update after the pull goes where pull -u would go, e.g., to the head of the
+branch given with --branch.
+
+  $ hg tclone -q r1 pb s1
+  $ hg -R r1/s1/s1.2 branch -q foo
+  $ echo foo >> r1/s1/s1.2/x
+  $ hg -R r1/s1/s1.2 ci -qm foo
+  $ hg -R pb/s1/s1.2 tpull -q -u -b foo --jobs 2
+  $ hg -R pb/s1/s1.2 parents -T '{branch}\n'
+  foo
+  $ hg -R pb/s1/s1.2 up -q default
+  $ hg -R pb/s1/s1.2 strip -q --config extensions.strip= foo
+  $ hg -R pb/s1/s1.2 pull -q -u -b foo
+  $ hg -R pb/s1/s1.2 parents -T '{branch}\n'
+  foo
+  $ hg -R r1/s1/s1.2 up -q default
+  $ hg -R r1/s1/s1.2 strip -q --config extensions.strip= foo
+  $ rm -r pb
+
+tlog --merged shows the changesets of the whole tree as one log, newest first.
+
+  $ hg init ml
+  $ hg init ml/a
+  $ hg init ml/b
+  $ hg -R ml tconfig -q --set a b
+  $ for c in ".:1" "a:2" "b:3" ".:4" "b:5" "a:6" "a:7" "b:8"; do
+  >     r=${c%:*}; d=${c#*:}
+  >     echo $d >> ml/$r/f
+  >     hg -R ml/$r ci -qA -d "$d 0" -m "c$d"
+  > done
+  $ hg -R ml tlog --merged -T '{rev} {desc}\n'
+  b: 2 c8
+  a: 2 c7
+  a: 1 c6
+  b: 1 c5
+  .: 1 c4
+  b: 0 c3
+  a: 0 c2
+  .: 0 c1
+  $ hg -R ml tlog --merged -l 3 --jobs 2
+  b: changeset:   2:* (glob)
+  b: tag:         tip
+  b: user:        test
+  b: date:        Thu Jan 01 00:00:08 1970 +0000
+  b: summary:     c8
+  b: 
+  a: changeset:   2:* (glob)
+  a: tag:         tip
+  a: user:        test
+  a: date:        Thu Jan 01 00:00:07 1970 +0000
+  a: summary:     c7
+  a: 
+  a: changeset:   1:* (glob)
+  a: user:        test
+  a: date:        Thu Jan 01 00:00:06 1970 +0000
+  a: summary:     c6
+  a: 
+
+The log of each repo is sorted by date first, so an ascending -r range (or
+changesets with older dates on top) does not change the order, and --limit
+keeps the newest changesets.
+
+  $ hg -R ml tlog --merged -r 0:tip -T '{rev} {desc}\n'
+  b: 2 c8
+  a: 2 c7
+  a: 1 c6
+  b: 1 c5
+  .: 1 c4
+  b: 0 c3
+  a: 0 c2
+  .: 0 c1
+  $ hg -R ml tlog --merged -r 0:tip -l 2 -T '{desc}\n'
+  b: c8
+  a: c7
+  $ hg -R ml tlog --merged -r 0:tip -l 2 --jobs 2 -T '{desc}\n'
+  b: c8
+  a: c7
+  $ hg -R ml tlog --merged -k c4 -k c5 -k c9 -T '{desc}\n'
+  b: c5
+  .: c4
+  $ hg -R ml tlog --merged -G
+  abort: cannot use --merged with --graph
+  [255]
+  $ rm -r ml
+
+tsnapshot records the working directory parent of each repo; trestore updates
+the repos that differ back to it.
+
+  $ hg tclone -q r1 sn s1
+  $ echo more >> r1/s1/s1.2/x
+  $ hg -R r1/s1/s1.2 ci -qm more
+  $ hg -R sn tpull -q
+  $ hg -R sn tsnapshot | sed 's/^[0-9a-f]* /NODE /'
+  NODE .
+  NODE s1
+  NODE s1/s1.1 with spaces
+  NODE s1/s1.2
+  NODE s1/s1.3 with spaces
+  $ hg -R sn tsnapshot snap
+  $ hg -R sn/s1/s1.2 up -q tip
+  $ hg -R sn/s1 up -q null
+  $ hg -R sn trestore snap --jobs 2
+  
+  [$TESTTMP/sn/s1]:
+  1 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  
+  [$TESTTMP/sn/s1/s1.2]:
+  1 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  2 repos updated, 3 unchanged
+  $ hg -R sn tsnapshot | cmp - snap
+  $ hg -R sn trestore snap
+  0 repos updated, 5 unchanged
+
+Repos that lack a revision stop the restore before anything is updated.
+
+  $ hg -R sn/s1/s1.2 up -q tip
+  $ hg -R sn/s1 up -q null
+  $ hg -R r1/s1/s1.2 tsnapshot | sed "s|. *$|s1/s1.2|" > snap2
+  $ sed '/s1\/s1.2$/d' snap >> snap2
+  $ echo '0123456789012345678901234567890123456789 s9' >> snap2
+  $ hg -R sn/s1/s1.2 strip -q --config extensions.strip= tip
+  $ hg -R sn trestore snap2
+  abort: unknown revision * in $TESTTMP/sn/s1/s1.2 (glob)
+  [255]
+  $ hg -R sn tpull -q
+  $ hg -R sn trestore snap2
+  s9 is in the snapshot but not in the tree
+  
+  [$TESTTMP/sn/s1]:
+  1 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  
+  [$TESTTMP/sn/s1/s1.2]:
+  1 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  2 repos updated, 3 unchanged
+  $ hg -R sn/s1/s1.2 parents -T '{desc}\n'
+  more
+  $ echo bad > snap3
+  $ hg -R sn trestore snap3
+  abort: snap3: invalid snapshot line: bad
+  [255]
+  $ hg -R r1/s1/s1.2 strip -q --config extensions.strip= tip
+  $ rm -r sn snap snap2 snap3
+
+tdiff --combined shows the diffs of the whole tree as one patch, with the paths
+relative to the root of the tree.
+
+  $ hg init cd
+  $ hg init cd/a
+  $ hg init "cd/a/b c"
+  $ hg -R cd tconfig -q --set a
+  $ hg -R cd/a tconfig -q --set "b c"
+  $ for r in . a "a/b c"; do
+  >     echo 1 > "cd/$r/f"
+  >     echo 1 > "cd/$r/g h"
+  >     hg -R "cd/$r" ci -qA -d "0 0" -m 1
+  >     echo 2 >> "cd/$r/f"
+  > done
+  $ hg -R "cd/a/b c" mv -q "cd/a/b c/g h" "cd/a/b c/i"
+  $ hg -R cd tdiff --combined --nodates
+  diff -r * f (glob)
+  --- a/f
+  +++ b/f
+  @@ -1,1 +1,2 @@
+   1
+  +2
+  diff -r * a/f (glob)
+  --- a/a/f
+  +++ b/a/f
+  @@ -1,1 +1,2 @@
+   1
+  +2
+  diff -r * a/b c/f (glob)
+  --- a/a/b c/f
+  +++ b/a/b c/f
+  @@ -1,1 +1,2 @@
+   1
+  +2
+  diff -r * a/b c/g h (glob)
+  --- a/a/b c/g h	
+  +++ /dev/null
+  @@ -1,1 +0,0 @@
+  -1
+  diff -r * a/b c/i (glob)
+  --- /dev/null
+  +++ b/a/b c/i
+  @@ -0,0 +1,1 @@
+  +1
+  $ hg -R cd tdiff --combined --git --jobs 2 > cd.diff
+  $ cat cd.diff
+  diff --git a/f b/f
+  --- a/f
+  +++ b/f
+  @@ -1,1 +1,2 @@
+   1
+  +2
+  diff --git a/a/f b/a/f
+  --- a/a/f
+  +++ b/a/f
+  @@ -1,1 +1,2 @@
+   1
+  +2
+  diff --git a/a/b c/f b/a/b c/f
+  --- a/a/b c/f
+  +++ b/a/b c/f
+  @@ -1,1 +1,2 @@
+   1
+  +2
+  diff --git a/a/b c/g h b/a/b c/i
+  rename from a/b c/g h
+  rename to a/b c/i
+
+  $ hg -R cd tdiff --combined --stat
+  abort: cannot use --combined with --stat
+  [255]
+  $ rm -r cd cd.diff
+
+File arguments are passed only to the repos that own them, relative to the root
+of each repo; a directory also selects the repos below it.
+
+  $ hg init po
+  $ hg init po/a
+  $ hg init "po/a/b c"
+  $ hg init po/d
+  $ hg -R po tconfig -q --set a d
+  $ hg -R po/a tconfig -q --set "b c"
+  $ for r in . a "a/b c" d; do
+  >     echo 1 > "po/$r/f"
+  >     hg -R "po/$r" ci -qA -d "0 0" -m "$r"
+  >     echo 2 >> "po/$r/f"
+  > done
+  $ cd po
+  $ hg tstatus "a/b c/f" --debug | grep -v '^  \|^listing\|^using'
+  routing a/b c/f to 1 of 4 repos
+  [$TESTTMP/po/a/b c]:
+  M a/b c/f
+  $ hg tstatus a
+  [$TESTTMP/po/a]:
+  M a/f
+  
+  [$TESTTMP/po/a/b c]:
+  M a/b c/f
+  $ hg tstatus f d/f d --jobs 2
+  [$TESTTMP/po]:
+  M f
+  
+  [$TESTTMP/po/d]:
+  M d/f
+  $ hg tstatus a/g
+  [$TESTTMP/po/a]:
+  a/g: No such file or directory (?)
+  $ hg tdiff --combined --nodates d/f
+  diff -r * d/f (glob)
+  --- a/d/f
+  +++ b/d/f
+  @@ -1,1 +1,2 @@
+   1
+  +2
+  $ hg tlog --merged -T '{desc}\n' a "a/b c" d/f
+  a: a
+  a/b c: a/b c
+  d: d
+  $ hg tstatus --subtrees d d/f
+  [$TESTTMP/po/d]:
+  M d/f
+  $ cd "a/b c"
+  $ hg -R ../.. tstatus f ../f
+  [$TESTTMP/po/a]:
+  M ../f
+  
+  [$TESTTMP/po/a/b c]:
+  M f
+  $ cd ../..
+
+Patterns that cannot be routed are passed to every repo, as before.
+
+  $ hg tstatus "re:f$" --debug | grep -c '^M '
+  4
+  $ cd ..
+  $ rm -r po
+
+An exception from a worker that cannot be pickled is reported with its message.
+
+  $ cat > worker.py <<'PYEOF'
+  > import sys
+  > sys.path.insert(0, sys.argv[1])
+  > import trees
+  > from mercurial import error
+  > def fail():
+  >     raise error.LookupError('abc', 'idx', 'no such node')
+  > w = trees._worker(None, fail)
+  > w.start()
+  > while not w.read():
+  >     pass
+  > print('%s: %s' % (w.exc.__class__.__name__, w.exc))
+  > PYEOF
+  $ $PYTHON worker.py "$TESTDIR/.."
+  Abort: idx@abc: no such node
+  $ rm worker.py
+
+--jobs bounds the number of workers submitted (and so of repos open) at once.
+
+  $ cat > pool.py <<'PYEOF'
+  > import sys, time
+  > sys.path.insert(0, sys.argv[1])
+  > import trees
+  > created = []
+  > most = [0]
+  > def workers():
+  >     for i in range(6):
+  >         w = trees._worker(i, time.sleep, (0.1,))
+  >         created.append(w)
+  >         most[0] = max(most[0], len([w for w in created if not w.done]))
+  >         yield w
+  > def done(w):
+  >     pass
+  > trees._runordered(2, workers(), done)
+  > print('at most %d workers at once' % most[0])
+  > PYEOF
+  $ $PYTHON pool.py "$TESTDIR/.."
+  at most 2 workers at once
+  $ rm pool.py
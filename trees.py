@@ -45,6 +45,10 @@ from a different server.  If the hg servers have the trees extension enabled::
     $ hg tclone http://abc/proj myproj
     $ hg tclone --skiproot http://xyz/pub myproj
 
+(A server with this version of the extension gives the configuration of the
+whole tree in reply to a single request, so tclone need not ask each repo for
+its subtrees.)
+
 If the hg servers do not have the trees extension enabled, then simply append
 the desired contained repos (subtrees) to the command line::
 
@@ -106,25 +110,179 @@ Show the working directory status, but only for the root repo plus the jdk and
 langtools repos::
 
     $ hg tstatus --subtrees jdk-lt
+
+File arguments to tstatus, tdiff and tlog are passed only to the repos that
+contain them (a directory also selects the repos nested below it), so that::
+
+    $ hg tlog jdk/src/Main.java
+
+runs log in the jdk repo alone.  The owning repos are found from the cached
+tree topology without opening the others.  Patterns other than plain paths
+(e.g., glob:) are passed to every repo.
+
+Commands that examine the repos (tstatus, tdiff, tlog, etc.) accept a --jobs
+option to process several repos at once; the output is still shown in tree
+order.  A default can be set in the [trees] section::
+
+    [trees]
+    jobs = 4
+
+The commands that talk to other repositories (tincoming, toutgoing, tpull and
+tpush) also accept --jobs.  To avoid overloading a server, the number of repos
+talking to any one host at the same time can be limited with the [trees]
+hostjobs config item.  With tpull --update, the working directory of each
+repo is updated as soon as its changesets have been pulled, while the other
+repos are still being pulled, and the repos left with unresolved files are
+listed at the end.
+
+When the repos are on an ssh:// server, the commands that talk to it (and
+tclone) share a single ssh connection to each host among all the repos, using
+OpenSSH connection multiplexing, instead of connecting once per repo.  This is
+not done if --ssh is given or ui.ssh is not OpenSSH's ssh, and can be disabled
+by setting sshmux = False in the [trees] section.
+
+Most of the time a tpull or tincoming finds nothing new in most of the repos,
+but each of them still runs the full discovery protocol.  With pullcache = True
+in the [trees] section, the heads, bookmarks and phase roots of the remote
+repo are fetched first and compared with those seen by the last tpull or
+tincoming from the same remote (kept in .hg/trees.pullcache).  Repos in which
+they did not change, and whose heads are all present locally, are skipped::
+
+    $ hg tpull
+    [.]:
+    pulling from http://abc/proj
+    no changes found (remote heads unchanged)
+    ...
+
+This is not done with --rev, --bookmark, --branch or --force.
+
+To watch a long-running command make progress, use --interleave (or set
+interleave = True in the [trees] section).  The output of each repo is then
+shown as soon as the repo is done, instead of in tree order, with each line
+prefixed by the path of the repo::
+
+    $ hg tpull --jobs 8 --interleave
+    src: pulling from http://abc/proj/src
+    src: no changes found
+    .: pulling from http://abc/proj
+    ...
+
+To find out which repos make a command slow, use --trees-profile.  When the
+command is done, the wall clock time spent on each repo is shown (slowest
+first), split into opening the repo, reading its subtree configuration and
+running the command itself (exchange for commands that talk to another repo,
+so it includes the network time), along with the cpu time::
+
+    $ hg tpull --trees-profile
+    ...
+    repo      open   config exchange    total      cpu
+    images   0.004    0.000    2.113    2.117    0.153
+    .        0.000    0.001    0.420    0.421    0.132
+    ...
+
+With --trees-profile-dir DIR, the cProfile stats of the command in each repo
+are also saved in DIR (e.g., DIR/images.exchange.prof) for use with pstats.
+
+To keep a record of the time spent on each repo by every tree command, set
+telemetry in the [trees] section to the path of a log file::
+
+    [trees]
+    telemetry = ~/.hgtrees.jsonl
+
+One line is appended for each repo, with a JSON object giving the command,
+the root and short path of the repo, the start time (seconds since the epoch),
+the duration and cpu time (in total and by phase) and the exit code (rc) of
+the command in that repo.
+
+The file system search done by tlist --walk and tconfig --set --walk can be
+limited with --maxdepth and tuned in the [trees] section::
+
+    [trees]
+    # directories (names or glob patterns) that never contain repos
+    walkskip = build .idea
+    # do not search directories ignored by the root repo
+    walkignored = False
+    # scan wide directory levels with several threads
+    walkthreads = 4
 """
 
 import __builtin__
+import errno
 import exceptions
+import fnmatch
+import heapq
 import inspect
 import os
+import pickle
 import re
+import select
+import shlex
+import shutil
+import signal
+import socket
+import stat
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
 
 from mercurial import cmdutil
 from mercurial import commands
+from mercurial import dispatch
 from mercurial import extensions
 from mercurial import hg
 from mercurial import localrepo
 from mercurial import pushkey
+from mercurial import templatefilters
 from mercurial import ui
 from mercurial import util
 from mercurial import error
 from mercurial.i18n import _
+from mercurial.node import bin, hex, nullid
+
+try:
+    from mercurial import scmutil
+    scmutil.match # force demandimport to load the module
+except ImportError:
+    # hg < 1.9
+    scmutil = None
+
+try:
+    from mercurial import exchange
+    exchange.pull # force demandimport to load the module
+except ImportError:
+    # hg < 3.2
+    exchange = None
+
+try:
+    from mercurial import logcmdutil
+except ImportError:
+    # hg < 4.6
+    logcmdutil = None
+
+try:
+    from hashlib import sha1
+except ImportError:
+    # python < 2.5
+    from sha import sha as sha1
+
+try:
+    import cProfile
+except ImportError:
+    # python < 2.5
+    cProfile = None
+
+# os.scandir (python 3.5) or the scandir module avoid most stat() calls when
+# walking the file system.
+_scandirfunc = getattr(os, 'scandir', None)
+if _scandirfunc is None:
+    try:
+        from scandir import scandir as _scandirfunc
+    except ImportError:
+        pass
 
 testedwith = '''
 1.1 1.1.2 1.2 1.2.1 1.3 1.3.1 1.4 1.4.3
@@ -201,6 +359,15 @@ if configitem:
     configitem('trees', 'namespace', default='trees')
     configitem('trees', 'namespaces', default=[])
     configitem('trees', 'splitargs', default=True)
+    configitem('trees', 'jobs', default=1)
+    configitem('trees', 'hostjobs', default=0)
+    configitem('trees', 'interleave', default=False)
+    configitem('trees', 'walkignored', default=True)
+    configitem('trees', 'walkskip', default=[])
+    configitem('trees', 'walkthreads', default=1)
+    configitem('trees', 'telemetry', default=None)
+    configitem('trees', 'sshmux', default=True)
+    configitem('trees', 'pullcache', default=False)
     configitem('trees', '.*', default=None, generic=True)
 
 def _checklocal(repo):
@@ -268,6 +435,10 @@ def hg_repo(ui, url, opts):
     parts = url.split(':', 2)
     if len(parts) == 1 or parts[0] == 'file':
         return hg.repository(ui, url)
+    _sshmaster(url)
+    if _mux is not None and _mux.ssh and not opts.get('ssh'):
+        opts = dict(opts)
+        opts['ssh'] = _mux.ssh
     return hg.peer(ui, opts, url)
 
 def _subtreegen_listkeys(ui, repo, opts, namespace):
@@ -297,54 +468,1831 @@ def _subtreegen(ui, repo, opts):
         for r, st in _subtreegen_listkeys(ui, repo, opts, namespace):
             yield r, st
 
-def _docmd1(cmd, ui, repo, *args, **opts):
-    """Call cmd for repo and each configured/specified subtree.
+# The recursively expanded list of repos in a tree is cached in the top-level
+# repo, separately for each namespace, along with the mtime and size of every
+# file that was read to produce it (the namespace file and hgrc of each repo).
+# The cached list is used as long as none of those files have changed, so
+# repeated commands need not open every repo in the tree just to list them.
+#
+# The cache is a text file; after a version line, each namespace starts with an
+# 'ns' line, followed by 'stamp <mtime> <size> <path>' lines ('-' for the mtime
+# and size of a file that does not exist) and 'repo <parent> <root>\0<path>'
+# lines, where parent is the index of the enclosing repo in the list (-1 for the
+# top) and path is relative to the top.
 
-    This is for commands which operate on a single tree (e.g., tstatus,
-    tupdate)."""
+_topologyversion = 'trees-topology 2'
+
+def _topologypath(repo):
+    return _repo_join(repo, os.path.join('cache', 'trees-topology'))
+
+def _stamp(path):
+    """Return (mtime, size) for path, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+def _readtopology(repo):
+    """Return the cached topology as a dict: namespace -> (stamps, nodes)."""
+    s = _readfile(_topologypath(repo))
+    if not s or not s.startswith(_topologyversion + '\n'):
+        return {}
+    d = {}
+    try:
+        for line in s.splitlines()[1:]:
+            kind, rest = line.split(' ', 1)
+            if kind == 'ns':
+                stamps, nodes = d[rest] = ([], [])
+            elif kind == 'stamp':
+                mtime, size, path = rest.split(' ', 2)
+                stamp = None
+                if mtime != '-':
+                    stamp = (float(mtime), int(size))
+                stamps.append((path, stamp))
+            elif kind == 'repo':
+                parent, rest = rest.split(' ', 1)
+                root, path = rest.split('\0')
+                nodes.append((int(parent), root, path))
+    except (ValueError, UnboundLocalError):
+        return {}
+    return d
+
+def _writetopology(repo, d):
+    lines = [_topologyversion]
+    for ns, (stamps, nodes) in sorted(d.items()):
+        lines.append('ns %s' % ns)
+        for path, stamp in stamps:
+            if stamp:
+                lines.append('stamp %r %d %s' % (stamp[0], stamp[1], path))
+            else:
+                lines.append('stamp - - %s' % path)
+        for parent, root, path in nodes:
+            lines.append('repo %d %s\0%s' % (parent, root, path))
+    path = _topologypath(repo)
+    tmp = '%s.%d' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(tmp, 'w')
+        try:
+            f.write('\n'.join(lines) + '\n')
+        finally:
+            f.close()
+        util.rename(tmp, path)
+    except (IOError, OSError):
+        # The cache is only an optimization (and the repo may be read-only).
+        pass
+
+def _topologyvalid(stamps, nodes):
+    for path, stamp in stamps:
+        if _stamp(path) != stamp:
+            return False
+    for parent, root, path in nodes:
+        if not os.path.isdir(os.path.join(root, '.hg')):
+            return False
+    return True
+
+def _topologyambiguous(stamps):
+    """Return True if a file may change without changing its stamp.
+
+    A file modified within the current second could be modified again within
+    that second without a change in its mtime (on file systems with coarse
+    timestamps), so a topology built from it is not cached."""
+    now = int(time.time())
+    for path, stamp in stamps:
+        if stamp and int(stamp[0]) >= now:
+            return True
+    return False
+
+class _tree(object):
+    """The repos in a tree:  the top-level repo and its subtrees, recursively.
+
+    Walking a _tree yields (path, repo, ui) nodes in depth-first order, where
+    path is relative to the top-level repo ('' for the top-level repo itself)
+    and ui is the one to use with repo.  Each repo is opened only once:  the
+    first walk opens them lazily, so an error opening a subtree is raised only
+    after the repos before it have been processed, and later walks (or len())
+    reuse the same nodes.
+
+    If strict is False, missing subtrees are skipped with a warning instead of
+    raising an error.  If the subtrees were not specified on the command line,
+    the topology cache is used (or updated) so that the configuration of each
+    repo need not be read."""
+
+    def __init__(self, ui, repo, opts, strict=True):
+        self.ui = ui
+        self.repo = repo
+        self.opts = dict(opts)
+        self.strict = strict
+        self.nodes = []
+        self._sep = None
+        self._ns = None
+        self._cache = None
+        self._cached = None
+        self._pathindex = None
+        if _profile is not None and not _profile.top:
+            _profile.top = repo.root
+        if not opts.get('subtrees'):
+            self._ns = _ns(ui, opts)
+            self._cache = _readtopology(repo)
+            entry = self._cache.get(self._ns)
+            if entry and entry[1][0][1] == repo.root and \
+               _topologyvalid(*entry):
+                ui.debug('using cached tree topology\n')
+                self._cached = entry[1]
+        if self._cached:
+            self._gen = self._opencached()
+        else:
+            self._gen = self._walktop()
+
+    def _opencached(self):
+        for parent, root, path in self._cached:
+            if parent < 0:
+                yield '', self.repo, self.ui
+            else:
+                if self._sep:
+                    self._sep()
+                start = _pstart()
+                lr = _openrepo(self.nodes[parent][2], root)
+                _pstop(start, lr.root, 'open')
+                yield path, lr, lr.ui
+
+    def _walktop(self):
+        topology, stamps = [], []
+        self._complete = True
+        for node in self._walk(self.ui, self.repo, '', -1, topology, stamps):
+            yield node
+        if self._cache is not None and self._complete and \
+           not _topologyambiguous(stamps):
+            self._cache[self._ns] = (stamps, topology)
+            _writetopology(self.repo, self._cache)
+
+    def _walk(self, ui, repo, path, parent, topology, stamps):
+        index = len(topology)
+        topology.append((parent, repo.root, path))
+        for f in ('hgrc', _ns(ui, self.opts)):
+            p = _repo_join(repo, f)
+            stamps.append((p, _stamp(p)))
+        yield path, repo, ui
+        start = _pstart()
+        subtrees = _subtreelist(ui, repo, self.opts)
+        _pstop(start, repo.root, 'config')
+        for subtree in subtrees:
+            dir = repo.wjoin(subtree)
+            if not self.strict and not os.path.exists(dir):
+                ui.warn('repo %s is missing subtree %s\n' %
+                        (repo.root, subtree))
+                self._complete = False
+                continue
+            if self._sep:
+                self._sep()
+            start = _pstart()
+            lr = _openrepo(ui, dir)
+            _pstop(start, lr.root, 'open')
+            for node in self._walk(lr.ui, lr, path and path + '/' + subtree or
+                                   subtree, index, topology, stamps):
+                yield node
+
+    def walk(self, sep=None):
+        """yields the nodes of the tree
+
+        If sep is given, it is called before each node after the first (before
+        the repo is opened)."""
+        i = 0
+        while i < len(self.nodes) or self._gen:
+            if i < len(self.nodes):
+                if i and sep:
+                    sep()
+                node = self.nodes[i]
+            else:
+                self._sep = sep
+                try:
+                    node = self._gen.next()
+                except StopIteration:
+                    self._gen = None
+                    break
+                self.nodes.append(node)
+            yield node
+            i += 1
 
-    ui.status('[%s]:\n' % repo.root)
-    # XXX - should be done just once.
+    def __iter__(self):
+        return self.walk()
+
+    def __len__(self):
+        for node in self.walk():
+            pass
+        return len(self.nodes)
+
+    def pathindex(self):
+        """Return a dict mapping the path of each repo (as in the nodes) to its
+        position in the tree, without opening the repos if possible."""
+        if self._pathindex is None:
+            if self._cached:
+                paths = [path for parent, root, path in self._cached]
+            else:
+                paths = [path for path, lr, lui in self.walk()]
+            self._pathindex = dict([(paths[i], i) for i in xrange(len(paths))])
+        return self._pathindex
+
+    def select(self, positions, sep=None):
+        """Yield the nodes at the given positions in the tree, in tree order.
+
+        With a cached topology, only those repos and the repos above them are
+        opened.  sep is called as it is by walk(), between the nodes yielded."""
+        positions = sorted(positions)
+        if not self._cached:
+            wanted = set(positions)
+            for i, node in enumerate(self.walk()):
+                if i in wanted:
+                    if sep and i != positions[0]:
+                        sep()
+                    yield node
+            return
+        opened = {}
+        def get(i):
+            if i < len(self.nodes):
+                return self.nodes[i]
+            if i not in opened:
+                parent, root, path = self._cached[i]
+                if parent < 0:
+                    opened[i] = '', self.repo, self.ui
+                else:
+                    pui = get(parent)[2]
+                    start = _pstart()
+                    lr = _openrepo(pui, root)
+                    _pstop(start, lr.root, 'open')
+                    opened[i] = path, lr, lr.ui
+            return opened[i]
+        for i in positions:
+            if sep and i != positions[0]:
+                sep()
+            yield get(i)
+
+    def roots(self):
+        """Return the root of each repo, without opening them if possible."""
+        if self._cached and len(self.nodes) <= 1:
+            return [root for parent, root, path in self._cached]
+        return [lr.root for path, lr, lui in self.walk()]
+
+# Pattern kinds that name a file or directory relative to the current directory
+# (the default when no kind is given).
+_routablekinds = ('relpath',)
+_patkinds = ('re', 'glob', 'path', 'relglob', 'relpath', 'relre', 'listfile',
+             'listfile0', 'set', 'include', 'subinclude', 'rootfilesin')
+
+def _routepats(tree, pats):
+    """Return [(position, pats)] giving the repos of the tree that own the files
+    named by pats, and the pats to pass to each, rewritten relative to its root.
+
+    A file is owned by the innermost repo containing it; a directory also names
+    every repo below it, as a whole (by its root).  The owners are found in the
+    tree's path index, so the other repos need not be opened.  None is returned
+    if pats is empty, or if a pattern cannot be routed (e.g., a glob or a path
+    outside the tree), in which case pats should be passed to every repo."""
+    if not pats:
+        return None
+    root = tree.repo.root
+    cwd = os.getcwd()
+    index = tree.pathindex()
+    routes = {}
+    def add(i, pat):
+        l = routes.setdefault(i, [])
+        if pat not in l:
+            l.append(pat)
+    for pat in pats:
+        kind, name = None, pat
+        if ':' in pat:
+            kind, name = pat.split(':', 1)
+            if kind not in _patkinds:
+                kind, name = None, pat
+            elif kind not in _routablekinds:
+                return None
+        f = os.path.normpath(os.path.join(cwd, name))
+        if f == root:
+            rel = ''
+        elif f.startswith(root + os.sep):
+            rel = util.pconvert(f[len(root) + 1:])
+        else:
+            return None
+        parts = rel and rel.split('/') or []
+        for n in xrange(len(parts), -1, -1):
+            i = index.get('/'.join(parts[:n]))
+            if i is not None:
+                add(i, parts[n:] and 'path:' + '/'.join(parts[n:]) or '')
+                break
+        for path, i in index.iteritems():
+            if path and (not rel or path.startswith(rel + '/')):
+                add(i, '')
+    paths = dict([(i, path) for path, i in index.iteritems()])
+    # A repo selected as a whole is named by its root, as 'hg status .' would
+    # name it, so that the command still shows paths relative to cwd.
+    return [(i, '' in l and [paths[i] and os.path.join(root, paths[i]) or root]
+             or l) for i, l in sorted(routes.items())]
+
+def _treepats(tree, pats, sep=None):
+    """Yield (node, pats) for each repo of the tree in which to run a command
+    on the files named by pats (see _routepats); sep is passed to walk()."""
+    routes = _routepats(tree, pats)
+    if routes is None:
+        for node in tree.walk(sep):
+            yield node, pats
+        return
+    tree.ui.debug('routing %s to %d of %d repos\n' %
+                  (' '.join(pats), len(routes), len(tree.pathindex())))
+    for k, node in enumerate(tree.select([i for i, p in routes], sep)):
+        yield node, tuple(routes[k][1])
+
+def _cmdopts(opts):
+    """Return a copy of opts without the options specific to tree commands."""
     cmdopts = dict(opts)
-    for o in subtreesopts:
-        if o[1] in cmdopts:
-            del cmdopts[o[1]]
-    trc = cmd(ui, repo, *args, **cmdopts)
-    ui.flush()
-    rc = trc != None and trc or 0
-    for subtree in _subtreelist(ui, repo, opts):
-        ui.status('\n')
-        lr = hg.repository(ui, repo.wjoin(subtree))
-        trc = _docmd1(cmd, lr.ui, lr, *args, **opts)
-        rc += trc != None and trc or 0
-    return rc
+    for o in subtreesopts + jobsopt + profileopts:
+        # fancyopts stores the options with '_' in place of '-'
+        cmdopts.pop(o[1].replace('-', '_'), None)
+    return cmdopts
 
-def _docmd2(cmd, ui, repo, remote, adjust, **opts):
-    """Call cmd for repo and each configured/specified subtree.
+# --------------------------------- profiling ----------------------------------
 
-    This is for commands which operate on two trees (e.g., tpull, tpush)."""
+_profile = None # the _profiler of the running command, if any
 
-    ui.status('[%s]:\n' % repo.root)
-    trc = cmd(ui, repo, remote, **opts)
-    ui.flush()
-    rc = trc != None and trc or 0
-    for subtree in _subtreelist(ui, repo, opts):
-        ui.status('\n')
-        lr = hg.repository(ui, repo.wjoin(subtree))
-        remote2 = adjust and os.path.join(remote, subtree) or remote
-        trc = _docmd2(cmd, lr.ui, lr, remote2, adjust, **opts)
+class _profiler(object):
+    """The wall clock and cpu time spent on each repo, by phase.
+
+    This is used to show the time spent by a command (--trees-profile) and to
+    log it (the [trees] telemetry config item).
+
+    The phases are 'open' (opening the repo), 'config' (reading the list of
+    subtrees), 'command' (running the command in the repo), 'exchange' (the
+    same, for commands that talk to another repo, so it includes the time spent
+    on the network), 'update' and 'clone'.  Times measured in worker processes
+    are sent back to the parent with the result of the worker.
+
+    If dir is given, the cProfile stats of each command, exchange, update or
+    clone are saved in dir, in a file named after the repo and the phase."""
+
+    def __init__(self, dir=None):
+        self.dir = dir
+        self.top = None
+        self.records = [] # (root, phase, start, wall, cpu, rc)
+
+    def shortpath(self, root):
+        if root == self.top:
+            return '.'
+        if self.top and root.startswith(self.top + os.sep):
+            return root[len(self.top) + 1:]
+        return root
+
+    def runcall(self, root, phase, func, args, kwargs):
+        p = cProfile.Profile()
+        try:
+            return p.runcall(func, *args, **kwargs)
+        finally:
+            name = self.shortpath(root).replace(os.sep, '_')
+            if name == '.':
+                name = 'root'
+            p.dump_stats(os.path.join(self.dir, '%s.%s.prof' % (name, phase)))
+
+    def report(self, ui):
+        """Show the time spent on each repo, slowest first."""
+        order = ('open', 'config', 'command', 'exchange', 'update', 'clone')
+        phases = [p for p in order if p in [r[1] for r in self.records]]
+        repos = {}
+        for root, phase, start, wall, cpu, rc in self.records:
+            t = repos.setdefault(root, {}).setdefault(phase, [0.0, 0.0])
+            t[0] += wall
+            t[1] += cpu
+        rows = []
+        for root, d in repos.items():
+            rows.append((sum([t[0] for t in d.values()]),
+                         sum([t[1] for t in d.values()]),
+                         self.shortpath(root), d))
+        rows.sort()
+        rows.reverse()
+        width = max([len(r[2]) for r in rows] + [5])
+        ui.write_err(('%-*s' + ' %8s' * (len(phases) + 2) + '\n') %
+                     tuple([width, 'repo'] + phases + ['total', 'cpu']))
+        totals = {}
+        for wall, cpu, path, d in rows:
+            l = []
+            for phase in phases:
+                t = d.get(phase, [0.0])[0]
+                totals[phase] = totals.get(phase, 0.0) + t
+                l.append(t)
+            ui.write_err(('%-*s' + ' %8.3f' * (len(phases) + 2) + '\n') %
+                         tuple([width, path] + l + [wall, cpu]))
+        ui.write_err(('%-*s' + ' %8.3f' * (len(phases) + 2) + '\n') %
+                     tuple([width, 'total'] + [totals[p] for p in phases] +
+                           [sum([r[0] for r in rows]),
+                            sum([r[1] for r in rows])]))
+
+    def log(self, ui, path, name):
+        """Append a JSON record for each repo to the file path.
+
+        Each record gives the command name, the root and short path of the
+        repo, the time the command started on the repo, the wall clock and cpu
+        time spent on it (in total and by phase) and the exit code of the
+        command in the repo (255 if it failed with an error)."""
+        repos = {}
+        order = []
+        for root, phase, start, wall, cpu, rc in self.records:
+            d = repos.get(root)
+            if d is None:
+                d = repos[root] = {'command': name, 'root': root,
+                                   'path': self.shortpath(root),
+                                   'time': start, 'duration': 0.0, 'cpu': 0.0,
+                                   'phases': {}, 'rc': None}
+                order.append(root)
+            d['duration'] += wall
+            d['cpu'] += cpu
+            d['phases'][phase] = d['phases'].get(phase, 0.0) + wall
+            if rc is not None:
+                d['rc'] = rc
+        data = ''.join([templatefilters.json(repos[root]) + '\n'
+                        for root in order])
+        try:
+            fd = os.open(util.expandpath(path),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except (IOError, OSError), inst:
+            ui.warn(_('cannot write telemetry to %s: %s\n') %
+                    (path, inst.strerror))
+
+def _cputime():
+    """Return the user and system time of this process and its children."""
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+def _pstart():
+    """Return the start of a phase for _pstop, or None if not profiling."""
+    if _profile is None:
+        return None
+    return (time.time(), _cputime())
+
+def _pstop(start, root, phase, rc=None):
+    """Record the time since start (from _pstart) as spent on root in phase.
+
+    rc is the exit code of the command in phase, if any."""
+    if start is not None and _profile is not None:
+        _profile.records.append((root, phase, start[0], time.time() - start[0],
+                                 _cputime() - start[1], rc))
+
+def _pcall(root, phase, func):
+    """Return func, or a wrapper that records the time func spends on root in
+    phase if profiling."""
+    if _profile is None:
+        return func
+    def call(*args, **kwargs):
+        start = _pstart()
+        rc = 255
+        try:
+            if _profile.dir:
+                ret = _profile.runcall(root, phase, func, args, kwargs)
+            else:
+                ret = func(*args, **kwargs)
+            rc = ret or 0
+            return ret
+        finally:
+            _pstop(start, root, phase, rc)
+    return call
+
+def _profiled(func, name):
+    """Wrap the command func (named name) so that the time spent on each repo
+    is shown (--trees-profile) or logged ([trees] telemetry) once the command
+    finishes."""
+    def cmd(ui, *args, **opts):
+        global _profile
+        show = opts.get('trees_profile')
+        telemetry = ui.config('trees', 'telemetry')
+        if show or telemetry:
+            dir = show and opts.get('trees_profile_dir')
+            if dir and cProfile is None:
+                raise error_Abort(_('--trees-profile-dir requires cProfile'))
+            if dir and not os.path.isdir(dir):
+                os.makedirs(dir)
+            _profile = _profiler(dir and os.path.abspath(dir))
+        try:
+            try:
+                return func(ui, *args, **opts)
+            except TypeError:
+                # Let mercurial report a call with the wrong arguments.
+                if len(traceback.extract_tb(sys.exc_info()[2])) == 1:
+                    raise error.SignatureError
+                raise
+        finally:
+            if _profile is not None:
+                p, _profile = _profile, None
+                if p.records and show:
+                    p.report(ui)
+                if p.records and telemetry:
+                    p.log(ui, telemetry, name)
+    cmd.__doc__ = func.__doc__
+    cmd.__dict__.update(func.__dict__)
+    return cmd
+
+# ---------------------------- concurrent execution ----------------------------
+
+def _jobs(ui, opts):
+    """Return the number of repos to process concurrently.
+
+    The --jobs option overrides the [trees] jobs config item.  Commands without
+    a --jobs option, and platforms without fork(), always run serially."""
+    if 'jobs' not in opts or not hasattr(os, 'fork'):
+        return 1
+    n = opts.get('jobs') or ui.configint('trees', 'jobs', 1)
+    return max(n or 1, 1)
+
+def _interleave(ui, opts):
+    """Return True if the output of each repo should be shown as soon as it
+    finishes instead of in tree order (--interleave or [trees] interleave).
+
+    Like --jobs, this needs fork(); elsewhere the output is in tree order."""
+    if 'interleave' not in opts or not hasattr(os, 'fork'):
+        return False
+    return opts.get('interleave') or ui.configbool('trees', 'interleave', False)
+
+class _worker(object):
+    """Call func(*args, **kwargs) in a forked child process.
+
+    Whatever the child writes to stdout and stderr is spooled to temporary files
+    so the parent can replay it later, in tree order.  The return value (or the
+    exception raised) is pickled and sent back to the parent through a pipe.
+
+    Workers in the same group (e.g., those talking to the same remote host) can
+    be limited by the _pool that runs them."""
+
+    def __init__(self, data, func, args=(), kwargs=None, group=None):
+        self.data = data
+        self.group = group
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.pid = None
+        self.fd = None
+        self.done = False
+        self.result = None
+        self.exc = None
+
+    def start(self):
+        self.out = tempfile.TemporaryFile()
+        self.err = tempfile.TemporaryFile()
+        rfd, wfd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(rfd)
+            self._child(wfd)
+        os.close(wfd)
+        self.fd = rfd
+        self._chunks = []
+
+    def _child(self, wfd):
+        status = 255
+        try:
+            try:
+                os.dup2(self.out.fileno(), 1)
+                os.dup2(self.err.fileno(), 2)
+                # Times recorded by the child are sent back to the parent.
+                n = _profile is not None and len(_profile.records) or 0
+                try:
+                    res = [self.func(*self.args, **self.kwargs), None]
+                except Exception, inst:
+                    res = [None, inst]
+                sys.stdout.flush()
+                sys.stderr.flush()
+                res.append(_profile is not None and _profile.records[n:] or [])
+                data = _pickleresult(res)
+            except Exception, inst:
+                # Report the failure instead of dying without a result.
+                data = pickle.dumps((None, error_Abort(str(inst)), []), 2)
+            try:
+                while data:
+                    data = data[os.write(wfd, data):]
+                status = 0
+            except OSError:
+                pass
+        finally:
+            os._exit(status)
+
+    def runinline(self):
+        """Call func in this process, spooling its output as a child would."""
+        self.out = tempfile.TemporaryFile()
+        self.err = tempfile.TemporaryFile()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = (os.dup(1), os.dup(2))
+        try:
+            os.dup2(self.out.fileno(), 1)
+            os.dup2(self.err.fileno(), 2)
+            try:
+                self.result = self.func(*self.args, **self.kwargs)
+            except Exception, inst:
+                self.exc = inst
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+        self.done = True
+
+    def read(self):
+        """Read from the result pipe; return True once the child is done."""
+        try:
+            s = os.read(self.fd, 65536)
+        except OSError, inst:
+            if inst.errno == errno.EINTR:
+                return False
+            raise
+        if s:
+            self._chunks.append(s)
+            return False
+        os.close(self.fd)
+        os.waitpid(self.pid, 0)
+        data = ''.join(self._chunks)
+        if data:
+            try:
+                self.result, self.exc, records = pickle.loads(data)
+            except Exception, inst:
+                self.exc = error_Abort(_('worker process %d: cannot read its '
+                                         'result: %s') % (self.pid, inst))
+                records = []
+            if _profile is not None:
+                _profile.records.extend(records)
+        else:
+            self.exc = error_Abort(_('worker process %d died') % self.pid)
+        self.done = True
+        return True
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        os.close(self.fd)
+        os.waitpid(self.pid, 0)
+        self.done = True
+        self.exc = error_Abort(_('worker process %d killed') % self.pid)
+
+    def replay(self, ui, prefix=None, filter=None):
+        """Write the spooled output of the child using ui.
+
+        If prefix is given, it is written at the start of each line.  If filter
+        is given, each line of stdout is passed through it instead."""
+        for f, write in ((self.out, ui.write), (self.err, ui.write_err)):
+            f.seek(0)
+            if filter is not None and f is self.out:
+                for line in f:
+                    write(filter(line))
+            elif prefix is None:
+                for chunk in util.filechunkiter(f):
+                    write(chunk)
+            else:
+                for line in f:
+                    if not line.endswith('\n'):
+                        line += '\n'
+                    write(prefix + line)
+            f.close()
+
+def _pickleresult(res):
+    """Pickle the [result, exception, records] of a worker.
+
+    An exception that does not survive pickling (e.g., one whose constructor
+    takes other arguments than it keeps in args, like error.LookupError) is
+    replaced by an Abort with the same message."""
+    try:
+        data = pickle.dumps(tuple(res), 2)
+        if res[1] is not None:
+            pickle.loads(data)
+        return data
+    except Exception, inst:
+        msg = res[1] is None and _('cannot return result: %s') % inst or \
+              str(res[1])
+        return pickle.dumps((None, error_Abort(msg), res[2]), 2)
+
+class _pool(object):
+    """Run _workers, at most jobs of them at a time.
+
+    If grouplimit is non-zero, at most that many workers from any one group run
+    at a time; pending workers from other groups may be started first."""
+
+    def __init__(self, jobs, grouplimit=0):
+        self.jobs = jobs
+        self.grouplimit = grouplimit
+        self.pending = []
+        self.running = {} # result pipe fd -> _worker
+        self.groups = {}  # group -> number of running workers
+
+    def full(self):
+        """Return True if no more workers should be submitted for now.
+
+        At most jobs workers are running or pending (so at most jobs repos are
+        open for them), except that while a running slot is free and every
+        pending worker is held back by grouplimit, more may be submitted to
+        find one that can use the slot."""
+        if len(self.running) + len(self.pending) < self.jobs:
+            return False
+        return len(self.running) >= self.jobs or \
+               [w for w in self.pending if not self._blocked(w)] != []
+
+    def _blocked(self, w):
+        return w.group is not None and self.grouplimit and \
+               self.groups.get(w.group, 0) >= self.grouplimit
+
+    def submit(self, w, first=False):
+        """Queue w to run; if first is true, ahead of the pending workers."""
+        if first:
+            self.pending.insert(0, w)
+        else:
+            self.pending.append(w)
+        self._fill()
+
+    def _fill(self):
+        i = 0
+        while i < len(self.pending) and len(self.running) < self.jobs:
+            w = self.pending[i]
+            if self._blocked(w):
+                i += 1
+                continue
+            del self.pending[i]
+            w.start()
+            self.running[w.fd] = w
+            self.groups[w.group] = self.groups.get(w.group, 0) + 1
+
+    def wait(self):
+        """Wait for running workers; return a list of those that finished."""
+        finished = []
+        while self.running and not finished:
+            try:
+                fds = select.select(self.running.keys(), [], [])[0]
+            except select.error, inst:
+                if inst.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in fds:
+                w = self.running[fd]
+                if w.read():
+                    del self.running[fd]
+                    self.groups[w.group] -= 1
+                    finished.append(w)
+        self._fill()
+        return finished
+
+    def cancel(self):
+        self.pending = []
+        for w in self.running.values():
+            w.kill()
+        self.running = {}
+
+def _runordered(jobs, workers, done, grouplimit=0, ordered=True, inline=False):
+    """Run workers in a _pool and call done(worker) for each, in order.
+
+    workers is an iterable which is consumed lazily, so repos can be opened as
+    the pool has room for them.  If the iterable raises an exception, it is
+    passed to done, in order, as a finished worker with no data.  An exception
+    raised by done, or done returning True, cancels the remaining workers.
+
+    If ordered is False, done is called as soon as each worker finishes; an
+    exception from the iterable is still passed to done after the workers
+    before it.
+
+    If inline is True, the first worker is run in this process before any are
+    forked.  Mercurial loads most of its modules on first use, so this loads
+    the modules the workers need once, instead of once in every worker."""
+    pool = _pool(jobs, grouplimit)
+    queue = []
+    it = iter(workers)
+    exhausted = False
+    try:
+        while True:
+            while not (exhausted or pool.full()):
+                try:
+                    w = it.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                except Exception, inst:
+                    w = _worker(None, None)
+                    w.done, w.exc = True, inst
+                    exhausted = True
+                    queue.append(w)
+                    break
+                if inline:
+                    inline = False
+                    w.runinline()
+                else:
+                    pool.submit(w)
+                queue.append(w)
+            stopped = False
+            if ordered:
+                while queue and queue[0].done and not stopped:
+                    stopped = done(queue.pop(0))
+            else:
+                for w in [w for w in queue if w.done]:
+                    if stopped:
+                        break
+                    if w.data is None and len(queue) > 1:
+                        continue # an error from workers; see above
+                    queue.remove(w)
+                    stopped = done(w)
+            if stopped:
+                pool.cancel()
+                break
+            if not queue and exhausted:
+                break
+            pool.wait()
+    except:
+        pool.cancel()
+        raise
+
+def _prun(tree, jobs, workers, grouplimit=0, stop=False, inline=False):
+    """Run the workers for the repos in tree; return the sum of the results.
+
+    Each worker's data is a (path, repo, ui) node.  The output is shown in tree
+    order under the usual [repo]: headers, just as the serial loop shows it.
+    If stop is True, the repos after the first one with a non-zero result are
+    cancelled.
+
+    With --interleave, the output of each repo is shown as soon as it finishes,
+    with each line prefixed by the short path of the repo, and stop cancels all
+    the remaining repos.
+
+    inline is passed to _runordered."""
+    rc = [0]
+    interleave = _interleave(tree.ui, tree.opts)
+    def done(w):
+        if w.data is None:
+            if not interleave:
+                tree.ui.status('\n')
+            raise w.exc
+        path, lr, lui = w.data
+        if interleave:
+            w.replay(lui, _shortpaths(tree.repo.root, [lr.root])[0] + ': ')
+        else:
+            if path:
+                lui.status('\n')
+            lui.status('[%s]:\n' % lr.root)
+            w.replay(lui)
+        lui.flush()
+        if w.exc:
+            raise w.exc
+        rc[0] += w.result != None and w.result or 0
+        return stop and rc[0] != 0
+    _runordered(jobs, workers, done, grouplimit, not interleave, inline)
+    return rc[0]
+
+# ------------------------------- command server -------------------------------
+
+# The repos kept open by tserve, keyed by path; None except in a tserve server.
+_servedrepos = None
+# The settings of the ui each of _servedrepos was opened with (see _uiconfig).
+_servedconfigs = {}
+
+# Files (relative to .hg) whose changes make tserve reopen a repo.
+_servestampfiles = ('', 'dirstate', 'bookmarks', 'branch', 'hgrc', 'trees',
+                    'store', 'store/00changelog.i', 'store/00manifest.i',
+                    'store/phaseroots', 'store/obsstore')
+
+def _uiconfig(ui):
+    """Return all the settings of ui (including --config and the verbosity),
+    except the internal one that dispatch sets to the root of the repo."""
+    return sorted([c for c in ui.walkconfig()
+                   if c[:2] != ('bundle', 'mainreporoot')])
+
+def _openrepo(ui, path, open=None):
+    """Open the repo at path, as hg.repository(ui, path) (or open) does.
+
+    In a tserve server, a repo that is already open is reused if it was opened
+    with the same settings as ui (the dirstate, store and caches of the repo
+    keep the ui they were created with); its ui is replaced by a new one
+    derived from ui, so that output goes to the caller.  Otherwise, the repo
+    is opened again."""
+    open = open or hg.repository
+    if _servedrepos is None:
+        return open(ui, path)
+    path = os.path.normpath(path)
+    config = _uiconfig(ui)
+    lr = _servedrepos.get(path)
+    if lr is None or _servedconfigs.get(path) != config:
+        lr = open(ui, path)
+        _servedrepos[path] = lr
+        _servedconfigs[path] = config
+        return lr
+    lui = ui.copy()
+    lui.copy = ui.copy # as in localrepository.__init__
+    lui.readconfig(_repo_join(lr, 'hgrc'), lr.root)
+    lr.baseui, lr.ui = ui, lui
+    if hasattr(lr.dirstate, '_ui'):
+        lr.dirstate._ui = lui
+    # Paths are shown relative to the current directory, which may differ.
+    lr.dirstate.__dict__.pop('_cwd', None)
+    return lr
+
+def _servedrepository(orig, ui, path='', *args, **kwargs):
+    """Wraps hg.repository in a tserve child, so that the repo of the command
+    is opened by _openrepo once dispatch has applied the global options."""
+    def open(ui, path):
+        return orig(ui, path, *args, **kwargs)
+    if path and os.path.normpath(os.path.abspath(path)) in _servedrepos:
+        return _openrepo(ui, os.path.abspath(path), open)
+    return open(ui, path)
+
+def _repostamp(root):
+    """Return a list of stamps for the files that describe the repo at root."""
+    l = []
+    for f in _servestampfiles:
+        try:
+            st = os.stat(os.path.join(root, '.hg', f))
+            l.append((st.st_mtime, st.st_size, st.st_ino))
+        except OSError:
+            l.append(None)
+    return l
+
+def _recvall(conn, n):
+    l = []
+    while n:
+        s = conn.recv(n)
+        if not s:
+            break
+        l.append(s)
+        n -= len(s)
+    return ''.join(l)
+
+class _relay(object):
+    """Send what is written to stdout and stderr (file descriptors 1 and 2, so
+    that the output of subprocesses is included) to a tserve client.
+
+    Each chunk is sent as a frame:  a channel ('o' for stdout, 'e' for stderr
+    or 'r' for the final exit status) followed by a 4-byte big-endian length and
+    the data.  This is the framing used by tclient.py.  Input is requested from
+    the client by _channelin."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.threads = []
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.close(null)
+        for fd, ch in ((1, 'o'), (2, 'e')):
+            rfd, wfd = os.pipe()
+            os.dup2(wfd, fd)
+            os.close(wfd)
+            t = threading.Thread(target=self._copy, args=(rfd, ch))
+            t.start()
+            self.threads.append(t)
+
+    def _copy(self, fd, ch):
+        while True:
+            try:
+                s = os.read(fd, 65536)
+            except OSError, inst:
+                if inst.errno == errno.EINTR:
+                    continue
+                raise
+            if not s:
+                break
+            self.send(ch, s)
+        os.close(fd)
+
+    def send(self, ch, data):
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.sendall(ch + struct.pack('>I', len(data)) + data)
+            except socket.error:
+                pass # the client went away
+        finally:
+            self.lock.release()
+
+    def close(self, rc):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        null = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        os.dup2(null, 2)
+        os.close(null)
+        for t in self.threads:
+            t.join()
+        self.send('r', struct.pack('>i', rc))
+
+class _channelin(object):
+    """Standard input of a tserve command, read from the client on demand.
+
+    Like the 'I' and 'L' channels of mercurial's command server, each read
+    sends a frame asking for up to a number of bytes (or a line) and the client
+    answers with an 'i' frame holding the data, empty at end of file.  Nothing
+    is read from the client unless the command reads its input."""
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.eof = False
+
+    def _request(self, ch, size):
+        if self.eof:
+            return ''
+        self.relay.send(ch, struct.pack('>I', size))
+        header = _recvall(self.relay.conn, 5)
+        if len(header) < 5 or header[0] != 'i':
+            self.eof = True
+            return ''
+        data = _recvall(self.relay.conn, struct.unpack('>I', header[1:])[0])
+        if not data:
+            self.eof = True
+        return data
+
+    def read(self, size=-1):
+        if size >= 0:
+            return self._request('I', size)
+        l = []
+        while True:
+            s = self._request('I', 65536)
+            if not s:
+                return ''.join(l)
+            l.append(s)
+
+    def readline(self, size=-1):
+        return self._request('L', size >= 0 and size or 65536)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        pass
+
+def _peeruid(conn):
+    """Return the uid of the process at the other end of the unix socket conn,
+    or None if the platform cannot tell."""
+    opt = getattr(socket, 'SO_PEERCRED', None)
+    if opt is None and sys.platform.startswith('linux'):
+        opt = 17
+    if opt is None:
+        return None
+    try:
+        cred = conn.getsockopt(socket.SOL_SOCKET, opt, struct.calcsize('3i'))
+    except socket.error:
+        return None
+    return struct.unpack('3i', cred)[1]
+
+def _setenviron(env):
+    """Make env the environment of this process, including the settings that
+    python and mercurial only read at startup (time zone and encoding)."""
+    os.environ.clear()
+    os.environ.update(env)
+    if hasattr(time, 'tzset'):
+        time.tzset()
+    from mercurial import encoding
+    import locale
+    try:
+        locale.setlocale(locale.LC_CTYPE, '')
+        preferred = locale.getpreferredencoding()
+    except locale.Error:
+        preferred = None
+    encoding.encoding = env.get('HGENCODING') or preferred or 'ascii'
+    encoding.encodingmode = env.get('HGENCODINGMODE') or 'strict'
+
+class _server(object):
+    """A tserve server:  keeps the repos of a tree open and runs the commands
+    sent by clients, each in a forked child.
+
+    Before each command, the repos whose files have changed are reopened (see
+    _servestampfiles), so the child sees the current state.  Since each
+    command runs in a child, nothing it does affects the repos kept open."""
+
+    def __init__(self, ui, repo, opts, path):
+        self.ui = ui
+        # Commands run noninteractively (see child()); the repos are opened
+        # with the same settings so that they can be reused (see _openrepo).
+        self.baseui = getattr(repo, 'baseui', ui).copy()
+        self.baseui.setconfig('ui', 'interactive', 'off')
+        self.root = repo.root
+        self.opts = opts
+        self.path = path
+        self.stamps = {}
+        self.sock = None
+
+    def load(self):
+        """Open (and read the commonly used parts of) the repos in the tree."""
+        repo = _openrepo(self.baseui, self.root)
+        for node in _tree(repo.ui, repo, self.opts, strict=False):
+            pass
+        for path, lr in _servedrepos.items():
+            if path not in self.stamps:
+                self.stamps[path] = _repostamp(lr.root)
+                lr['.'].manifestnode()
+                '.hgtags' in lr.dirstate
+
+    def refresh(self):
+        stale = [path for path, lr in _servedrepos.items()
+                 if self.stamps.get(path) != _repostamp(lr.root)]
+        for path in stale:
+            self.ui.debug('reopening %s\n' % path)
+            del _servedrepos[path]
+            del self.stamps[path]
+        if stale:
+            self.load()
+
+    def init(self):
+        global _servedrepos
+        _servedrepos = {}
+        self.load()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the user running the server may connect (see also run()).
+        umask = os.umask(0177)
+        try:
+            self._bind(sock)
+        finally:
+            os.umask(umask)
+        sock.listen(5)
+        self.sock = sock
+        self.ui.status(_('listening on %s\n') % self.path)
+        self.ui.flush()
+
+    def _bind(self, sock):
+        try:
+            sock.bind(self.path)
+        except socket.error, inst:
+            if inst.args[0] != errno.EADDRINUSE:
+                raise error_Abort(_('cannot listen on %s: %s') %
+                                  (self.path, inst.args[-1]))
+            # A stale socket is removed; a live one means a running server.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                probe.close()
+                raise error_Abort(_('a server is already listening on %s') %
+                                  self.path)
+            except socket.error:
+                pass
+            os.unlink(self.path)
+            sock.bind(self.path)
+
+    def run(self):
+        def stop(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            while True:
+                try:
+                    conn = self.sock.accept()[0]
+                except socket.error, inst:
+                    if inst.args[0] == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    uid = _peeruid(conn)
+                    if uid is not None and uid != os.getuid():
+                        self.ui.warn(_('refusing connection from uid %d\n') %
+                                     uid)
+                        continue
+                    n = struct.unpack('>I', _recvall(conn, 4))[0]
+                    args = _recvall(conn, n).split('\0')
+                    n = struct.unpack('>I', _recvall(conn, 4))[0]
+                    env = dict([v.split('=', 1) for v in
+                                _recvall(conn, n).split('\0') if '=' in v])
+                    self.refresh()
+                    if os.fork() == 0:
+                        self.sock.close()
+                        self.child(conn, args[0], args[1:], env)
+                finally:
+                    conn.close()
+                self.reap()
+        finally:
+            self.sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def reap(self):
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except OSError:
+            pass
+
+    def child(self, conn, cwd, args, env):
+        rc = 255
+        relay = None
+        try:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                relay = _relay(conn)
+                sys.stdin = _channelin(relay)
+                os.chdir(cwd)
+                _setenviron(env)
+                ui = self.baseui.copy()
+                ui.fin = sys.stdin
+                ui.setconfig('ui', 'interactive', 'off')
+                extensions.wrapfunction(hg, 'repository', _servedrepository)
+                rc = dispatch.dispatch(dispatch.request(args, ui)) or 0
+                rc &= 255
+            except SystemExit, inst:
+                rc = inst.code or 0
+            except Exception, inst:
+                sys.stderr.write('tserve: %s\n' % inst)
+        finally:
+            try:
+                if relay:
+                    relay.close(rc)
+            finally:
+                os._exit(0)
+
+def _docmd1(cmd, tree, *args, **opts):
+    """Call cmd for each repo in the tree.
+
+    This is for commands which operate on a single tree (e.g., tstatus,
+    tupdate)."""
+    return _docmdnodes(cmd, tree,
+                       lambda sep: ((n, args) for n in tree.walk(sep)), opts)
+
+def _docmdpats(cmd, tree, pats, opts):
+    """Call cmd with file arguments pats in the repos of the tree that own the
+    files (see _routepats), or in each repo if they cannot be routed."""
+    return _docmdnodes(cmd, tree, lambda sep: _treepats(tree, pats, sep), opts)
+
+def _docmdnodes(cmd, tree, nodes, opts):
+    """Call cmd for each (node, args) in nodes(sep), as _docmd1 does."""
+    cmdopts = _cmdopts(opts)
+    jobs = _jobs(tree.ui, opts)
+    if jobs > 1 or _interleave(tree.ui, opts):
+        def workers():
+            for node, args in nodes(None):
+                path, lr, lui = node
+                yield _worker(node, _pcall(lr.root, 'command', cmd),
+                              (lui, lr) + args, cmdopts)
+        return _prun(tree, jobs, workers(), inline=True)
+    rc = 0
+    for (path, lr, lui), args in nodes(lambda: tree.ui.status('\n')):
+        lui.status('[%s]:\n' % lr.root)
+        trc = _pcall(lr.root, 'command', cmd)(lui, lr, *args, **cmdopts)
+        lui.flush()
         rc += trc != None and trc or 0
     return rc
 
+def _urlhost(url):
+    """Return the host named in url, or None for local paths."""
+    m = re.match(r'[a-zA-Z][a-zA-Z0-9+.-]*://([^@/]*@)?(\[[^]/]*\]|[^:/]*)',
+                 url)
+    return m and m.group(2) or None
+
+_mux = None # the _sshmux of the running command, if any
+
+class _sshmux(object):
+    """Share one ssh connection to each host among the repos of a tree.
+
+    Each repo behind an ssh:// url is served by its own 'hg serve --stdio', so
+    a peer cannot be reused from one subtree to the next.  The ssh connection
+    can, though:  with OpenSSH connection multiplexing, a master connection is
+    started for each host the first time it is needed (see start()) and the
+    ssh commands run by mercurial for the repos on that host go through it,
+    without a TCP connection and ssh handshake of their own.
+
+    This is only done if the ssh command is OpenSSH's ssh (the default) and
+    --ssh was not given; it can be disabled by setting sshmux = False in the
+    [trees] section.  If a master cannot be started, ssh connects directly.
+    Once there is an ssh:// url, opts['ssh'] is set to the ssh command that
+    uses the masters.  The masters are closed by close()."""
+
+    def __init__(self, ui, opts):
+        self.ui = ui
+        self.opts = opts
+        self.base = None
+        self.ssh = None
+        self.argv = None
+        self.dir = None
+        self.masters = {} # (user@host, port) -> True if started
+        ssh = ui.config('ui', 'ssh') or 'ssh'
+        if os.name == 'posix' and not opts.get('ssh') and \
+           ui.configbool('trees', 'sshmux', True) and \
+           os.path.basename(ssh.split()[0]) == 'ssh':
+            self.base = ssh
+
+    def start(self, url):
+        """Start a master connection to the host of url if it is an ssh://
+        url and there is not one already.
+
+        The url may come from the tree configuration of a remote repo, so a
+        user or host that ssh could take as an option, or that is not made of
+        plain name characters, is refused (as mercurial's sshargs does)."""
+        m = re.match(r'ssh://(?:([^@/]*)@)?(\[[^]/]*\]|[^:/]*)(?::(\d+))?',
+                     url or '')
+        if not self.base or not m:
+            return
+        user, host, port = m.groups()
+        if not _sshsafe(host) or user is not None and not _sshsafe(user):
+            raise error_Abort(_('potentially unsafe url: %r') % url)
+        if not self.dir:
+            self.dir = tempfile.mkdtemp(prefix='hgtrees')
+            path = os.path.join(self.dir, '%r@%h:%p')
+            self.ssh = "%s -o ControlPath='%s'" % (self.base,
+                                                   path.replace("'", "'\\''"))
+            self.argv = shlex.split(self.base) + ['-o', 'ControlPath=' + path]
+            self.opts['ssh'] = self.ssh
+        if host.startswith('['):
+            host = host[1:-1]
+        target = user and '%s@%s' % (user, host) or host
+        if (target, port) in self.masters:
+            return
+        argv = self.argv + ['-o', 'ControlMaster=yes', '-o', 'ControlPersist=60',
+                            '-f', '-N'] + self._targetargs(target, port)
+        self.ui.debug('starting ssh master: %s\n' % ' '.join(argv))
+        null = open(os.devnull, 'r+')
+        try:
+            rc = subprocess.call(argv, stdin=null, stdout=null)
+        except OSError:
+            rc = 1
+        null.close()
+        self.masters[(target, port)] = not rc
+
+    def _targetargs(self, target, port):
+        args = []
+        if port:
+            args += ['-p', port]
+        return args + ['--', target]
+
+    def close(self):
+        """Close the master connections."""
+        if not self.dir:
+            return
+        null = open(os.devnull, 'r+')
+        for (target, port), started in self.masters.items():
+            if started:
+                try:
+                    subprocess.call(self.argv + ['-O', 'exit'] +
+                                    self._targetargs(target, port),
+                                    stdin=null, stdout=null, stderr=null)
+                except OSError:
+                    pass
+        null.close()
+        shutil.rmtree(self.dir, True)
+        self.dir = None
+
+def _sshsafe(s):
+    """Return True if s (the user or host of an ssh:// url) is safe to pass
+    to ssh and to a shell."""
+    return bool(s) and not s.startswith('-') and \
+           re.match(r'^(\[[0-9a-fA-F:.%]+\]|[\w.%+~-]+)$', s) is not None
+
+def _sshmaster(url):
+    """Start an ssh master for url (see _sshmux) if a command is sharing ssh
+    connections."""
+    if _mux is not None:
+        _mux.start(url)
+
+def _sshmuxed(ui, opts, func, *args):
+    """Call func(*args), sharing the ssh connection to each host among the
+    repos (see _sshmux), which may set opts['ssh']."""
+    global _mux
+    if _mux is not None:
+        return func(*args)
+    _mux = _sshmux(ui, opts)
+    try:
+        return func(*args)
+    finally:
+        m, _mux = _mux, None
+        m.close()
+
+def _noninteractive(cmd, ui, repo, *args, **opts):
+    """Call cmd with prompting disabled, as in a worker there is no terminal."""
+    for u in (ui, repo.ui, getattr(repo, 'baseui', None)):
+        if u:
+            u.setconfig('ui', 'interactive', 'off')
+    return cmd(ui, repo, *args, **opts)
+
+def _readpullcache(repo):
+    """Return the dict of remote state digests saved in repo, keyed by the
+    digest of the remote url."""
+    cache = {}
+    try:
+        f = open(_repo_join(repo, 'trees.pullcache'))
+    except IOError:
+        return cache
+    try:
+        for line in f:
+            l = line.split()
+            if len(l) == 2:
+                cache[l[0]] = l[1]
+    finally:
+        f.close()
+    return cache
+
+def _writepullcache(repo, cache):
+    path = _repo_join(repo, 'trees.pullcache')
+    tmp = path + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        for k in sorted(cache):
+            f.write('%s %s\n' % (k, cache[k]))
+    finally:
+        f.close()
+    util.rename(tmp, path)
+
+def _remotecalls(other):
+    """Return the heads, bookmarks and phases of the peer other, in a single
+    round trip if other can batch commands."""
+    if not other.capable('pushkey'):
+        return other.heads(), {}, {}
+    if getattr(other, 'commandexecutor', None):
+        # hg >= 4.6
+        e = other.commandexecutor()
+        try:
+            l = [e.callcommand('heads', {})]
+            for ns in ('bookmarks', 'phases'):
+                l.append(e.callcommand('listkeys', {'namespace': ns}))
+            e.sendcommands()
+            return tuple([f.result() for f in l])
+        finally:
+            e.close()
+    if getattr(other, 'iterbatch', None):
+        # hg >= 4.1
+        b = other.iterbatch()
+        b.heads()
+        b.listkeys('bookmarks')
+        b.listkeys('phases')
+        b.submit()
+        return tuple(b.results())
+    return other.heads(), other.listkeys('bookmarks'), other.listkeys('phases')
+
+def _remotestate(ui, repo, url, opts):
+    """Return (digest, known, peer) for the remote repo at url.
+
+    The digest covers the heads, bookmarks and phase roots of the remote repo;
+    known is true if all of the heads are present in repo.  The peer is left
+    open so that the pull, if needed, can use it (see _handoffpeer)."""
+    other = hg_repo(ui, url, opts)
+    other = getattr(other, 'peer', None) and other.peer() or other
+    try:
+        heads, bookmarks, phases = _remotecalls(other)
+    except:
+        _closepeer(other)
+        raise
+    known = True
+    for h in heads:
+        try:
+            repo.changelog.rev(h)
+        except error.LookupError:
+            known = False
+            break
+    l = [hex(h) for h in sorted(heads)]
+    for ns, keys in (('bookmarks', bookmarks), ('phases', phases)):
+        for k in sorted(keys):
+            l.append('%s %s %s' % (ns, k, keys[k]))
+    return sha1('\n'.join(l)).hexdigest(), known, other
+
+def _closepeer(other):
+    if hasattr(other, 'close'):
+        other.close()
+
+_handoff = None # (url, peer) for the next hg.peer(url), see _handoffpeer
+
+def _handoffpeer(orig, uiorrepo, opts, path, *args, **kwargs):
+    """Wraps hg.peer so that the pull (or incoming) run by _cachedpull gets
+    the peer already opened by _remotestate instead of connecting again."""
+    global _handoff
+    if _handoff is not None and _handoff[0] == path:
+        other, _handoff = _handoff[1], None
+        return other
+    return orig(uiorrepo, opts, path, *args, **kwargs)
+
+_handoffwrapped = False
+
+def _cachedpull(ui, cmd, incoming=False):
+    """Return a wrapper for the pull (or incoming) command cmd which skips the
+    repo if the state of the remote repo matches the one seen the last time.
+
+    This is done only if [trees] pullcache is set in ui (the ui of the root
+    repo, as the other repos do not read its hgrc).  For incoming, the state
+    is saved only if nothing was found."""
+    if not ui.configbool('trees', 'pullcache', False):
+        return cmd
+    def run(ui, repo, remote, **opts):
+        if [o for o in ('rev', 'bookmark', 'branch', 'force') if opts.get(o)]:
+            return cmd(ui, repo, remote, **opts)
+        global _handoff, _handoffwrapped
+        url = ui.expandpath(remote or 'default')
+        key = sha1(url).hexdigest()
+        try:
+            state, known, other = _remotestate(ui, repo, url, opts)
+        except (error.RepoError, error_Abort, IOError), inst:
+            # Let the command itself report the problem.
+            ui.debug('cannot get the state of %s: %s\n' %
+                     (util.hidepassword(url), inst))
+            return cmd(ui, repo, remote, **opts)
+        cache = _readpullcache(repo)
+        if known and cache.get(key) == state:
+            _closepeer(other)
+            if incoming:
+                ui.status(_('comparing with %s\n') % util.hidepassword(url))
+            else:
+                ui.status(_('pulling from %s\n') % util.hidepassword(url))
+            ui.status(_('no changes found (remote heads unchanged)\n'))
+            return int(incoming)
+        if not _handoffwrapped and getattr(hg, 'peer', None):
+            extensions.wrapfunction(hg, 'peer', _handoffpeer)
+            _handoffwrapped = True
+        if _handoffwrapped:
+            _handoff = (hg.parseurl(url)[0], other)
+        else:
+            _closepeer(other)
+        try:
+            rc = cmd(ui, repo, remote, **opts)
+        finally:
+            if _handoff is not None:
+                _closepeer(_handoff[1])
+                _handoff = None
+        if not incoming or rc == 1:
+            cache[key] = state
+            _writepullcache(repo, cache)
+        return rc
+    return run
+
+def _remoteof(remote, adjust, path):
+    return adjust and path and os.path.join(remote, path) or remote
+
+def _remoteurl(ui, remote):
+    return ui.expandpath(remote or 'default-push', remote or 'default')
+
+def _docmd2(cmd, tree, remote, adjust, **opts):
+    """Call cmd for each repo in the tree.
+
+    This is for commands which operate on two trees (e.g., tpull, tpush).  If
+    adjust is true, the path of each subtree is appended to remote.
+
+    With --jobs, the repos are also grouped by the remote host they talk to,
+    and at most [trees] hostjobs of them (if set) run at once for any one
+    host.  Repos on the same ssh:// host share one ssh connection (see
+    _sshmux)."""
+
+    cmdopts = _cmdopts(opts)
+    def remoteof(path):
+        return _remoteof(remote, adjust, path)
+    def urlof(lui, path):
+        return _remoteurl(lui, remoteof(path))
+    jobs = _jobs(tree.ui, opts)
+    if jobs > 1 or _interleave(tree.ui, opts):
+        def workers():
+            for node in tree:
+                path, lr, lui = node
+                url = urlof(lui, path)
+                _sshmaster(url)
+                yield _worker(node, _pcall(lr.root, 'exchange',
+                                           _noninteractive),
+                              (cmd, lui, lr, remoteof(path)), cmdopts,
+                              _urlhost(url))
+        hostjobs = tree.ui.configint('trees', 'hostjobs', 0)
+        return _sshmuxed(tree.ui, cmdopts, _prun, tree, jobs, workers(),
+                         hostjobs, False, True)
+    def run():
+        rc = 0
+        for path, lr, lui in tree.walk(lambda: tree.ui.status('\n')):
+            lui.status('[%s]:\n' % lr.root)
+            _sshmaster(urlof(lui, path))
+            trc = _pcall(lr.root, 'exchange', cmd)(lui, lr, remoteof(path),
+                                                   **cmdopts)
+            lui.flush()
+            rc += trc != None and trc or 0
+        return rc
+    return _sshmuxed(tree.ui, cmdopts, run)
+
+def _pullrepo(cmd, ui, repo, remote, **opts):
+    """Pull into repo in a worker; return (rc, number of changesets added,
+    arguments of postincoming).
+
+    The working directory is updated afterwards (see _pullupdate), so the hints
+    to update or merge it are not shown, as with pull --update.  The checkout
+    computed by pull (from --rev, --branch or the #branch of the url) is
+    captured from its call to postincoming, for _updaterepo."""
+    hints = (_("(run 'hg update' to get a working copy)\n"),
+             _("(run 'hg heads' to see heads, 'hg merge' to merge)\n"),
+             _("(run 'hg heads .' to see heads, 'hg merge' to merge)\n"),
+             _("(run 'hg heads' to see heads)\n"))
+    status = ui.status
+    def nohint(*msg, **opts):
+        if len(msg) != 1 or msg[0] not in hints:
+            status(*msg, **opts)
+    ui.status = nohint
+    incoming = []
+    postincoming = commands.postincoming
+    def capture(ui, repo, modheads, optupdate, *args):
+        incoming.append((modheads,) + args)
+        return postincoming(ui, repo, modheads, False, *args)
+    commands.postincoming = capture
+    try:
+        n = len(repo)
+        rc = _noninteractive(cmd, ui, repo, remote, **opts)
+    finally:
+        commands.postincoming = postincoming
+    return rc, len(repo) - n, incoming and incoming[0] or None
+
+def _updaterepo(cmd, ui, repo, rev, incoming):
+    """Update repo in a worker, after a _pullrepo, as pull --update would (or to
+    rev, if the pull did not call postincoming)."""
+    # The changelog of repo was read before the pull.
+    repo = hg.repository(getattr(repo, 'baseui', ui), repo.root)
+    repo.ui.setconfig('ui', 'interactive', 'off')
+    if incoming is not None:
+        modheads, args = incoming[0], incoming[1:]
+        return commands.postincoming(repo.ui, repo, modheads, True, *args)
+    return _update1(cmd, repo.ui, repo, rev=rev)
+
+def _pullupdate(cmd, tree, remote, adjust, **opts):
+    """Run tpull -u with --jobs (or --interleave) as a two-stage pipeline.
+
+    Each repo is pulled (by cmd) without updating it, and as soon as the pull
+    is done, the working directory is updated by a separate worker (if any
+    changesets were added), while later repos are still being pulled.  The
+    update workers go ahead of the pending pulls.  The output of each repo
+    (pull, then update) is shown as usual.  The repos which were left with
+    unresolved files are listed at the end."""
+    cmdopts = _cmdopts(opts)
+    cmdopts['update'] = False
+    rev = opts.get('rev') and opts['rev'][0] or None
+    jobs = _jobs(tree.ui, opts)
+    interleave = _interleave(tree.ui, opts)
+    pool = _pool(jobs, tree.ui.configint('trees', 'hostjobs', 0))
+    entries = [] # [node, workers, exception, done] in tree order
+    unresolved = []
+    rc = [0]
+    def show(entry, w):
+        node = entry[0]
+        path, lr, lui = node
+        if interleave:
+            w.replay(lui, _shortpaths(tree.repo.root, [lr.root])[0] + ': ')
+        else:
+            if path:
+                lui.status('\n')
+            lui.status('[%s]:\n' % lr.root)
+            for w in entry[1]:
+                w.replay(lui)
+        lui.flush()
+    def finish(entry, w):
+        entry[3] = True
+        if interleave and w is not None:
+            show(entry, w)
+        while entries and entries[0][3]:
+            entry = entries.pop(0)
+            if entry[2] is not None:
+                if not interleave:
+                    tree.ui.status('\n')
+                raise entry[2]
+            if not interleave:
+                show(entry, None)
+            for w in entry[1]:
+                if w.exc:
+                    raise w.exc
+            if len(entry[1]) > 1 and entry[1][1].result:
+                unresolved.append(entry[0][1].root)
+    def run():
+        it = iter(tree)
+        exhausted = False
+        while True:
+            while not (exhausted or pool.full()):
+                try:
+                    node = it.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                except Exception, inst:
+                    # Raised by finish after the output of the repos before.
+                    entries.append([None, [], inst, False])
+                    exhausted = True
+                    finish(entries[-1], None)
+                    break
+                path, lr, lui = node
+                url = _remoteurl(lui, _remoteof(remote, adjust, path))
+                _sshmaster(url)
+                entry = [node, [], None, False]
+                w = _worker(entry, _pcall(lr.root, 'exchange', _pullrepo),
+                            (cmd, lui, lr, _remoteof(remote, adjust, path)),
+                            cmdopts, _urlhost(url))
+                entry[1].append(w)
+                entries.append(entry)
+                pool.submit(w)
+            if not (pool.running or pool.pending):
+                break
+            for w in pool.wait():
+                entry = w.data
+                path, lr, lui = entry[0]
+                if len(entry[1]) == 1 and not w.exc:
+                    trc, added, incoming = w.result
+                    if added:
+                        u = _worker(entry, _pcall(lr.root, 'update',
+                                                  _updaterepo),
+                                    (_origcmd('update'), lui, lr, rev,
+                                     incoming))
+                        entry[1].append(u)
+                        pool.submit(u, True)
+                    rc[0] += trc or 0
+                    if added:
+                        if interleave:
+                            show(entry, w)
+                        continue
+                elif not w.exc and w.result and not entry[1][0].result[0]:
+                    rc[0] += 1
+                finish(entry, w)
+    try:
+        _sshmuxed(tree.ui, cmdopts, run)
+    except:
+        pool.cancel()
+        raise
+    if unresolved:
+        tree.ui.warn(_('\nrepos with unresolved files:\n'))
+        for path in _shortpaths(tree.repo.root, unresolved):
+            tree.ui.warn('  %s\n' % path)
+    return rc[0]
+
+def _repoinfo(repo, pats=()):
+    """Return a dict describing the working dir state of repo (for -Tjson).
+
+    If pats is None, none of the files asked for are in repo, so the file
+    counts are all zero."""
+    if pats is None:
+        st = [[]] * 5
+    else:
+        match = None
+        if pats:
+            match = scmutil and scmutil.match(repo[None], pats) or \
+                    cmdutil.match(repo, pats)
+        st = repo.status(match=match, unknown=True)
+    ctx = repo[None]
+    d = {'root': repo.root,
+         'branch': ctx.branch(),
+         'parents': [p.hex() for p in ctx.parents()],
+         'heads': [repo[h].hex() for h in repo.heads()],
+         'tip': repo['tip'].hex()}
+    for i, k in enumerate(('modified', 'added', 'removed', 'deleted',
+                           'unknown')):
+        d[k] = len(st[i])
+    return d
+
+def _treejson(tree, pats=(), **opts):
+    """Write a single JSON object describing each repo in the tree.
+
+    The object is keyed by the short path of each repo, in tree order.  With
+    --jobs, the repos are examined concurrently.  File arguments are routed to
+    the repos that own them (see _routepats); the others count no files."""
+    info = []
+    routes = _routepats(tree, pats)
+    if routes is not None:
+        routes = dict(routes)
+    def repopats(i):
+        if routes is None:
+            return pats
+        return routes.get(i)
+    jobs = _jobs(tree.ui, opts)
+    if jobs > 1:
+        def workers():
+            for i, node in enumerate(tree):
+                yield _worker(node, _repoinfo, (node[1], repopats(i)))
+        def done(w):
+            if w.data:
+                w.replay(tree.ui)
+            if w.exc:
+                raise w.exc
+            info.append((w.data[1].root, w.result))
+        _runordered(jobs, workers(), done, inline=True)
+    else:
+        for i, (path, lr, lui) in enumerate(tree):
+            info.append((lr.root, _repoinfo(lr, repopats(i))))
+    paths = _shortpaths(tree.repo.root, [root for root, d in info])
+    l = []
+    for path, (root, d) in zip(paths, info):
+        l.append(' %s: %s' % (templatefilters.json(path),
+                              templatefilters.json(d)))
+    tree.ui.write('{\n%s\n}\n' % ',\n'.join(l))
+    return 0
+
 def _makeparentdir(path):
     if path:
         pdir = os.path.split(path.rstrip(os.sep + '/'))[0]
         if pdir and not os.path.exists(pdir):
             os.makedirs(pdir)
 
+_origcmds = {} # command name -> callable, see _origcmd
+
 def _origcmd(name):
-    """Return the callable mercurial will invoke for the given command name."""
-    return cmdutil.findcmd(name, commands.table)[1][0]
+    """Return the callable mercurial will invoke for the given command name.
+
+    The command table does not change once the extensions are set up, so the
+    lookup is done once per process."""
+    cmd = _origcmds.get(name)
+    if cmd is None:
+        cmd = _origcmds[name] = cmdutil.findcmd(name, commands.table)[1][0]
+    return cmd
 
 def _shortpaths(root, subtrees):
     l = []
@@ -371,12 +2319,93 @@ def _subtreejoin(repo, subtree):
     u = _stripfilescheme(repo.url()).rstrip('/')
     return u + '/' + subtree
 
+def _scandir(path):
+    """Return a list of (name, isdir, islink) tuples for the entries in path.
+
+    isdir is True only for real directories, not symbolic links to them.  Uses
+    scandir (which usually needs no stat() calls) if it is available, otherwise
+    a single lstat() per entry."""
+    try:
+        if _scandirfunc:
+            return [(e.name, e.is_dir(follow_symlinks=False), e.is_symlink())
+                    for e in _scandirfunc(path)]
+        names = os.listdir(path)
+    except OSError:
+        return []
+    l = []
+    lstat = os.lstat
+    prefix = os.path.join(path, '')
+    for name in names:
+        try:
+            mode = lstat(prefix + name).st_mode
+        except OSError:
+            continue
+        l.append((name, stat.S_ISDIR(mode), stat.S_ISLNK(mode)))
+    return l
+
+def _scanlevel(dirs, threads):
+    """Return the _scandir results for each of dirs, using up to threads
+    threads if there are enough dirs to make it worthwhile."""
+    if threads <= 1 or len(dirs) < 2 * threads:
+        return [_scandir(d) for d in dirs]
+    results = [None] * len(dirs)
+    def scan(first):
+        for i in xrange(first, len(dirs), threads):
+            results[i] = _scandir(dirs[i])
+    l = [threading.Thread(target=scan, args=(i,)) for i in xrange(threads)]
+    for t in l:
+        t.start()
+    for t in l:
+        t.join()
+    return results
+
 def _walk(ui, repo, opts):
+    """Return the sorted list of repos found below the root of repo.
+
+    Like os.walk(), this does not follow symbolic links to directories (though
+    a symlinked .hg counts) and never descends into .hg.  The search is breadth
+    first, one directory level at a time, so that wide levels can be scanned
+    by several threads ([trees] walkthreads).  It can also be limited:
+
+    - --maxdepth N stops after N directory levels below the root;
+    - [trees] walkskip lists glob patterns for directories (names or paths
+      relative to the root) that are known not to contain repos;
+    - [trees] walkignored = False skips directories ignored by repo."""
+    maxdepth = opts.get('maxdepth') or 0
+    skip = ui.configlist('trees', 'walkskip', [])
+    threads = ui.configint('trees', 'walkthreads', 1)
+    ignore = None
+    if not ui.configbool('trees', 'walkignored', True):
+        ignore = getattr(repo.dirstate, '_ignore', None)
     l = []
-    for dirpath, subdirs, files in os.walk(repo.root, True):
-        if '.hg' in subdirs:
-            subdirs.remove('.hg')
-            l += [dirpath]
+    level = [(repo.root, '')]
+    depth = 0
+    while level:
+        scanned = _scanlevel([d for d, rel in level], threads)
+        sublevel = []
+        for (dirpath, rel), entries in zip(level, scanned):
+            for name, isdir, islink in entries:
+                if name == '.hg':
+                    if isdir or islink and \
+                       os.path.isdir(os.path.join(dirpath, name)):
+                        l.append(dirpath)
+                    continue
+                if not isdir:
+                    continue
+                subrel = rel and rel + '/' + name or name
+                skipped = False
+                for pat in skip:
+                    if fnmatch.fnmatch(name, pat) or \
+                       fnmatch.fnmatch(subrel, pat):
+                        skipped = True
+                        break
+                if skipped or ignore and ignore(subrel):
+                    continue
+                sublevel.append((os.path.join(dirpath, name), subrel))
+        if maxdepth and depth >= maxdepth:
+            break
+        level = sublevel
+        depth += 1
     return sorted(l)
 
 def _readfile(path):
@@ -403,63 +2432,456 @@ def _writeconfig(repo, namespace, subtrees, append = False):
     if subtrees:
         newconfig = '\n'.join(subtrees) + '\n'
         if append or newconfig != _readfile(confpath):
-            f = open(confpath, append and 'a' or 'w')
+            # Replace the file in one step, so that an interrupted write
+            # cannot leave a partial configuration behind.
+            path = append and confpath or confpath + '.tmp'
+            f = open(path, append and 'a' or 'w')
             try:
                 f.write(newconfig)
             finally:
                 f.close()
+            if not append:
+                util.rename(path, confpath)
     elif os.path.exists(confpath):
         os.remove(confpath)
     return 0
 
 # ---------------- commands and associated recursion helpers -------------------
 
-def _clonerepo(ui, source, dest, opts):
+def _clonerepo(ui, source, dest, opts, path=''):
+    """Clone source to dest, which is at path in the tree being cloned.
+
+    With --reference, the repo at the same path in the reference tree (if any)
+    is copied instead, and the rest pulled from source (see _refclone).  With
+    --share-pool, dest shares a store kept in the pool."""
     _makeparentdir(dest)
+    _sshmaster(source)
+    update = opts.get('updaterev') or not opts.get('noupdate')
+    ref = opts.get('reference')
+    if ref:
+        ref = path and os.path.join(ref, path) or ref
+        if os.path.isdir(os.path.join(ref, '.hg')):
+            return _refclone(ui, source, dest, ref, update, opts)
+    kwargs = {}
+    if opts.get('share_pool'):
+        kwargs['shareopts'] = {
+            'pool': os.path.abspath(util.expandpath(opts['share_pool'])),
+            'mode': ui.config('share', 'poolnaming', 'identity')}
     # Copied from mercurial/hg.py; need the returned dest repo.
     s, d = hg_clone(ui, opts, source, dest,
                     pull=opts.get('pull'),
                     stream=opts.get('uncompressed'),
                     revs=opts.get('rev'),
-                    update=opts.get('updaterev') or not opts.get('noupdate'),
-                    branch=opts.get('branch'))
+                    update=update,
+                    branch=opts.get('branch'), **kwargs)
     if isinstance(s, localrepo.localrepository) or isinstance(d.local(), bool):
         return (s, d)
     # peers; return the destination localrepo
     return (s, d.local())
 
+def _refclone(ui, source, dest, ref, update, opts):
+    """Clone source to dest by copying the local repo ref (hardlinking the
+    store where possible) and pulling only the missing changesets from source.
+
+    The default path of dest is source, as if it had been cloned from it."""
+    ui.status(_('copying from reference %s\n') % ref)
+    s, d = hg_clone(ui, opts, ref, dest, update=False)
+    if not isinstance(d, localrepo.localrepository):
+        d = d.local()
+    if hg.islocal(source) and '://' not in source:
+        default = os.path.abspath(source)
+    elif getattr(util, 'url', None):
+        u = util.url(source)
+        u.passwd = None
+        default = str(u)
+    else:
+        default = source
+    f = getattr(d, 'vfs', None) and d.vfs('hgrc', 'w') or d.opener('hgrc', 'w')
+    try:
+        f.write('[paths]\ndefault = %s\n' % default)
+    finally:
+        f.close()
+    dst = hg.repository(ui, d.root)
+    source, branches = hg.parseurl(source, opts.get('branch'))
+    src = hg_repo(ui, source, opts)
+    other = getattr(src, 'peer', None) and src.peer() or src
+    revs, checkout = hg.addbranchrevs(dst, other, branches, opts.get('rev'))
+    heads = revs and [other.lookup(rev) for rev in revs] or None
+    ui.status(_('pulling from %s\n') % util.hidepassword(source))
+    if exchange:
+        exchange.pull(dst, other, heads)
+    else:
+        dst.pull(other, heads)
+    _stripextra(ui, dst, heads or other.heads())
+    if update:
+        # As clone does:  the given revision, else the first one pulled, else
+        # the @ bookmark or the tip of the default branch.
+        candidates = ['@', 'default', 'tip']
+        if update is not True:
+            candidates = [update]
+        elif checkout:
+            candidates = [checkout] + candidates
+        for rev in candidates:
+            try:
+                node = dst.lookup(rev)
+                break
+            except error.RepoError:
+                pass
+        else:
+            raise error_Abort(_("unknown revision '%s'") % rev)
+        dst.ui.status(_('updating to branch %s\n') % dst[node].branch())
+        hg.update(dst, node)
+    return (src, dst)
+
+def _stripextra(ui, repo, heads):
+    """Strip the changesets of repo that are not ancestors of heads, i.e.,
+    those copied from a reference repo that the source does not have (or that
+    are outside --rev), so that they cannot be pushed later."""
+    repo = getattr(repo, 'unfiltered', None) and repo.unfiltered() or repo
+    cl = repo.changelog
+    keep = set(cl.nodesbetween(None, heads)[0])
+    extra = [cl.node(r) for r in xrange(len(cl)) if cl.node(r) not in keep]
+    if not extra:
+        return
+    ui.status(_('removing %d changesets not in the source\n') % len(extra))
+    from mercurial import repair
+    wlock = repo.wlock()
+    try:
+        lock = repo.lock()
+        try:
+            if inspect.getargspec(repair.strip)[0][2] == 'nodelist':
+                repair.strip(ui, repo, extra, backup=False)
+            else:
+                # hg < 1.9: one changeset (and its descendants) at a time
+                extraset = set(extra)
+                for n in extra:
+                    if not [p for p in cl.parents(n) if p in extraset]:
+                        repair.strip(ui, repo, n, backup='none')
+        finally:
+            lock.release()
+    finally:
+        wlock.release()
+
+class _pathrepo(object):
+    """Stands in for a source repo that is not opened; only its url is used."""
+    def __init__(self, ui, path):
+        self.ui = ui
+        self._path = path
+    def peer(self):
+        return self
+    def local(self):
+        return self._path
+    def url(self):
+        return self._path
+    def wjoin(self, path):
+        return os.path.join(self._path, path)
+
 def _skiprepo(ui, source, dest):
     src = None
     try:
         src = hg_repo(ui, source, {})
     except:
-        class fakerepo(object):
-            def __init__(self, ui, path):
-                self.ui = ui
-                self._path = path
-            def peer(self):
-                return self
-            def local(self):
-                return self._path
-            def url(self):
-                return self._path
-            def wjoin(self, path):
-                return os.path.join(self._path, path)
-        src = fakerepo(ui, source)
+        src = _pathrepo(ui, source)
     return (src, hg.repository(ui, dest))
 
-def _clonesubtrees(ui, src, dst, opts):
+def _manifest(ui, src, opts):
+    """Return the subtrees of each repo in the tree of src, as a dict mapping
+    the path of each repo (relative to src, '' for src itself) to the list of
+    its subtrees, from a single listkeys request (see genrecursivekeys).
+
+    The manifest only describes the tree of src:  m[None] is the url of src,
+    see _inmanifest.  Return None if src does not provide the recursive
+    namespace, or if what it provides is not valid."""
+    try:
+        keys = src.listkeys(_recursivens(_ns(ui, opts)))
+    except:
+        return None
+    if keys.get('v') != '1':
+        return None
+    m = {'': []}
+    paths = []
+    try:
+        for i in xrange(len(keys) - 1):
+            parent, subtree = keys[str(i)].split(' ', 1)
+            parent = int(parent)
+            if parent < -1 or parent >= i or not _safesubtree(subtree):
+                raise ValueError(keys[str(i)])
+            base = parent >= 0 and paths[parent] or ''
+            path = base and base + '/' + subtree or subtree
+            m[base].append(subtree)
+            m.setdefault(path, [])
+            paths.append(path)
+    except (KeyError, ValueError), inst:
+        ui.debug('ignoring invalid recursive tree configuration of %s: %s\n'
+                 % (src.url(), inst))
+        return None
+    m[None] = _stripfilescheme(src.url()).rstrip('/')
+    ui.debug('using the recursive tree configuration of %s\n' % src.url())
+    return m
+
+def _inmanifest(manifest, url, path):
+    """Return True if manifest (see _manifest) gives the subtrees of the repo at
+    path in the tree, cloned from url.
+
+    Subtrees given on the command line may come from another url; the manifest
+    does not describe those."""
+    if manifest is None or path not in manifest:
+        return False
+    base = manifest[None]
+    return _stripfilescheme(url).rstrip('/') == (path and base + '/' + path or
+                                                 base)
+
+def _levelmanifest(ui, src, opts, path=''):
+    """Like _manifest, but reads the configuration of each repo in turn."""
+    m = {path: []}
+    for r, subtree in _subtreegen(ui, src, opts):
+        m[path].append(subtree)
+        sub = path and path + '/' + subtree or subtree
+        if sub not in m:
+            m.update(_levelmanifest(ui, hg_repo(ui, _subtreejoin(r, subtree),
+                                                opts), opts, sub))
+    return m
+
+def _manifestpaths(m, path=''):
+    """Return the paths of the repos below path in m, in tree order."""
+    l = []
+    for subtree in m.get(path, []):
+        sub = path and path + '/' + subtree or subtree
+        if sub not in l:
+            l.append(sub)
+            l.extend([p for p in _manifestpaths(m, sub) if p not in l])
+    return l
+
+def _subtreepairs(src, dst, opts, manifest, path):
+    """Return (repo, subtree) pairs for the subtrees of src, which is at path in
+    the tree being cloned to dst.  If manifest (see _manifest) lists the repo,
+    src is not asked for its configuration."""
+    start = _pstart()
+    if _inmanifest(manifest, src.url(), path) and not opts.get('subtrees'):
+        l = [(src, subtree) for subtree in manifest[path]]
+    else:
+        l = __builtin__.list(_subtreegen(src.ui, src, opts))
+    _pstop(start, dst.root, 'config')
+    return l
+
+def _clonesubtrees(ui, src, dst, opts, manifest=None, path=''):
     subtrees = []
-    for src, subtree in _subtreegen(src.ui, src, opts):
+    pairs = _subtreepairs(src, dst, opts, manifest, path)
+    for src, subtree in pairs:
+        _journal.plan(path and path + '/' + subtree or subtree)
+    for src, subtree in pairs:
         ui.status('\n')
-        _clone(ui, _subtreejoin(src, subtree), dst.wjoin(subtree), opts)
+        _clone(ui, _subtreejoin(src, subtree), dst.wjoin(subtree), opts,
+               manifest=manifest, path=path and path + '/' + subtree or subtree)
         subtrees.append(subtree)
     return subtrees
 
-def _clone(ui, source, dest, opts, skiproot = False):
-    if not skiproot and not os.path.exists(os.path.join(dest, '.hg')):
+_journal = None # the _clonejournal of the running tclone, if any
+
+class _clonejournal(object):
+    """Record the progress of tclone in .hg/trees.clonejournal of the root.
+
+    Each line gives the state (plan, start or done) of the repo at a path in
+    the tree ('.' for the root), the last line for a path being the current
+    one.  The configuration of the subtrees is only written (by finish) once
+    all the repos have been cloned (or, with --jobs, all that could be), after
+    which the journal is removed.
+
+    If tclone is interrupted, the journal is left behind, and tclone --resume
+    clones the outstanding repos, removing any that were started but not
+    finished, and skips the others."""
+
+    def __init__(self, root):
+        self.path = os.path.join(root, '.hg', 'trees.clonejournal')
+        self.state = {}
+        self.configs = [] # (dst repo, subtrees) to write when done
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        try:
+            for line in f:
+                line = line.rstrip('\n')
+                if ' ' in line:
+                    state, path = line.split(' ', 1)
+                    self.state[path] = state
+        finally:
+            f.close()
+
+    def resuming(self):
+        return bool(self.state)
+
+    def record(self, state, path):
+        path = path or '.'
+        if self.state.get(path) == state:
+            return
+        self.state[path] = state
+        f = open(self.path, 'a')
+        try:
+            f.write('%s %s\n' % (state, path))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def plan(self, path):
+        if path not in self.state:
+            self.record('plan', path)
+
+    def start(self, ui, dest, path):
+        """Note that dest (at path) is about to be cloned; return False if it
+        need not be, as the destination exists.
+
+        'start' is only recorded right before cloning into a destination that
+        does not exist, so the only directories removed (those left by an
+        earlier attempt that did not finish) were created by tclone.  An
+        existing destination is recorded as done."""
+        if self.state.get(path or '.') == 'start' and os.path.exists(dest):
+            ui.status(_('removing partial clone %s\n') % dest)
+            shutil.rmtree(dest)
+        if os.path.exists(os.path.join(dest, '.hg')):
+            self.record('done', path)
+            return False
+        self.record('start', path)
+        return True
+
+    def writeconfigs(self, ui, opts):
+        for dst, subtrees in self.configs:
+            l = _subtreelist(ui, dst, opts)
+            if [st for st in l if st not in subtrees]:
+                addconfig(ui, dst, subtrees, opts, True)
+            else:
+                # Resuming; keep the order of the source.
+                _writeconfig(dst, _ns(ui, opts), subtrees)
+        self.configs = []
+
+    def finish(self, ui, opts):
+        self.writeconfigs(ui, opts)
+        os.unlink(self.path)
+
+def _clone1(ui, source, dest, opts, path):
+    """Clone a single repo (but not its subtrees) in a worker process."""
+    ui.setconfig('ui', 'interactive', 'off')
+    if not _journal.start(ui, dest, path):
+        ui.status('skipping %s (destination exists)\n' % source)
+    else:
+        ui.status('cloning %s\n' % source)
+        src, dst = _clonerepo(ui, source, dest, opts, path)
+        ui.status(_('created %s\n') % dst.root)
+
+def _pclonesubtrees(ui, src, dst, opts, jobs, manifest=None):
+    """Clone the subtrees of dst with up to jobs clones running concurrently.
+
+    Siblings are cloned in parallel, but the subtrees of a repo are not started
+    until the repo itself exists (and are skipped if it could not be cloned).
+    The output of each clone is shown as it finishes (with --interleave,
+    prefixed by the path of the subtree); failures are listed at the end.  The
+    configuration of each repo lists the successfully cloned subtrees in their
+    configured order."""
+    pool = _pool(jobs, ui.configint('trees', 'hostjobs', 0))
+    interleave = _interleave(ui, opts)
+    top = dst.root
+    configs = [] # (dst repo, [[subtree, cloned], ...])
+    failed = []
+    skipped = [] # (source, source of the repo that failed)
+    started = {} # dest -> config entries satisfied by the clone of dest
+    waiting = {} # dest -> nested subtrees to submit once dest is cloned
+    finished = {} # dest -> True if cloned successfully
+    def submit(source, dest, entry, path):
+        # A subtree can be reached from more than one repo, e.g. s/t can be
+        # listed both by the repo containing s and by s itself.
+        if dest in finished:
+            entry[1] = finished[dest]
+            return
+        if dest in started:
+            started[dest].append(entry)
+            return
+        started[dest] = [entry]
+        _sshmaster(source)
+        pool.submit(_worker((source, dest, path),
+                            _pcall(os.path.realpath(dest), 'clone', _clone1),
+                            (ui, source, dest, opts, path),
+                            group=_urlhost(source)))
+    def plan(src, dst, path):
+        l = []
+        for r, subtree in _subtreepairs(src, dst, opts, manifest, path):
+            entry = [subtree, False]
+            args = (_subtreejoin(r, subtree), dst.wjoin(subtree), entry,
+                    path and path + '/' + subtree or subtree)
+            _journal.plan(args[3])
+            parent = ''
+            for st, cloned in l:
+                if subtree.startswith(st + '/') and len(st) > len(parent):
+                    parent = st
+            if parent:
+                waiting.setdefault(dst.wjoin(parent), []).append(args)
+            else:
+                submit(*args)
+            l.append(entry)
+        configs.append((dst, l))
+    def skip(dest, source):
+        # The subtrees nested in a repo that failed are not cloned.
+        for args in waiting.pop(dest, []):
+            skipped.append((args[0], source))
+            finished[args[1]] = False
+            skip(args[1], source)
+    try:
+        plan(src, dst, '')
+        while pool.running or pool.pending:
+            for w in pool.wait():
+                source, dest, path = w.data
+                if interleave:
+                    w.replay(ui, _shortpaths(top, [dest])[0] + ': ')
+                else:
+                    ui.status('\n')
+                    w.replay(ui)
+                finished[dest] = not w.exc
+                if w.exc:
+                    failed.append((source, w.exc))
+                    skip(dest, source)
+                else:
+                    _journal.record('done', path)
+                    for entry in started[dest]:
+                        entry[1] = True
+                    if _inmanifest(manifest, source, path):
+                        # No need to contact the source.
+                        plan(_pathrepo(ui, source), hg.repository(ui, dest),
+                             path)
+                    else:
+                        plan(*_skiprepo(ui, source, dest) + (path,))
+                for args in waiting.pop(dest, []):
+                    submit(*args)
+    except:
+        pool.cancel()
+        raise
+    for dst, l in configs:
+        _journal.configs.append((dst, [st for st, cloned in l if cloned]))
+    if failed:
+        # Keep the journal, but let the repos that were cloned be used.
+        _journal.writeconfigs(ui, opts)
+        ui.status('\n')
+        for source, inst in failed:
+            ui.warn(_('failed to clone %s: %s\n') % (source, inst))
+        for source, parent in skipped:
+            ui.warn(_('skipped %s (%s could not be cloned)\n') %
+                    (source, parent))
+        raise error_Abort(_('%d subtrees could not be cloned') % len(failed))
+
+def _clone(ui, source, dest, opts, skiproot = False, manifest=None, path=''):
+    global _journal
+    root = os.path.realpath(dest)
+    if _profile is not None and not _profile.top:
+        _profile.top = root
+    if skiproot:
+        exists = True
+    elif _journal is not None:
+        exists = not _journal.start(ui, dest, path)
+    else:
+        exists = os.path.exists(os.path.join(dest, '.hg'))
+    if not exists:
         ui.status('cloning %s\n' % source)
-        src, dst = _clonerepo(ui, source, dest, opts)
+        src, dst = _pcall(root, 'clone', _clonerepo)(ui, source, dest, opts,
+                                                     path)
         ui.status(_('created %s\n') % dst.root)
     else:
         msg = 'skipping %s (destination exists)\n'
@@ -467,16 +2889,58 @@ def _clone(ui, source, dest, opts, skiproot = False):
             msg = 'skipping root %s\n'
         ui.status(msg % source)
         src, dst = _skiprepo(ui, source, dest)
-    subtrees = _clonesubtrees(ui, src, dst, opts)
-    addconfig(ui, dst, subtrees, opts, True)
+    top = _journal is None
+    if top:
+        _journal = _clonejournal(dst.root)
+    _journal.record('done', path)
+    if not path:
+        # Learn the whole tree at once if the source can tell.
+        start = _pstart()
+        manifest = _manifest(ui, src, opts)
+        _pstop(start, root, 'config')
+    jobs = _jobs(ui, opts)
+    if jobs > 1 or _interleave(ui, opts):
+        _pclonesubtrees(ui, src, dst, opts, jobs, manifest)
+    else:
+        subtrees = _clonesubtrees(ui, src, dst, opts, manifest, path)
+        _journal.configs.append((dst, subtrees))
+    if top:
+        _journal.finish(ui, opts)
 
 # Need to indirect through hg_clone for compatibility w/various hg versions.
 hg_clone = None
 
 @command("^tclone", norepo=True)
 def clone(ui, source, dest=None, *subtreeargs, **opts):
-    '''copy one or more existing repositories to create a tree'''
-    global hg_clone
+    '''copy one or more existing repositories to create a tree
+
+    With --jobs, sibling subtrees are cloned concurrently once the repo that
+    contains them has been cloned.  The output of each clone is shown as it
+    completes, and any subtrees that could not be cloned are listed at the end.
+
+    To avoid fetching the full history of every repo, e.g. when trees are
+    created often, use --share-pool or --reference.  With --share-pool DIR,
+    each repo is created as a share (see hg help share) of a store in DIR, which
+    is created by the first clone of that repo and later only updated with the
+    new changesets (the stores are named as set by share.poolnaming).  With
+    --reference TREE, each repo is first copied (using hardlinks if possible)
+    from the repo at the same path in the local tree TREE, if there is one, and
+    then only the missing changesets are pulled from the source.  In both cases,
+    the default path of each repo is its source.
+
+    The progress of the clone is kept in a journal in the root repo until the
+    whole tree has been cloned, and the subtree configuration of each repo is
+    only written at the end.  If the clone is interrupted, run it again with
+    --resume to clone the remaining repos; repos that were only partly cloned
+    are removed and cloned again.
+    '''
+    global hg_clone, _journal
+    if opts.get('share_pool') and opts.get('reference'):
+        raise error_Abort(_('cannot use --share-pool with --reference'))
+    if opts.get('share_pool') and 'shareopts' not in _cloneargs():
+        raise error_Abort(_('--share-pool requires mercurial 3.3 or later'))
+    if opts.get('reference'):
+        opts['reference'] = os.path.abspath(opts['reference'])
     if not hg_clone:
         hg_clone = compatible_clone()
     if subtreeargs:
@@ -485,22 +2949,52 @@ def clone(ui, source, dest=None, *subtreeargs, **opts):
         opts['subtrees'] = s
     if dest is None:
         dest = hg.defaultdest(source)
-    _clone(ui, source, dest, opts, opts.get('skiproot'))
+    journal = _clonejournal(dest)
+    if journal.resuming():
+        if not opts.get('resume'):
+            raise error_Abort(_('%s has an interrupted clone (use --resume to '
+                                'finish it)') % dest)
+        done = [p for p in journal.state if journal.state[p] == 'done']
+        ui.status(_('resuming clone of %s (%d of %d repos cloned)\n') %
+                  (source, len(done), len(journal.state)))
+    try:
+        _sshmuxed(ui, opts, _clone, ui, source, dest, opts,
+                  opts.get('skiproot'))
+    finally:
+        _journal = None
     return 0
 
-def _command(ui, repo, argv, stop, opts):
-    ui.status('[%s]:\n' % repo.root)
-    ui.flush()
-    # Mercurial bug?  util.system() drops elements of argv after the first.
-    # rc = util.system(argv, cwd=repo.root)
-    rc = subprocess.call(argv, cwd=repo.root)
-    if rc and stop:
-        return rc
-    for subtree in _subtreelist(ui, repo, opts):
-        ui.status('\n')
-        ui.flush()
-        lr = hg.repository(ui, repo.wjoin(subtree))
-        rc += _command(lr.ui, lr, argv, stop, opts)
+def _call(argv, cwd):
+    """Run argv in cwd from a worker, without a terminal for input.
+
+    If the worker is killed (e.g., tcommand --stop), so is the command."""
+    p = subprocess.Popen(argv, cwd=cwd, stdin=open(os.devnull))
+    def term(signum, frame):
+        try:
+            os.kill(p.pid, signal.SIGTERM)
+        finally:
+            os._exit(255)
+    signal.signal(signal.SIGTERM, term)
+    return p.wait()
+
+def _command(tree, argv, stop, jobs=1):
+    if jobs > 1 or _interleave(tree.ui, tree.opts):
+        def workers():
+            for node in tree:
+                path, lr, lui = node
+                yield _worker(node, _pcall(lr.root, 'command', _call),
+                              (argv, lr.root))
+        return _prun(tree, jobs, workers(), stop=stop)
+    def sep():
+        tree.ui.status('\n')
+        tree.ui.flush()
+    rc = 0
+    for path, lr, lui in tree.walk(sep):
+        lui.status('[%s]:\n' % lr.root)
+        lui.flush()
+        # Mercurial bug?  util.system() drops elements of argv after the first.
+        # rc = util.system(argv, cwd=lr.root)
+        rc += _pcall(lr.root, 'command', subprocess.call)(argv, cwd=lr.root)
         if rc and stop:
             return rc
     return rc
@@ -519,11 +3013,17 @@ def command_cmd(ui, repo, cmd, *args, **opts):
 
     Mercurial parses all arguments that start with a dash, including those that
     follow the command name, which usually results in an error.  Prevent this by
-    using '--' before the command or arguments, e.g.:  hg tcommand -- ls -l"""
+    using '--' before the command or arguments, e.g.:  hg tcommand -- ls -l
+
+    With --jobs, the command is run in several repos at once, with its standard
+    input redirected from /dev/null.  The output from each repo is saved and
+    shown in tree order.  With --stop, the repos after the first failure are
+    skipped (or interrupted, if already running)."""
 
     _checklocal(repo)
     l = __builtin__.list((cmd,) + args)
-    return _command(ui, repo, l, opts.get('stop'), opts)
+    return _command(_tree(ui, repo, opts), l, opts.get('stop'),
+                    _jobs(ui, opts))
 
 @command('tcommit|tci')
 def commit(ui, repo, *pats, **opts):
@@ -535,16 +3035,185 @@ def commit(ui, repo, *pats, **opts):
     hgcommit = _origcmd('commit')
     def condcommit(ui, repo, *pats, **opts):
         '''commit conditionally - only if there is something to commit'''
-        needcommit = len(repo[None].parents()) > 1 # merge
-        if not needcommit:
-            mar = repo.status()[:3] # modified, added, removed
-            needcommit = bool(mar[0] or mar[1] or mar[2])
-        if needcommit:
+        if _dirty(repo, False):
             return hgcommit(ui, repo, *pats, **opts)
         ui.status('nothing to commit\n')
         return 0
 
-    return _docmd1(condcommit, ui, repo, *pats, **opts)
+    return _docmd1(condcommit, _tree(ui, repo, opts), *pats, **opts)
+
+def _dirty(repo, missing=True):
+    """Return True if the working dir of repo has uncommitted changes.
+
+    The cheap checks come first:  an uncommitted merge, or (with hg >= 4.4)
+    files added, removed or merged according to the dirstate.  Only then are
+    the files examined for modifications (and, if missing is true, deleted
+    files).  Unknown files are not changes."""
+    ds = repo.dirstate
+    if ds.parents()[1] != nullid:
+        return True
+    # hg >= 4.4:  the dirstate map tracks the entries not in the normal state.
+    # Older dirstates would have to be scanned (and sorted) in full, which
+    # costs more than it saves, so status does all the work.
+    files = getattr(getattr(ds, '_map', None), 'nonnormalset', ())
+    for f in files:
+        if ds[f] in 'arm':
+            return True
+    st = repo.status()
+    return bool(st[0] or st[1] or st[2] or missing and st[3])
+
+@command('tdirty')
+def dirty(ui, repo, **opts):
+    '''check whether any repo in the tree has uncommitted changes
+
+    Nothing is printed (except with --verbose); the exit status is 0 if a repo
+    has uncommitted changes (including an uncommitted merge), and 1 if all the
+    repos are clean.  Unknown files are ignored.
+
+    The check stops at the first repo with changes.  With --jobs, several repos
+    are checked at once and the check stops as soon as any of them has
+    changes.
+    '''
+    _checklocal(repo)
+    tree = _tree(ui, repo, opts)
+    found = []
+    def done(path, lr, lui, isdirty):
+        if isdirty:
+            lui.note(_('%s has uncommitted changes\n') % lr.root)
+            found.append(lr.root)
+        return isdirty
+    jobs = _jobs(ui, opts)
+    if jobs > 1:
+        def workers():
+            for node in tree:
+                yield _worker(node, _dirty, (node[1],))
+        def wdone(w):
+            if w.exc:
+                raise w.exc
+            return done(*w.data + (w.result,))
+        _runordered(jobs, workers(), wdone, ordered=False, inline=True)
+    else:
+        for path, lr, lui in tree:
+            if done(path, lr, lui, _dirty(lr)):
+                break
+    return int(not found)
+
+@command('tsnapshot')
+def snapshot(ui, repo, dest=None, **opts):
+    '''record the working directory parent of each repo in the tree
+
+    One line is written for each repo, in tree order, giving the parent of its
+    working directory and its path relative to the root of the tree ('.' for
+    the root itself), to DEST or, if DEST is not given, to standard output.
+    trestore updates the tree back to these revisions.
+
+    Uncommitted changes are not recorded.  A repo with an uncommitted merge
+    cannot be recorded.
+    '''
+    _checklocal(repo)
+    lines = []
+    for path, lr, lui in _tree(ui, repo, opts):
+        parents = lr.dirstate.parents()
+        if parents[1] != nullid:
+            raise error_Abort(_('uncommitted merge in %s') % lr.root)
+        lines.append('%s %s\n' % (hex(parents[0]), path or '.'))
+    if dest is None or dest == '-':
+        for line in lines:
+            ui.write(line)
+        return 0
+    f = open(dest + '.tmp', 'w')
+    try:
+        f.writelines(lines)
+    finally:
+        f.close()
+    util.rename(dest + '.tmp', dest)
+    return 0
+
+def _readsnapshot(path):
+    """Return the (path, node) pairs in the tsnapshot file at path."""
+    l = []
+    f = path == '-' and sys.stdin or open(path)
+    try:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(' ', 1)
+            if len(parts) != 2 or len(parts[0]) != 40:
+                raise error_Abort(_('%s: invalid snapshot line: %s') %
+                                  (path, line))
+            l.append((parts[1], parts[0]))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return l
+
+def _restore1(cmd, ui, repo, node, clean, interactive=True):
+    if not interactive:
+        ui.setconfig('ui', 'interactive', 'off')
+    return _update1(cmd, ui, repo, rev=node, clean=clean)
+
+@command('trestore')
+def restore(ui, repo, source, **opts):
+    '''update the repos in the tree to the revisions in a snapshot
+
+    SOURCE is a file written by tsnapshot ('-' for standard input).  Only the
+    repos whose working directory parent differs from the snapshot are
+    updated (with --jobs, several at once); the others are not touched.  Each
+    revision is checked before any repo is updated, so a repo that lacks the
+    revision of the snapshot (e.g., one that needs a pull) stops the restore
+    early.
+
+    Repos in the tree that are not in the snapshot are left alone, as are
+    repos in the snapshot that are not in the tree; both are reported.
+    '''
+    _checklocal(repo)
+    snap = _readsnapshot(source)
+    wanted = dict(snap)
+    tree = _tree(ui, repo, opts)
+    todo = []
+    seen = {}
+    for node in tree:
+        path, lr, lui = node
+        path = path or '.'
+        seen[path] = True
+        if path not in wanted:
+            ui.warn(_('%s is not in the snapshot\n') % lr.root)
+            continue
+        n = wanted[path]
+        try:
+            lr.changelog.rev(bin(n))
+        except (error.LookupError, TypeError):
+            raise error_Abort(_('unknown revision %s in %s') % (n[:12], lr.root))
+        if hex(lr.dirstate.parents()[0]) != n:
+            todo.append(node)
+    for path, n in snap:
+        if path not in seen:
+            ui.warn(_('%s is in the snapshot but not in the tree\n') % path)
+    cmd = _origcmd('update')
+    clean = opts.get('clean')
+    rc = 0
+    jobs = _jobs(ui, opts)
+    if todo and (jobs > 1 or _interleave(ui, opts)):
+        def workers():
+            for node in todo:
+                path, lr, lui = node
+                yield _worker(node, _pcall(lr.root, 'update', _restore1),
+                              (cmd, lui, lr, wanted[path or '.'], clean, False))
+        rc = _prun(tree, jobs, workers())
+    else:
+        for path, lr, lui in todo:
+            if path:
+                lui.status('\n')
+            lui.status('[%s]:\n' % lr.root)
+            trc = _pcall(lr.root, 'update', _restore1)(cmd, lui, lr,
+                                                       wanted[path or '.'],
+                                                       clean)
+            lui.flush()
+            rc += trc != None and trc or 0
+    ui.status(_('%d repos updated, %d unchanged\n') %
+              (len(todo), len(seen) - len(todo)))
+    return rc and 1 or 0
 
 def addconfig(ui, repo, subtrees, opts, ignoredups = False):
     modified = False
@@ -641,7 +3310,7 @@ def setconfig(ui, repo, subtrees, opts):
         raise error_Abort(msg)
 
     if walk:
-        subtrees = _shortpaths(repo.root, _walk(ui, repo, {}))[1:]
+        subtrees = _shortpaths(repo.root, _walk(ui, repo, opts))[1:]
     elif not subtrees:
         subtrees = _shortpaths(repo.root, _list(ui, repo, opts))[1:]
     if depth:
@@ -708,43 +3377,125 @@ def config(ui, repo, *subtrees, **opts):
         ui.write(subtree + '\n')
     return 0
 
+_diffplainre = re.compile(r'(diff (?:-r \S+ )+)(.*)$', re.S)
+_diffpathheaders = ('--- a/', '+++ b/', 'rename from ', 'rename to ',
+                    'copy from ', 'copy to ', 'Binary file ')
+
+def _diffprefixer(prefix):
+    """Return a function rewriting the lines of a patch so that the files in it
+    are under prefix (e.g., 'sub/').
+
+    Only the header lines of each file (from the 'diff' line to the first hunk)
+    are rewritten; a hunk line never starts with 'diff'."""
+    inheader = [False]
+    def rewrite(line):
+        if line.startswith('diff --git a/'):
+            inheader[0] = True
+            rest = line[13:].rstrip('\n')
+            n = (len(rest) - 3) // 2
+            if rest[n:n + 3] == ' b/' and rest[:n] == rest[n + 3:]:
+                a = b = rest[:n] # the usual case; either may contain ' b/'
+            else:
+                a, b = rest.split(' b/', 1)
+            return 'diff --git a/%s%s b/%s%s\n' % (prefix, a, prefix, b)
+        if line.startswith('diff '):
+            inheader[0] = True
+            m = _diffplainre.match(line)
+            return m and m.group(1) + prefix + m.group(2) or line
+        if inheader[0]:
+            if line.startswith('@@'):
+                inheader[0] = False
+                return line
+            for h in _diffpathheaders:
+                if line.startswith(h):
+                    return h + prefix + line[len(h):]
+        return line
+    return rewrite
+
+def _combineddiff(tree, pats, opts):
+    """Show the diffs of all the repos in the tree as a single patch.
+
+    The paths in the diff of each subtree are prefixed with the path of the
+    subtree (relative to the root of the tree), so the patch applies to the
+    root of a checkout of the tree, e.g., with 'hg import' or 'patch -p1'.
+    There are no [repo]: headers.  The diff of each repo is produced into a
+    temporary file (with --jobs, in separate processes) and copied to stdout
+    a line at a time, in tree order, so the patch is never held in memory."""
+    for o in ('stat', 'noprefix', 'root'):
+        if opts.get(o):
+            raise error_Abort(_('cannot use --combined with --%s') % o)
+    cmd = _origcmd('diff')
+    cmdopts = _cmdopts(opts)
+    root = tree.repo.root
+    rc = [0]
+    def workers():
+        for node, npats in _treepats(tree, pats):
+            path, lr, lui = node
+            yield _worker(node, _pcall(lr.root, 'command', cmd),
+                          (lui, lr) + npats, cmdopts)
+    def done(w):
+        if w.data is None:
+            raise w.exc
+        path, lr, lui = w.data
+        sp = _shortpaths(root, [lr.root])[0]
+        w.replay(lui, filter=sp != '.' and
+                 _diffprefixer(util.pconvert(sp) + '/') or None)
+        lui.flush()
+        if w.exc:
+            raise w.exc
+        rc[0] += w.result != None and w.result or 0
+    jobs = _jobs(tree.ui, opts)
+    if jobs > 1:
+        _runordered(jobs, workers(), done, inline=True)
+    else:
+        for w in workers():
+            w.runinline()
+            done(w)
+    return rc[0]
+
 @command('tdiff')
 def diff(ui, repo, *args, **opts):
-    """diff repository (or selected files)"""
+    """diff repository (or selected files)
+
+    With --combined, the diffs of all the repos are shown as a single patch,
+    without [repo]: headers, with the path of each file relative to the root of
+    the tree.  With --jobs, the diffs are produced concurrently and still shown
+    in tree order."""
     _checklocal(repo)
-    return _docmd1(_origcmd('diff'), ui, repo, *args, **opts)
+    combined = opts.pop('combined', False)
+    tree = _tree(ui, repo, opts)
+    if combined:
+        return _combineddiff(tree, args, opts)
+    return _docmdpats(_origcmd('diff'), tree, args, opts)
 
 @command('theads')
 def heads(ui, repo, *branchrevs, **opts):
     """show current repository heads or show branch heads"""
     _checklocal(repo)
-    st = opts.get('subtrees')
-    repocount = len(_list(ui, repo, st and {'subtrees': st} or {}))
-    rc = _docmd1(_origcmd('heads'), ui, repo, *branchrevs, **opts)
+    tree = _tree(ui, repo, opts)
+    if opts.get('template') == 'json':
+        if branchrevs:
+            raise error_Abort(_('cannot use -Tjson with BRANCHREVS'))
+        _treejson(tree, **opts)
+        # return 0 if any of the repos have heads; 1 otherwise.
+        return int(not [lr for path, lr, lui in tree if len(lr)])
+    rc = _docmd1(_origcmd('heads'), tree, *branchrevs, **opts)
     # return 0 if any of the repos have matching heads; 1 otherwise.
-    return int(rc == repocount)
+    return int(rc == len(tree))
 
 @command('tincoming')
 def incoming(ui, repo, remote="default", **opts):
     """show new changesets found in source"""
     _checklocal(repo)
     adjust = remote and not ui.config('paths', remote)
-    st = opts.get('subtrees')
-    repocount = len(_list(ui, repo, st and {'subtrees': st} or {}))
-    rc = _docmd2(_origcmd('incoming'), ui, repo, remote, adjust, **opts)
+    tree = _tree(ui, repo, opts)
+    rc = _docmd2(_cachedpull(ui, _origcmd('incoming'), True), tree, remote,
+                 adjust, **opts)
     # return 0 if any of the repos have incoming changes; 1 otherwise.
-    return int(rc == repocount)
+    return int(rc == len(tree))
 
 def _list(ui, repo, opts):
-    l = [repo.root]
-    for subtree in _subtreelist(ui, repo, opts):
-        dir = repo.wjoin(subtree)
-        if os.path.exists(dir):
-            lr = hg.repository(ui, dir)
-            l += _list(lr.ui, lr, opts)
-        else:
-            ui.warn('repo %s is missing subtree %s\n' % (repo.root, subtree))
-    return l
+    return _tree(ui, repo, opts, strict=False).roots()
 
 # This function cannot be named list since it clashes with the python builtin
 @command('tlist')
@@ -771,11 +3522,135 @@ def list_cmd(ui, repo, **opts):
         ui.write(subtree + '\n')
     return 0
 
+def _logrevs(ui, repo, pats, opts):
+    """Return (revs, displayer, filematcher) for hg log pats in repo.
+
+    revs is in the order log shows them, and is usually computed lazily.
+    filematcher is None, or a function returning the matcher to pass to
+    displayer.show() for each rev (hg < 4.6)."""
+    try:
+        getrevs = logcmdutil.getrevs
+    except (AttributeError, ImportError):
+        getrevs = None
+    if getrevs is not None:
+        revs, differ = getrevs(repo, pats, opts)
+        return (revs, logcmdutil.changesetdisplayer(ui, repo, opts, differ,
+                                                    buffered=True), None)
+    if not hasattr(cmdutil, 'getlogrevs'):
+        raise error_Abort(_('--merged is not supported by this version of '
+                            'mercurial'))
+    revs, expr, filematcher = cmdutil.getlogrevs(repo, pats, opts)
+    return revs, cmdutil.show_changeset(ui, repo, opts, buffered=True), \
+           filematcher
+
+def _logentries(ui, repo, pats, opts):
+    """Yield (date, rev, output) for each changeset hg log would show in repo,
+    newest first.
+
+    hg log shows the revs in revset order (e.g., oldest first with -r 0:tip,
+    or pulled changesets with older dates after newer ones), so the revs are
+    sorted by date, but each one is rendered only when needed."""
+    revs, displayer, filematcher = _logrevs(ui, repo, pats, opts)
+    revs = sorted(revs, key=lambda r: (-repo[r].date()[0], -r))
+    # hg < 3.5: flush takes the rev instead of the changectx
+    flushrev = inspect.getargspec(displayer.flush)[0][1] == 'rev'
+    for rev in revs:
+        ctx = repo[rev]
+        ui.pushbuffer()
+        if filematcher is not None:
+            displayer.show(ctx, matchfn=filematcher(rev))
+        else:
+            displayer.show(ctx)
+        displayer.flush(flushrev and rev or ctx)
+        yield ctx.date()[0], rev, ui.popbuffer()
+
+def _logentrylist(ui, repo, pats, opts, limit):
+    """Return the first limit (or all) _logentries, e.g., from a worker."""
+    l = []
+    for entry in _logentries(ui, repo, pats, opts):
+        l.append(entry)
+        if len(l) == limit:
+            break
+    return l
+
+def _mergedlog(tree, pats, opts):
+    """Show the changesets of all the repos in the tree as a single log.
+
+    The log of each repo is sorted by date and rendered lazily (with --jobs,
+    up to --limit entries of each are produced in workers), and the logs are
+    merged by date, newest first, through a heap.  Each line is prefixed by
+    the short path of the repo.  --limit applies to the merged log, so no repo
+    renders more changesets than needed."""
+    if opts.get('graph'):
+        raise error_Abort(_('cannot use --merged with --graph'))
+    cmdopts = _cmdopts(opts)
+    limit = cmdopts.get('limit')
+    if limit:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise error_Abort(_('limit must be a positive integer'))
+        if limit <= 0:
+            raise error_Abort(_('limit must be a positive integer'))
+    else:
+        limit = None
+    # The limit applies to the merged log; the log of a repo is cut only after
+    # it is sorted by date (see _logentries).
+    cmdopts['limit'] = None
+    routed = __builtin__.list(_treepats(tree, pats))
+    nodes = [node for node, npats in routed]
+    jobs = _jobs(tree.ui, opts)
+    if jobs > 1:
+        streams = [None] * len(nodes)
+        def workers():
+            for i in xrange(len(nodes)):
+                path, lr, lui = nodes[i]
+                yield _worker(i, _pcall(lr.root, 'command', _logentrylist),
+                              (lui, lr, routed[i][1], cmdopts, limit))
+        def done(w):
+            if w.exc:
+                raise w.exc
+            streams[w.data] = iter(w.result)
+        _runordered(jobs, workers(), done, inline=True)
+    else:
+        streams = [_logentries(lui, lr, npats, cmdopts)
+                   for (path, lr, lui), npats in routed]
+    heap = []
+    def advance(i):
+        for date, rev, text in streams[i]:
+            # Newest first; ties are broken by tree order.
+            heapq.heappush(heap, (-date, i, text))
+            return
+    for i in xrange(len(nodes)):
+        advance(i)
+    prefixes = [p + ': ' for p in
+                _shortpaths(tree.repo.root, [n[1].root for n in nodes])]
+    n = 0
+    while heap and (limit is None or n < limit):
+        date, i, text = heapq.heappop(heap)
+        lui = nodes[i][2]
+        for line in text.splitlines(True):
+            lui.write(prefixes[i] + line)
+        n += 1
+        advance(i)
+    tree.ui.flush()
+    return 0
+
 @command('^tlog|thistory')
 def log(ui, repo, *args, **opts):
-    '''show revision history of entire repository or files'''
+    '''show revision history of entire repository or files
+
+    With --merged, the changesets of all the repos are shown as a single log,
+    newest first, with each line prefixed by the path of the repo (relative
+    to the root of the tree).  --limit then applies to the whole log.  With
+    --jobs, the log of each repo is read in a separate process.
+    '''
     _checklocal(repo)
-    return _docmd1(_origcmd('log'), ui, repo, *args, **opts)
+    merged = opts.pop('merged', False)
+    tree = _tree(ui, repo, opts)
+    if merged:
+        return _mergedlog(tree, args, opts)
+    return _docmdpats(_origcmd('log'), tree, args, opts)
 
 @command('tmerge')
 def merge(ui, repo, node=None, **opts):
@@ -789,107 +3664,170 @@ def merge(ui, repo, node=None, **opts):
         ui.status('nothing to merge\n')
         return 0
 
-    return _docmd1(condmerge, ui, repo, node, **opts)
+    return _docmd1(condmerge, _tree(ui, repo, opts), node, **opts)
 
 @command('toutgoing')
 def outgoing(ui, repo, remote=None, **opts):
     '''show changesets not found in the destination'''
     _checklocal(repo)
     adjust = remote and not ui.config('paths', remote)
-    st = opts.get('subtrees')
-    repocount = len(_list(ui, repo, st and {'subtrees': st} or {}))
-    rc = _docmd2(_origcmd('outgoing'), ui, repo, remote, adjust, **opts)
+    tree = _tree(ui, repo, opts)
+    rc = _docmd2(_origcmd('outgoing'), tree, remote, adjust, **opts)
     # return 0 if any of the repos have outgoing changes; 1 otherwise.
-    return int(rc == repocount)
+    return int(rc == len(tree))
 
 @command('tparents')
 def parents(ui, repo, filename=None, **opts):
     _checklocal(repo)
-    return _docmd1(_origcmd('parents'), ui, repo, filename, **opts)
+    return _docmd1(_origcmd('parents'), _tree(ui, repo, opts), filename,
+                   **opts)
 
-def _paths(cmd, ui, repo, search=None, **opts):
-    ui.status('[%s]:\n' % repo.root)
-    cmd(ui, repo, search)
-    for subtree in _subtreelist(ui, repo, opts):
-        ui.status('\n')
-        lr = hg.repository(ui, repo.wjoin(subtree))
-        _paths(cmd, lr.ui, lr, search, **opts)
+def _paths(cmd, tree, search=None):
+    for path, lr, lui in tree.walk(lambda: tree.ui.status('\n')):
+        lui.status('[%s]:\n' % lr.root)
+        _pcall(lr.root, 'command', cmd)(lui, lr, search)
     return 0
 
 @command('tpaths')
 def paths(ui, repo, search=None, **opts):
     '''show aliases for remote repositories'''
     _checklocal(repo)
-    return _paths(_origcmd('paths'), ui, repo, search, **opts)
+    return _paths(_origcmd('paths'), _tree(ui, repo, opts), search)
 
 @command('^tpull')
 def pull(ui, repo, remote="default", **opts):
     '''pull changes from the specified source'''
     _checklocal(repo)
     adjust = remote and not ui.config('paths', remote)
-    st = opts.get('subtrees')
-    repocount = len(_list(ui, repo, st and {'subtrees': st} or {}))
-    rc = _docmd2(_origcmd('pull'), ui, repo, remote, adjust, **opts)
+    tree = _tree(ui, repo, opts)
+    cmd = _cachedpull(ui, _origcmd('pull'))
+    if opts.get('update') and (_jobs(ui, opts) > 1 or _interleave(ui, opts)):
+        rc = _pullupdate(cmd, tree, remote, adjust, **opts)
+    else:
+        rc = _docmd2(cmd, tree, remote, adjust, **opts)
     # Sadly, pull returns 1 if there was nothing to pull *or* if there are
     # unresolved files on update.  No way to distinguish between them.
     # return 0 if any subtree pulled successfully.
-    return int(rc == repocount)
+    return int(rc == len(tree))
 
 @command('^tpush')
 def push(ui, repo, remote=None, **opts):
     '''push changes to the specified destination'''
     _checklocal(repo)
     adjust = remote and not ui.config('paths', remote)
-    st = opts.get('subtrees')
-    repocount = len(_list(ui, repo, st and {'subtrees': st} or {}))
-    rc = _docmd2(_origcmd('push'), ui, repo, remote, adjust, **opts)
+    tree = _tree(ui, repo, opts)
+    rc = _docmd2(_origcmd('push'), tree, remote, adjust, **opts)
     # return 0 if all pushes were successful; 1 if none of the repos had
     # anything to push.
-    return int(rc == repocount)
+    return int(rc == len(tree))
+
+@command('tserve')
+def serve(ui, repo, **opts):
+    '''serve tree commands from a persistent process
+
+    Start a server that keeps the repos in the tree open and runs the commands
+    sent to it by tclient.py (in the same directory as trees.py).  Commands run
+    through the server skip the startup of python, mercurial and the
+    extensions, as well as opening the repos, so repeated commands such as
+    tstatus or tsummary finish much faster::
+
+        $ hg tserve --daemon
+        $ python tclient.py tstatus
+
+    The server listens on the unix socket .hg/trees.sock in the root repo (or
+    the one given by --socket).  tclient.py finds it by searching upward from
+    the current directory, unless --socket or the TREES_SOCKET environment
+    variable is given; if there is no server, tclient.py runs hg directly.
+
+    Each command runs in a child process with the current directory,
+    environment and arguments of the client.  Standard input is read from the
+    client as the command needs it; it is never a terminal, so commands do not
+    prompt (the default answer is used).  Configuration files are read when the
+    server starts, so a client with a different HGRCPATH should run hg itself.
+    A repo is reopened if the files in its .hg directory change.
+
+    The socket can only be used by the user running the server:  it is created
+    with mode 0600, and (where the platform tells) connections from other users
+    are refused.
+
+    This requires a unix-like platform.
+    '''
+    _checklocal(repo)
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'fork'):
+        raise error_Abort(_('tserve requires unix sockets and fork()'))
+    path = opts.get('socket') or _repo_join(repo, 'trees.sock')
+    s = _server(ui, repo, opts, os.path.abspath(path))
+    service = getattr(cmdutil, 'service', None)
+    if service is None:
+        # hg >= 4.2
+        from mercurial import server
+        service = server.runservice
+    service(opts, initfn=s.init, runfn=s.run)
 
 @command('^tstatus')
 def status(ui, repo, *args, **opts):
-    '''show changed files in the working directory'''
+    '''show changed files in the working directory
+
+    With -Tjson, a single JSON object describing the whole tree is written
+    instead, keyed by the short path of each repo.  It gives the number of
+    modified, added, removed, deleted and unknown files (among the specified
+    files, if any), and the branch, parents, heads and tip of each repo.
+    tsummary, theads and ttip accept -Tjson and write the same object.
+    '''
     _checklocal(repo)
-    return _docmd1(_origcmd('status'), ui, repo, *args, **opts)
+    tree = _tree(ui, repo, opts)
+    if opts.get('template') == 'json':
+        return _treejson(tree, args, **opts)
+    return _docmdpats(_origcmd('status'), tree, args, opts)
 
-try:
-    cmdutil.findcmd('summary', commands.table)
+# The summary command is not present in early versions of mercurial
+if getattr(commands, 'summary', None):
     @command('tsummary')
     def summary(ui, repo, **opts):
         """summarize working directory state"""
         _checklocal(repo)
-        return _docmd1(_origcmd('summary'), ui, repo, **opts)
-except:
-    # The summary command is not present in early versions of mercurial
-    pass
+        tree = _tree(ui, repo, opts)
+        if opts.get('template') == 'json':
+            return _treejson(tree, **opts)
+        return _docmd1(_origcmd('summary'), tree, **opts)
 
 @command('ttag')
 def tag(ui, repo, name1, *names, **opts):
     '''add one or more tags for the current or given revision'''
     _checklocal(repo)
-    return _docmd1(_origcmd('tag'), ui, repo, name1, *names, **opts)
+    return _docmd1(_origcmd('tag'), _tree(ui, repo, opts), name1, *names,
+                   **opts)
 
 @command('ttip')
 def tip(ui, repo, **opts):
     '''show the tip revision'''
     _checklocal(repo)
-    return _docmd1(_origcmd('tip'), ui, repo, **opts)
-
-def _update(cmd, ui, repo, node=None, rev=None, clean=False, date=None,
-            check=False, **opts):
-    ui.status('[%s]:\n' % repo.root)
-    update_num_args = len(inspect.getargspec(commands.update)[0])
-    # hg 4.6: any arg after the 3rd must be specified with name
-    if update_num_args >= 7 or update_num_args <= 3:
-        trc = cmd(ui, repo, node=node, rev=rev, clean=clean, date=date, check=check)
-    else:
-        trc = cmd(ui, repo, node, rev, clean, date)
-    rc = trc != None and trc or 0
-    for subtree in _subtreelist(ui, repo, opts):
-        ui.status('\n')
-        lr = hg.repository(ui, repo.wjoin(subtree))
-        trc = _update(cmd, lr.ui, lr, node, rev, clean, date, check, **opts)
+    tree = _tree(ui, repo, opts)
+    if opts.get('template') == 'json':
+        return _treejson(tree, **opts)
+    return _docmd1(_origcmd('tip'), tree, **opts)
+
+_updatekwargs = None # whether update takes its arguments by name
+
+def _update1(cmd, ui, repo, node=None, rev=None, clean=False, date=None,
+             check=False):
+    global _updatekwargs
+    if _updatekwargs is None:
+        update_num_args = len(inspect.getargspec(commands.update)[0])
+        # hg 4.6: any arg after the 3rd must be specified with name
+        _updatekwargs = update_num_args >= 7 or update_num_args <= 3
+    if _updatekwargs:
+        return cmd(ui, repo, node=node, rev=rev, clean=clean, date=date,
+                   check=check)
+    return cmd(ui, repo, node, rev, clean, date)
+
+def _update(cmd, tree, node=None, rev=None, clean=False, date=None,
+            check=False):
+    rc = 0
+    for path, lr, lui in tree.walk(lambda: tree.ui.status('\n')):
+        lui.status('[%s]:\n' % lr.root)
+        trc = _pcall(lr.root, 'update', _update1)(cmd, lui, lr, node, rev,
+                                                  clean, date, check)
         rc += trc != None and trc or 0
     return rc
 
@@ -898,8 +3836,8 @@ def update(ui, repo, node=None, rev=None, clean=False, date=None, check=False,
            **opts):
     '''update working directory (or switch revisions)'''
     _checklocal(repo)
-    rc = _update(_origcmd('update'), ui, repo, node, rev, clean, date, check,
-                 **opts)
+    rc = _update(_origcmd('update'), _tree(ui, repo, opts), node, rev, clean,
+                 date, check)
     return rc and 1 or 0
 
 @command('tversion', norepo=True)
@@ -919,7 +3857,22 @@ def debugkeys(ui, src, **opts):
     '''list the tree configuration using mercurial's pushkey mechanism.
 
     This works for remote repositories as long as the remote hg server has the
-    trees extension enabled.'''
+    trees extension enabled.
+
+    With --recursive, the subtrees of the subtrees are listed too, by their
+    path relative to the top-level repo.  The whole tree is obtained with a
+    single request if the server has a version of the trees extension that
+    supports it, and otherwise from each repo in turn.'''
+    if opts.get('recursive'):
+        repo = hg_repo(ui, src, opts)
+        m = _manifest(ui, repo, opts)
+        if m is None:
+            m = _levelmanifest(ui, repo, opts)
+        i = 0
+        for path in _manifestpaths(m):
+            ui.write("%d: %s\n" % (i, path))
+            i += 1
+        return 0
     d = hg_repo(ui, src, opts).listkeys(_ns(ui, opts))
     i = 0
     n = len(d)
@@ -942,9 +3895,18 @@ if not hasattr(hg, 'remoteui'):
             return ui
         hg.remoteui = _remoteui
 
+_cloneargspec = None
+
+def _cloneargs():
+    """Return the argument names of hg.clone (looked up once)."""
+    global _cloneargspec
+    if _cloneargspec is None:
+        _cloneargspec = inspect.getargspec(hg.clone)[0]
+    return _cloneargspec
+
 # Tolerate changes to the signature of hg.clone().
 def compatible_clone():
-    clone_args = inspect.getargspec(hg.clone)[0]
+    clone_args = _cloneargs()
     if not 'branch' in clone_args:
         # hg < 1.5:  no 'branch' parameter (a78bfaf988e1)
         def hg_clone(ui, peeropts, source, dest=None, pull=False, revs=None,
@@ -963,10 +3925,10 @@ def compatible_clone():
     if 'rev' in clone_args:
         # hg < 4.6: argument is named 'rev', renamed to 'revs' in 4.6
         def hg_clone(ui, peeropts, source, dest=None, pull=False, revs=None,
-                     update=True, stream=False, branch=None):
+                     update=True, stream=False, branch=None, **kwargs):
             return hg.clone(ui, peeropts, source, dest=dest, pull=pull,
                             rev=revs, update=update, stream=stream,
-                            branch=branch)
+                            branch=branch, **kwargs)
         return hg_clone
     return hg.clone
 
@@ -980,6 +3942,27 @@ namespaceopt = [('', 'tns', '',
 subtreesopts = [('', 'subtrees', [],
                  _('path to subtree'),
                  _('SUBTREE'))] + namespaceopt
+jobsopt = [('', 'jobs', 0,
+            _('number of repos to process concurrently'),
+            _('N')),
+           ('', 'interleave', False,
+            _('show output as each repo finishes, prefixed with its path'))]
+profileopts = [('', 'trees-profile', False,
+                _('show the time spent on each repo')),
+               ('', 'trees-profile-dir', '',
+                _('with --trees-profile, save cProfile stats of each repo '
+                  'in DIR'),
+                _('DIR'))]
+clonesourceopts = [('', 'share-pool', '',
+                    _('create each repo as a share of a store in DIR'),
+                    _('DIR')),
+                   ('', 'reference', '',
+                    _('copy each repo from the same path in the local tree '
+                      'TREE'),
+                    _('TREE'))]
+templateopt = [('T', 'template', '',
+                _('display with template (json describes the whole tree)'),
+                _('TEMPLATE'))]
 
 if len(commands.globalopts[0]) < 5:
     # hg < 1.5.4:  arg description (5th tuple element) is not supported
@@ -990,19 +3973,42 @@ if len(commands.globalopts[0]) < 5:
             i += 1
     trimoptions(namespaceopt)
     trimoptions(subtreesopts)
+    trimoptions(jobsopt)
+    trimoptions(profileopts)
+    trimoptions(clonesourceopts)
+    trimoptions(templateopt)
 
-walkopt = [('w', 'walk', False,
-            _('walk the filesystem to discover subtrees'))]
+serveopts = [('d', 'daemon', None, _('run server in background')),
+              ('', 'daemon-postexec', [], _('used internally by daemon mode')),
+              ('', 'pid-file', '', _('name of file to write process ID to')),
+              ('', 'socket', '', _('path of the unix socket to listen on'))
+             ] + subtreesopts
 
+walkopt = [('w', 'walk', False,
+            _('walk the filesystem to discover subtrees')),
+           ('', 'maxdepth', 0,
+            _('with --walk, search at most N directory levels deep'))]
+
+restoreopts = [('C', 'clean', False,
+                _('discard uncommitted changes (no backup)'))
+              ] + subtreesopts + jobsopt + profileopts
+diffopts = [('', 'combined', False,
+             _('show the diffs of all the repos as a single patch'))]
+logopts = [('', 'merged', False,
+            _('show the changesets of all the repos in one log, newest first'))]
+debugkeysopts = [('r', 'recursive', False,
+                  _('list the subtrees of the subtrees, recursively'))]
 cloneopts = [('', 'skiproot', False,
-              _('do not clone the root repo in the tree'))
-            ] + subtreesopts
+              _('do not clone the root repo in the tree')),
+             ('', 'resume', False,
+              _('finish a clone that was interrupted'))
+            ] + clonesourceopts + subtreesopts + jobsopt + profileopts
 commandopts = [('', 'stop', False,
                 _('stop if command returns non-zero'))
-              ] + subtreesopts
+              ] + subtreesopts + jobsopt + profileopts
 listopts = [('s', 'short', False,
              _('list short paths (relative to repo root)'))
-           ] + walkopt + subtreesopts
+           ] + walkopt + subtreesopts + profileopts
 configopts = [('a', 'add', False,
                _('add the specified SUBTREEs to config')),
               ('',  'all', False,
@@ -1018,19 +4024,57 @@ configopts = [('a', 'add', False,
               ('s', 'set', False, _('set the subtree config to SUBTREEs'))
              ] + namespaceopt + walkopt
 
-def _newcte(origcmd, newfunc, extraopts = [], synopsis = None):
-    '''generate a cmdtable entry based on that for origcmd'''
-    cte = cmdutil.findcmd(origcmd, commands.table)[1]
-    # Filter out --exclude and --include, since those do not work across
-    # repositories (mercurial converts them to abs paths).
-    opts = [o for o in cte[1] if o[1] not in ('exclude', 'include')]
-    if len(cte) > 2:
-        return (newfunc, opts + extraopts, synopsis or cte[2])
-    return (newfunc, opts + extraopts, synopsis)
+class _lazycte(object):
+    """A cmdtable entry (func, opts, synopsis) whose options and synopsis are
+    only computed when first used, like mercurial's lazyaliasentry.
+
+    Mercurial only looks at the function of an entry until the command is
+    dispatched (or help is shown), so the entries of the t* commands cost
+    nothing when another command is run."""
+
+    def __init__(self, func, build, extraopts):
+        self.func = func
+        self.build = build
+        self.extraopts = extraopts
+        self._entry = None
+
+    def __getitem__(self, n):
+        if n == 0:
+            return self.func
+        if self._entry is None:
+            self._entry = self.build()
+        return ((self.func,) + self._entry)[n]
+
+    def __iter__(self):
+        for i in range(3):
+            yield self[i]
+
+    def __len__(self):
+        return 3
+
+def _newcte(origcmd, newfunc, extraopts = [], synopsis = None, json = False):
+    '''generate a cmdtable entry based on that for origcmd
+
+    The entry is a _lazycte, so origcmd is only looked up when the entry is
+    used.  If json is true, ensure the entry has a --template option (for
+    -Tjson).'''
+    def build():
+        cte = cmdutil.findcmd(origcmd, commands.table)[1]
+        # Filter out --exclude and --include, since those do not work across
+        # repositories (mercurial converts them to abs paths).
+        opts = [o for o in cte[1] if o[1] not in ('exclude', 'include')]
+        if json and 'template' not in [o[1] for o in opts]:
+            opts += templateopt
+        if len(cte) > 2:
+            return (opts + extraopts, synopsis or cte[2])
+        return (opts + extraopts, synopsis)
+    return _lazycte(newfunc, build, extraopts)
 
 def extsetup(ui = None):
     # The cmdtable is initialized here to pick up options added by other
-    # extensions (e.g., rebase, bookmarks).
+    # extensions (e.g., rebase, bookmarks).  The options of the entries based
+    # on mercurial commands are only looked up when the entry is used (see
+    # _lazycte), as extsetup runs for every hg command.
     #
     # Commands tagged with '^' are listed by 'hg help'.
     global defpath_mod
@@ -1050,34 +4094,63 @@ def extsetup(ui = None):
     cmdtable['^tclone'] = _newcte('clone', clone, cloneopts,
             _('[OPTION]... SOURCE [DEST [SUBTREE]...]'))
     cmdtable['tcommand|tcmd'] = (command_cmd, commandopts, _('command [arg] ...'))
-    cmdtable['tcommit|tci'] = _newcte('commit', commit, subtreesopts)
+    cmdtable['tcommit|tci'] = _newcte('commit', commit,
+                                      subtreesopts + profileopts)
     cmdtable['tconfig'] = (config, configopts, _('[OPTION]... [SUBTREE]...'))
-    cmdtable['tdiff'] = _newcte('diff', diff, subtreesopts)
-    cmdtable['theads'] = _newcte('heads', heads, subtreesopts)
-    cmdtable['tincoming'] = _newcte('incoming', incoming, subtreesopts)
-    cmdtable['toutgoing'] = _newcte('outgoing', outgoing, subtreesopts)
+    cmdtable['tdiff'] = _newcte('diff', diff, diffopts + subtreesopts +
+                                jobsopt + profileopts)
+    cmdtable['tdirty'] = (dirty, subtreesopts + jobsopt[:1] + profileopts,
+                          _('[OPTION]...'))
+    cmdtable['theads'] = _newcte('heads', heads,
+                                 subtreesopts + jobsopt + profileopts,
+                                 json=True)
+    cmdtable['tincoming'] = _newcte('incoming', incoming,
+                                    subtreesopts + jobsopt + profileopts)
+    cmdtable['toutgoing'] = _newcte('outgoing', outgoing,
+                                    subtreesopts + jobsopt + profileopts)
     cmdtable['tlist'] = (list_cmd, listopts, _('[OPTION]...'))
-    cmdtable['^tlog|thistory'] = _newcte('log', log, subtreesopts)
-    cmdtable['tmerge'] = _newcte('merge', merge, subtreesopts)
-    cmdtable['tparents'] = _newcte('parents', parents, subtreesopts)
-    cmdtable['tpaths'] = _newcte('paths', paths, subtreesopts)
-    cmdtable['^tpull'] = _newcte('pull', pull, subtreesopts)
-    cmdtable['^tpush'] = _newcte('push', push, subtreesopts)
-    cmdtable['^tstatus'] = _newcte('status', status, subtreesopts)
-    try:
-        cmdtable['tsummary'] = _newcte('summary', summary, subtreesopts)
-    except:
-        # The summary command is not present in early versions of mercurial
-        pass
-    cmdtable['^tupdate'] = _newcte('update', update, subtreesopts)
-    cmdtable['ttag'] = _newcte('tag', tag, subtreesopts)
-    cmdtable['ttip'] = _newcte('tip', tip, subtreesopts)
+    cmdtable['^tlog|thistory'] = _newcte('log', log, logopts + subtreesopts +
+                                         jobsopt + profileopts)
+    cmdtable['tmerge'] = _newcte('merge', merge, subtreesopts + profileopts)
+    cmdtable['tparents'] = _newcte('parents', parents,
+                                   subtreesopts + jobsopt + profileopts)
+    cmdtable['tpaths'] = _newcte('paths', paths, subtreesopts + profileopts)
+    cmdtable['^tpull'] = _newcte('pull', pull,
+                                 subtreesopts + jobsopt + profileopts)
+    cmdtable['^tpush'] = _newcte('push', push,
+                                 subtreesopts + jobsopt + profileopts)
+    cmdtable['tserve'] = (serve, serveopts, _('[OPTION]...'))
+    cmdtable['tsnapshot'] = (snapshot, subtreesopts + profileopts,
+                             _('[OPTION]... [DEST]'))
+    cmdtable['trestore'] = (restore, restoreopts, _('[OPTION]... SOURCE'))
+    cmdtable['^tstatus'] = _newcte('status', status,
+                                   subtreesopts + jobsopt + profileopts,
+                                   json=True)
+    cmdtable['^tupdate'] = _newcte('update', update,
+                                   subtreesopts + profileopts)
+    cmdtable['ttag'] = _newcte('tag', tag, subtreesopts + profileopts)
+    cmdtable['ttip'] = _newcte('tip', tip,
+                               subtreesopts + jobsopt + profileopts, json=True)
     cmdtable['tversion'] = (version, [], '')
-    cmdtable['tdebugkeys'] = (debugkeys, namespaceopt, '')
+    cmdtable['tdebugkeys'] = (debugkeys, namespaceopt + debugkeysopts, '')
     if defpath_mod:
         cmdtable['tdefpath'] = (defpath, defpath_opts, _(''))
     if getattr(commands, 'summary', None):
-        cmdtable['tsummary'] = _newcte('summary', summary, subtreesopts)
+        # The summary command is not present in early versions of mercurial
+        cmdtable['tsummary'] = _newcte('summary', summary,
+                                       subtreesopts + jobsopt + profileopts,
+                                       json=True)
+
+    # Commands with --trees-profile show (or log, see [trees] telemetry) the
+    # time spent on each repo.
+    for name, cte in cmdtable.items():
+        if isinstance(cte, _lazycte):
+            if 'trees-profile' in [o[1] for o in cte.extraopts]:
+                cte.func = _profiled(cte.func, name.lstrip('^').split('|')[0])
+        elif 'trees-profile' in [o[1] for o in cte[1]]:
+            cmdtable[name] = (_profiled(cte[0],
+                                        name.lstrip('^').split('|')[0]),) + \
+                             tuple(cte[1:])
 
 # hg > 3.8: setting norepo and optionalrepo can only be done through decorators
 # and these attributes are no longer present.
@@ -1092,6 +4165,66 @@ def _repo_opener(repo, ns):
     else:
         return repo.opener(ns)
 
+def _safesubtree(subtree):
+    """Return True if subtree is a relative path that stays within its repo."""
+    p = util.pconvert(subtree)
+    return bool(p) and not os.path.isabs(subtree) and not p.startswith('/') \
+           and '..' not in p.split('/')
+
+def _recursivens(namespace):
+    """Return the pushkey namespace listing every repo in a tree (see
+    genrecursivekeys) configured in namespace."""
+    return namespace + '-recursive'
+
+def genrecursivekeys(namespace):
+    """Return a listkeys function for the recursive form of namespace.
+
+    The keys list the subtrees of the repo and, recursively, of each subtree,
+    so that a client can learn the whole tree in a single request.  Key 'i'
+    (for i = 0, 1, ...) is '<parent> <subtree>', where subtree is relative to
+    the repo listed as key parent (-1 for the top-level repo); parents are
+    listed before their subtrees.  Key 'v' holds the version of the format.
+
+    There are no keys (and clients read each repo's configuration instead) if
+    a configuration refers to a url, which only the client can follow, or to a
+    path outside the repo containing it, which this request must not read."""
+    def _listkeys(repo):
+        d = {'v': '1'}
+        seen = {}
+        def read(root):
+            try:
+                f = open(os.path.join(root, '.hg', namespace))
+                try:
+                    return [line.rstrip('\n\r') for line in f]
+                finally:
+                    f.close()
+            except IOError:
+                return []
+        def add(parent, root):
+            real = os.path.realpath(root)
+            if real in seen:
+                return True
+            seen[real] = True
+            for subtree in read(root):
+                if subtree.split(':', 2)[0] in hg.schemes or \
+                   not _safesubtree(subtree):
+                    return False
+                sub = os.path.realpath(os.path.join(root, subtree))
+                if not sub.startswith(os.path.realpath(root) + os.sep):
+                    return False
+                i = len(d) - 1
+                d[str(i)] = '%d %s' % (parent, subtree)
+                if not add(i, os.path.join(root, subtree)):
+                    return False
+            return True
+        try:
+            if add(-1, repo.root):
+                return d
+        except (IOError, OSError):
+            pass
+        return {}
+    return _listkeys
+
 def genlistkeys(namespace):
     def _listkeys(repo):
         # trees are ordered, so the keys are the non-negative integers.
@@ -1113,6 +4246,7 @@ def reposetup(ui, repo):
     try:
         for ns in [_ns(ui, {})] + x:
             pushkey.register(ns, pushfunc, genlistkeys(ns))
+            pushkey.register(_recursivens(ns), pushfunc, genrecursivekeys(ns))
     except exceptions.ImportError:
         # hg < 1.6 - no pushkey.
         def _listkeys(self, namespace):